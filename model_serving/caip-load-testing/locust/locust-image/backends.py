@@ -0,0 +1,174 @@
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+The TensorFlow Serving gRPC target of the load test.
+
+The gRPC client accepts the same pre-serialized JSON request bodies as the
+REST clients, so all targets share the payload handling. The bodies are
+converted to PredictRequest messages with the same rules as the TF Serving
+REST API: a list of objects is converted to named inputs, any other list
+to the single input of the model, and {"b64": ...} values to bytes.
+The conversions of recent bodies are cached, because the payload pool
+sends the same bodies repeatedly unless it re-packs the instances. The
+load test converts the bodies with `prepare_request` before it starts
+timing a request, so the conversion is not counted as gRPC latency.
+
+The client requires the tensorflow-serving-api package, which is not
+installed in the default Locust image.
+"""
+
+import base64
+import collections
+import json
+import threading
+
+
+DEFAULT_INPUT_NAME = 'inputs'
+DEFAULT_TIMEOUT_SEC = 60
+CONVERSION_CACHE_SIZE = 1024
+
+
+def _decode_b64(value):
+    if isinstance(value, dict) and set(value) == {'b64'}:
+        return base64.b64decode(value['b64'])
+    if isinstance(value, list):
+        return [_decode_b64(item) for item in value]
+    return value
+
+
+def instances_to_inputs(instances, input_name=DEFAULT_INPUT_NAME):
+    """
+    Converts the instances of a JSON predict request to
+    a dictionary of input values in the columnar format.
+    """
+    if instances and all(isinstance(instance, dict) for instance in instances) and not any(
+            set(instance) == {'b64'} for instance in instances):
+        inputs = collections.OrderedDict()
+        for name in instances[0]:
+            inputs[name] = [_decode_b64(instance[name]) for instance in instances]
+        return inputs
+    return {input_name: _decode_b64(instances)}
+
+
+def model_version_fields(version):
+    """
+    Returns the TF Serving model spec fields of a version. Numeric
+    versions select a model version, anything else a version label.
+    """
+    if version is None:
+        return {}
+    if str(version).isdigit():
+        return {'version': int(version)}
+    return {'version_label': str(version)}
+
+
+class GRPCResponse(object):
+    """
+    Exposes a PredictResponse with the attributes of an HTTP response.
+    """
+
+    status_code = 200
+
+    def __init__(self, response):
+        self.content = response.SerializeToString()
+
+    @property
+    def text(self):
+        return ''
+
+
+class TFServingGRPCClient(object):
+    """
+    A client of the TF Serving PredictionService gRPC API.
+
+    All clients in a process share one channel. gRPC multiplexes the
+    concurrent requests over its connection.
+    """
+
+    _channel = None
+    _channel_lock = threading.Lock()
+    # The converted requests shared by all clients, keyed by the model,
+    # the version and the body, in LRU order
+    _requests = collections.OrderedDict()
+
+    def __init__(self, service_endpoint, input_name=DEFAULT_INPUT_NAME, timeout=DEFAULT_TIMEOUT_SEC):
+        try:
+            import grpc
+            import tensorflow as tf
+            from tensorflow_serving.apis import predict_pb2
+            from tensorflow_serving.apis import prediction_service_pb2_grpc
+        except ImportError:
+            raise ImportError(
+                'The TF Serving gRPC target requires the tensorflow-serving-api package')
+
+        self._make_tensor_proto = tf.make_tensor_proto
+        self._predict_pb2 = predict_pb2
+        self.input_name = input_name
+        self.timeout = timeout
+
+        with TFServingGRPCClient._channel_lock:
+            if TFServingGRPCClient._channel is None:
+                TFServingGRPCClient._channel = self._create_channel(grpc, service_endpoint)
+        self._stub = prediction_service_pb2_grpc.PredictionServiceStub(TFServingGRPCClient._channel)
+
+    @staticmethod
+    def _create_channel(grpc, service_endpoint):
+        # Locust runs the users as greenlets
+        try:
+            from grpc.experimental import gevent as grpc_gevent
+            grpc_gevent.init_gevent()
+        except ImportError:
+            pass
+
+        scheme, _, target = service_endpoint.rpartition('://')
+        if scheme in ('https', 'grpcs'):
+            return grpc.secure_channel(target, grpc.ssl_channel_credentials())
+        return grpc.insecure_channel(target)
+
+    def prepare_request(self, model, version, body):
+        """
+        Converts a pre-serialized JSON request body to a PredictRequest.
+        """
+        key = (model, version, body)
+        request = self._requests.get(key)
+        if request is not None:
+            self._requests.move_to_end(key)
+            return request
+
+        request_body = json.loads(body)
+        request = self._predict_pb2.PredictRequest()
+        request.model_spec.name = model
+        request.model_spec.signature_name = request_body.get('signature_name', 'serving_default')
+        for field, value in model_version_fields(version).items():
+            if field == 'version':
+                request.model_spec.version.value = value
+            else:
+                request.model_spec.version_label = value
+        for name, values in instances_to_inputs(request_body['instances'], self.input_name).items():
+            request.inputs[name].CopyFrom(self._make_tensor_proto(values))
+
+        self._requests[key] = request
+        if len(self._requests) > CONVERSION_CACHE_SIZE:
+            self._requests.popitem(last=False)
+        return request
+
+    def predict_encoded(self, project_id, model, version, body):
+        """
+        Invokes the Predict method with a pre-serialized JSON request body
+        or a request returned by `prepare_request`.
+        """
+        if isinstance(body, (bytes, str)):
+            body = self.prepare_request(model, version, body)
+        response = self._stub.Predict(body, self.timeout)
+        return GRPCResponse(response)
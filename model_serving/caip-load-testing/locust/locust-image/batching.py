@@ -0,0 +1,90 @@
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A sweep over client-side batch sizes.
+
+In the batch sweep mode the instances of the test data are re-packed into
+requests of a fixed batch size. The batch size is changed step by step,
+and the request latency and the throughput in instances per second
+are measured at each step. The sweep is configured in the `load_pattern`
+section of the test config JSON:
+
+    "load_pattern": {
+        "mode": "batch_sweep",
+        "batch_sizes": [1, 2, 4, 8, 16, 32, 64],
+        "warmup_sec": 15,
+        "step_duration_sec": 60
+    }
+
+The sweep runs with the closed-loop users, so the number of users sets
+the request concurrency. It can also be combined with an open-loop
+`stages` schedule, in which case the request rate is held constant.
+"""
+
+
+def batch_label(signature, batch_size):
+    """
+    Returns the name the requests of a batch size are tracked under.
+    """
+    return '{}[batch={}]'.format(signature, batch_size)
+
+
+class BatchSweep(object):
+    """
+    Collects the measurements of a batch size sweep.
+    """
+
+    def __init__(self, batch_sizes):
+        if not batch_sizes or min(batch_sizes) < 1:
+            raise ValueError('The batch sizes must be positive integers')
+
+        self.batch_sizes = [int(batch_size) for batch_size in batch_sizes]
+        self.steps = []
+
+    @classmethod
+    def from_config(cls, load_pattern):
+        return cls(load_pattern['batch_sizes'])
+
+    def report(self, batch_size, duration, num_requests, num_failures, p50_ms, p99_ms):
+        """
+        Records the measurement of a step and returns its summary.
+        """
+        succeeded = num_requests - num_failures
+        step = {
+            'batch_size': batch_size,
+            'requests_per_sec': num_requests / duration,
+            'instances_per_sec': succeeded * batch_size / duration,
+            'error_rate': float(num_failures) / num_requests if num_requests else 1.0,
+            'p50_ms': p50_ms,
+            'p99_ms': p99_ms
+        }
+        self.steps.append(step)
+        return step
+
+    @property
+    def best_batch_size(self):
+        """
+        The batch size with the highest throughput in instances per second.
+        """
+        if not self.steps:
+            return None
+        return max(self.steps, key=lambda step: step['instances_per_sec'])['batch_size']
+
+    def to_report(self, **labels):
+        report = dict(labels)
+        report.update({
+            'best_batch_size': self.best_batch_size,
+            'steps': self.steps
+        })
+        return report
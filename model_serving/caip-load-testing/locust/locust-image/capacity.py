@@ -0,0 +1,155 @@
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Search for the maximum arrival rate a model version sustains under a latency SLO.
+
+The search first steps the arrival rate up geometrically from `min_rate`
+until a step violates the SLO, then binary searches between the last
+passing and the first failing rate. A step passes if its p99 latency is
+within the SLO and its error rate does not exceed `max_error_rate`.
+
+A capacity test is configured in the `load_pattern` section of the test
+config JSON:
+
+    "load_pattern": {
+        "mode": "capacity",
+        "slo_p99_ms": 300,
+        "max_error_rate": 0.01,
+        "min_rate": 10,
+        "max_rate": 2000,
+        "step_multiplier": 2,
+        "tolerance": 0.05,
+        "warmup_sec": 15,
+        "step_duration_sec": 60
+    }
+"""
+
+
+DEFAULT_MAX_ERROR_RATE = 0.01
+DEFAULT_STEP_MULTIPLIER = 2.0
+DEFAULT_TOLERANCE = 0.05
+DEFAULT_WARMUP_SEC = 15
+DEFAULT_STEP_DURATION_SEC = 60
+
+
+class SaturationSearch(object):
+    """
+    Finds the highest passing arrival rate with a step-up and binary search.
+
+    Call `next_rate` to get the rate to measure and `report` to record the
+    measurement, until `next_rate` returns None. The search stops when
+    the gap between the passing and failing rates is within `tolerance`
+    relative to the passing rate.
+    """
+
+    def __init__(self,
+                 slo_p99_ms,
+                 min_rate,
+                 max_rate,
+                 max_error_rate=DEFAULT_MAX_ERROR_RATE,
+                 step_multiplier=DEFAULT_STEP_MULTIPLIER,
+                 tolerance=DEFAULT_TOLERANCE):
+        if not 0 < min_rate <= max_rate:
+            raise ValueError('The rates must satisfy 0 < min_rate <= max_rate')
+        if step_multiplier <= 1:
+            raise ValueError('step_multiplier must be greater than 1')
+
+        self.slo_p99_ms = slo_p99_ms
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.max_error_rate = max_error_rate
+        self.step_multiplier = step_multiplier
+        self.tolerance = tolerance
+        self.steps = []
+        self.passing_rate = None
+        self.failing_rate = None
+
+    @classmethod
+    def from_config(cls, load_pattern):
+        return cls(
+            slo_p99_ms=load_pattern['slo_p99_ms'],
+            min_rate=load_pattern['min_rate'],
+            max_rate=load_pattern['max_rate'],
+            max_error_rate=load_pattern.get('max_error_rate', DEFAULT_MAX_ERROR_RATE),
+            step_multiplier=load_pattern.get('step_multiplier', DEFAULT_STEP_MULTIPLIER),
+            tolerance=load_pattern.get('tolerance', DEFAULT_TOLERANCE))
+
+    def next_rate(self):
+        """
+        Returns the next arrival rate to measure or None if the search is done.
+        """
+        if self.failing_rate is None:
+            if self.passing_rate is None:
+                return self.min_rate
+            if self.passing_rate >= self.max_rate:
+                return None
+            return min(self.passing_rate * self.step_multiplier, self.max_rate)
+
+        if self.passing_rate is None:
+            # Even the minimum rate violates the SLO
+            return None
+        if self.failing_rate - self.passing_rate <= self.tolerance * self.passing_rate:
+            return None
+        return (self.passing_rate + self.failing_rate) / 2
+
+    def report(self, rate, p99_ms, error_rate, achieved_rate=None):
+        """
+        Records the measurement of a step and returns True if it passed.
+        """
+        passed = p99_ms <= self.slo_p99_ms and error_rate <= self.max_error_rate
+        self.steps.append({
+            'target_rate': rate,
+            'achieved_rate': achieved_rate,
+            'p99_ms': p99_ms,
+            'error_rate': error_rate,
+            'passed': passed
+        })
+        if passed:
+            self.passing_rate = max(rate, self.passing_rate or 0)
+        else:
+            self.failing_rate = rate if self.failing_rate is None else min(rate, self.failing_rate)
+        return passed
+
+    @property
+    def max_sustainable_rate(self):
+        return self.passing_rate
+
+    def to_report(self, **labels):
+        """
+        Returns the capacity report with optional labels, e.g. a model and version.
+        """
+        report = dict(labels)
+        report.update({
+            'slo_p99_ms': self.slo_p99_ms,
+            'max_error_rate': self.max_error_rate,
+            'max_sustainable_rate': self.passing_rate,
+            'first_failing_rate': self.failing_rate,
+            'saturated': self.failing_rate is not None,
+            'steps': self.steps
+        })
+        return report
+
+
+def find_max_sustainable_rate(search, measure):
+    """
+    Runs the search to completion with a `measure(rate)` callable that returns
+    a (p99_ms, error_rate) tuple, and returns the max sustainable rate.
+    """
+    rate = search.next_rate()
+    while rate is not None:
+        p99_ms, error_rate = measure(rate)
+        search.report(rate, p99_ms, error_rate)
+        rate = search.next_rate()
+
+    return search.max_sustainable_rate
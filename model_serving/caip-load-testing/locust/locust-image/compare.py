@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compares the results of two load test runs and flags regressions.
+
+The runs are compared per signature, so they can test different models,
+versions or machine types. The command exits with a non-zero status
+if the candidate run regressed, so it can gate a deployment:
+
+    python compare.py gs://bucket/locust-test/reports/test-1/results.parquet \\
+        gs://bucket/locust-test/reports/test-2/results.parquet \\
+        --max_throughput_drop 0.05 --max_latency_increase 0.1
+"""
+
+import argparse
+import statistics
+import sys
+
+from results import ResultsTable
+
+
+DEFAULT_MAX_THROUGHPUT_DROP = 0.05
+DEFAULT_MAX_LATENCY_INCREASE = 0.10
+DEFAULT_MAX_ERROR_RATE_INCREASE = 0.01
+
+LATENCY_METRICS = ['latency_p50', 'latency_p99']
+
+
+def load_results(path):
+    """
+    Reads a results file from a local path or GCS.
+    """
+    if path.startswith('gs://'):
+        from google.cloud import storage
+
+        bucket_name, blob_name = path[len('gs://'):].split('/', 1)
+        data = storage.Client().bucket(bucket_name).blob(blob_name).download_as_string()
+    else:
+        with open(path, 'rb') as f:
+            data = f.read()
+    return ResultsTable.from_bytes(data)
+
+
+def _median(values):
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
+
+
+def summarize(table):
+    """
+    Returns the throughput, the median interval latency percentiles
+    and the error rate of each signature of a run.
+    """
+    series = {}
+    for row in table.rows():
+        series.setdefault(row['signature'], []).append(row)
+
+    summaries = {}
+    for signature, rows in series.items():
+        last = max(rows, key=lambda row: row['timestamp'])
+        summary = {
+            'throughput': statistics.mean(row['rps'] or 0 for row in rows),
+            'error_rate': float(last['num_failures']) / last['num_requests']
+                          if last['num_requests'] else 0.0
+        }
+        for metric in LATENCY_METRICS:
+            summary[metric] = _median(row[metric] for row in rows)
+        summaries[signature] = summary
+    return summaries
+
+
+def _relative_change(baseline, candidate):
+    if not baseline or candidate is None:
+        return None
+    return candidate / baseline - 1
+
+
+def compare(baseline,
+            candidate,
+            max_throughput_drop=DEFAULT_MAX_THROUGHPUT_DROP,
+            max_latency_increase=DEFAULT_MAX_LATENCY_INCREASE,
+            max_error_rate_increase=DEFAULT_MAX_ERROR_RATE_INCREASE):
+    """
+    Compares the summaries of two runs. Returns a list of comparisons
+    of each signature and metric, and a list of regression descriptions.
+    """
+    comparisons = []
+    regressions = []
+    for signature in sorted(baseline):
+        if signature not in candidate:
+            regressions.append('{}: missing from the candidate run'.format(signature))
+            continue
+
+        for metric in ['throughput'] + LATENCY_METRICS + ['error_rate']:
+            base_value = baseline[signature][metric]
+            candidate_value = candidate[signature][metric]
+            change = _relative_change(base_value, candidate_value)
+            if metric == 'throughput':
+                regressed = change is not None and change < -max_throughput_drop
+            elif metric == 'error_rate':
+                regressed = candidate_value - base_value > max_error_rate_increase
+            else:
+                regressed = change is not None and change > max_latency_increase
+            comparisons.append({
+                'signature': signature,
+                'metric': metric,
+                'baseline': base_value,
+                'candidate': candidate_value,
+                'change': change,
+                'regression': regressed
+            })
+            if regressed:
+                regressions.append('{}: {} changed from {:.4g} to {:.4g}'.format(
+                    signature, metric, base_value, candidate_value))
+
+    return comparisons, regressions
+
+
+def _format(value, pattern='{:.4g}'):
+    return '-' if value is None else pattern.format(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('baseline', help='The results file of the baseline run')
+    parser.add_argument('candidate', help='The results file of the candidate run')
+    parser.add_argument('--max_throughput_drop', type=float, default=DEFAULT_MAX_THROUGHPUT_DROP,
+                        help='The maximum relative drop of the throughput')
+    parser.add_argument('--max_latency_increase', type=float, default=DEFAULT_MAX_LATENCY_INCREASE,
+                        help='The maximum relative increase of the p50 and p99 latency')
+    parser.add_argument('--max_error_rate_increase', type=float, default=DEFAULT_MAX_ERROR_RATE_INCREASE,
+                        help='The maximum absolute increase of the error rate')
+    args = parser.parse_args(argv)
+
+    comparisons, regressions = compare(
+        summarize(load_results(args.baseline)),
+        summarize(load_results(args.candidate)),
+        max_throughput_drop=args.max_throughput_drop,
+        max_latency_increase=args.max_latency_increase,
+        max_error_rate_increase=args.max_error_rate_increase)
+
+    print('{:<40} {:<12} {:>12} {:>12} {:>9}'.format(
+        'signature', 'metric', 'baseline', 'candidate', 'change'))
+    for comparison in comparisons:
+        print('{:<40} {:<12} {:>12} {:>12} {:>9}{}'.format(
+            comparison['signature'],
+            comparison['metric'],
+            _format(comparison['baseline']),
+            _format(comparison['candidate']),
+            _format(comparison['change'], '{:+.1%}'),
+            '  REGRESSION' if comparison['regression'] else ''))
+
+    if regressions:
+        print('\nRegressions:\n  ' + '\n  '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Buffered, asynchronous export of the test metrics.
+
+The Locust master produces a metrics record per stats entry at every
+logging interval. Records are queued in a bounded in-memory buffer and
+written in batches by a background greenlet. The blocking sink calls run
+in gevent's native thread pool, so a slow backend does not stall the
+master's event loop.
+
+The sink is selected with the LOCUST_METRICS_SINK environment variable:
+
+    cloud_logging              - Cloud Logging (default)
+    jsonl:/path/to/file.jsonl  - a local JSON lines file
+    prometheus:9646            - a Prometheus scrape endpoint on the given port
+"""
+
+import collections
+import json
+import logging
+
+import gevent
+
+
+METRICS_SINK_ENV = 'LOCUST_METRICS_SINK'
+DEFAULT_METRICS_SINK = 'cloud_logging'
+
+DEFAULT_MAX_QUEUE_SIZE = 5000
+DEFAULT_MAX_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL_SEC = 10
+
+# Record fields identifying a time series
+SERIES_KEY_FIELDS = ('test_id', 'model', 'signature')
+# Record fields whose latest value supersedes the earlier ones. The other
+# fields, e.g. the latency percentiles, describe a single interval.
+CUMULATIVE_FIELDS = ('num_requests', 'num_failures', 'user_count')
+
+
+class CloudLoggingSink(object):
+    """
+    Writes metrics records as structured Cloud Logging entries.
+    """
+
+    def __init__(self, log_name):
+        import google.auth
+        from google.cloud.logging_v2 import LoggingServiceV2Client
+
+        credentials, project_id = google.auth.default()
+        self._client = LoggingServiceV2Client(credentials=credentials)
+        self._log_path = self._client.log_path(project_id, log_name)
+
+    def write(self, records):
+        from google.cloud.logging_v2.types import LogEntry
+        from google.protobuf.struct_pb2 import Struct
+        from google.protobuf.timestamp_pb2 import Timestamp
+
+        log_entries = []
+        for record in records:
+            timestamp = Timestamp()
+            timestamp.FromDatetime(record['timestamp'])
+            payload = Struct()
+            payload.update(record['payload'])
+            log_entries.append(LogEntry(
+                log_name=self._log_path,
+                resource={'type': 'global'},
+                timestamp=timestamp,
+                json_payload=payload
+            ))
+        self._client.write_log_entries(entries=log_entries)
+
+
+class JsonlSink(object):
+    """
+    Appends metrics records to a local JSON lines file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        with open(self.path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(dict(
+                    record['payload'], timestamp=record['timestamp'].isoformat())))
+                f.write('\n')
+
+
+class PrometheusSink(object):
+    """
+    Exposes the latest value of every numeric metric as a Prometheus gauge.
+    """
+
+    def __init__(self, port):
+        try:
+            import prometheus_client
+        except ImportError:
+            raise ImportError(
+                'The Prometheus sink requires the prometheus_client package')
+
+        self._prometheus_client = prometheus_client
+        self._gauges = {}
+        prometheus_client.start_http_server(int(port))
+
+    def write(self, records):
+        for record in records:
+            labels = {field: str(record['payload'].get(field, ''))
+                      for field in SERIES_KEY_FIELDS}
+            for name, value in record['payload'].items():
+                if name in SERIES_KEY_FIELDS or not isinstance(value, (int, float)):
+                    continue
+                if name not in self._gauges:
+                    self._gauges[name] = self._prometheus_client.Gauge(
+                        'locust_{}'.format(name), name, list(SERIES_KEY_FIELDS))
+                self._gauges[name].labels(**labels).set(value)
+
+
+def create_sink(spec, log_name):
+    """
+    Creates a sink from a LOCUST_METRICS_SINK specification.
+    """
+    kind, _, argument = spec.partition(':')
+    if kind == 'cloud_logging':
+        return CloudLoggingSink(log_name)
+    if kind == 'jsonl':
+        return JsonlSink(argument)
+    if kind == 'prometheus':
+        return PrometheusSink(argument)
+    raise ValueError('Unsupported metrics sink: {}'.format(spec))
+
+
+class MetricsExporter(object):
+    """
+    Batches metrics records and writes them to a sink in the background.
+
+    When the queue is full a new cumulative record, i.e. one with only
+    cumulative counters, replaces the oldest queued cumulative record of
+    the same time series, which it supersedes. Otherwise the oldest record
+    is dropped, as the interval it describes cannot be recovered.
+    """
+
+    def __init__(self,
+                 sink,
+                 max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL_SEC):
+        self.sink = sink
+        self.max_queue_size = max_queue_size
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.dropped_count = 0
+        self.exported_count = 0
+        self._queue = collections.deque()
+        self._greenlet = None
+
+    def __len__(self):
+        return len(self._queue)
+
+    @staticmethod
+    def _series_key(record):
+        return tuple(record['payload'].get(field) for field in SERIES_KEY_FIELDS)
+
+    @staticmethod
+    def _is_cumulative(record):
+        return all(name in SERIES_KEY_FIELDS or name in CUMULATIVE_FIELDS
+                   for name in record['payload'])
+
+    def submit(self, records):
+        """
+        Queues records for export. Never blocks.
+        """
+        for record in records:
+            if len(self._queue) >= self.max_queue_size:
+                self._make_room(record)
+            self._queue.append(record)
+
+    def _make_room(self, record):
+        if self._is_cumulative(record):
+            key = self._series_key(record)
+            for queued in self._queue:
+                if self._is_cumulative(queued) and self._series_key(queued) == key:
+                    self._queue.remove(queued)
+                    self.dropped_count += 1
+                    return
+        self._queue.popleft()
+        self.dropped_count += 1
+
+    def flush(self):
+        """
+        Writes all queued records to the sink in batches. The sink calls are
+        executed in a native thread while the calling greenlet waits.
+        """
+        threadpool = gevent.get_hub().threadpool
+        while self._queue:
+            batch = [self._queue.popleft()
+                     for _ in range(min(self.max_batch_size, len(self._queue)))]
+            try:
+                threadpool.spawn(self.sink.write, batch).get()
+            except Exception as e:
+                logging.error('Failed to export %d metrics records: %s', len(batch), e)
+                # Put the batch back and retry at the next flush
+                free_slots = self.max_queue_size - len(self._queue)
+                self.dropped_count += max(len(batch) - free_slots, 0)
+                self._queue.extendleft(reversed(batch[:free_slots]))
+                return
+            self.exported_count += len(batch)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            self.flush()
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+        return self._greenlet
+
+    def stop(self, flush=True):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+        if flush:
+            self.flush()
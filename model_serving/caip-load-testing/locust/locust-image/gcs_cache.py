@@ -0,0 +1,119 @@
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A per-process cache of GCS objects validated with ETags.
+
+All users of a Locust process read the test config and the test data
+through one cache. An object is downloaded once to a local temporary
+file; later reads only fetch its metadata and download it again if its
+ETag changed. Within `max_age_sec` of the last validation the cached
+file is used without contacting GCS at all, which absorbs the burst of
+reads when users are spawned. Only the ETags and the file paths are
+kept in memory, so large objects such as the test data can be streamed
+from the local disk.
+"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from google.cloud import storage
+
+
+DEFAULT_MAX_AGE_SEC = 30
+
+
+class GCSCache(object):
+    """
+    Caches GCS objects in local temporary files.
+    """
+
+    def __init__(self, client=None, max_age_sec=DEFAULT_MAX_AGE_SEC):
+        self._client = client
+        self.max_age_sec = max_age_sec
+        self.download_count = 0
+        # Maps (bucket, blob) to (etag, validation time, local path)
+        self._entries = {}
+        self._dir = None
+        # Locust monkey patches threading, so concurrent users wait
+        # for a single download instead of starting their own
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = storage.Client()
+        return self._client
+
+    def _download(self, blob, bucket_name, blob_name):
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix='gcs-cache-')
+        fd, path = tempfile.mkstemp(dir=self._dir)
+        os.close(fd)
+        blob.download_to_filename(path)
+        self.download_count += 1
+        logging.info("Downloaded gs://{}/{}, {} bytes".format(
+            bucket_name, blob_name, os.path.getsize(path)))
+        return path
+
+    def get_path(self, bucket_name, blob_name, max_age_sec=None):
+        """
+        Returns the path of the local copy of a GCS object. The max age
+        of the last validation can be overridden, e.g. set to 0
+        to always validate the cached copy. A copy replaced by a newer
+        version of the object is removed, but files already open keep
+        their content.
+        """
+        if max_age_sec is None:
+            max_age_sec = self.max_age_sec
+        key = (bucket_name, blob_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry[1] < max_age_sec:
+                return entry[2]
+
+            blob = self.client.bucket(bucket_name).get_blob(blob_name)
+            if blob is None:
+                raise FileNotFoundError('gs://{}/{} does not exist'.format(bucket_name, blob_name))
+            if entry and entry[0] == blob.etag:
+                path = entry[2]
+            else:
+                path = self._download(blob, bucket_name, blob_name)
+                if entry:
+                    os.remove(entry[2])
+            self._entries[key] = (blob.etag, time.time(), path)
+            return path
+
+    def open(self, bucket_name, blob_name, max_age_sec=None):
+        """
+        Opens the local copy of a GCS object as a binary file.
+        """
+        return open(self.get_path(bucket_name, blob_name, max_age_sec), 'rb')
+
+    def get(self, bucket_name, blob_name, max_age_sec=None):
+        """
+        Returns the content of a GCS object as bytes.
+        """
+        with self.open(bucket_name, blob_name, max_age_sec) as f:
+            return f.read()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            if self._dir is not None:
+                shutil.rmtree(self._dir, ignore_errors=True)
+                self._dir = None
@@ -0,0 +1,198 @@
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+High dynamic range latency histograms.
+
+The histograms use the HdrHistogram bucketing scheme: values are grouped
+into power of two buckets, each split into linear sub-buckets, so every
+recorded value keeps a fixed number of significant decimal digits over an
+unbounded range. Counts are stored sparsely, which keeps the histograms
+small enough to be shipped from the workers to the master with every
+stats report and merged there without losing precision.
+"""
+
+import math
+
+
+DEFAULT_SIGNIFICANT_FIGURES = 3
+REPORTED_PERCENTILES = [
+    ('p50', 0.5),
+    ('p90', 0.9),
+    ('p99', 0.99),
+    ('p999', 0.999)
+]
+
+
+class LatencyHistogram(object):
+    """
+    A sparse HDR histogram of integer values, e.g. latencies in microseconds.
+    """
+
+    def __init__(self, significant_figures=DEFAULT_SIGNIFICANT_FIGURES):
+        if not 1 <= significant_figures <= 5:
+            raise ValueError('significant_figures must be between 1 and 5')
+
+        self.significant_figures = significant_figures
+        largest_single_unit_value = 2 * 10 ** significant_figures
+        sub_bucket_count_magnitude = int(math.ceil(math.log2(largest_single_unit_value)))
+        self._sub_bucket_half_count_magnitude = sub_bucket_count_magnitude - 1
+        self._sub_bucket_half_count = 1 << self._sub_bucket_half_count_magnitude
+        self._sub_bucket_mask = (1 << sub_bucket_count_magnitude) - 1
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.total_count = 0
+        self.min_value = None
+        self.max_value = None
+
+    def _index_for(self, value):
+        bucket_index = max(0, (value | self._sub_bucket_mask).bit_length()
+                           - (self._sub_bucket_half_count_magnitude + 1))
+        sub_bucket_index = value >> bucket_index
+        return (((bucket_index + 1) << self._sub_bucket_half_count_magnitude)
+                + sub_bucket_index - self._sub_bucket_half_count)
+
+    def _highest_value_for(self, index):
+        bucket_index = (index >> self._sub_bucket_half_count_magnitude) - 1
+        sub_bucket_index = (index & (self._sub_bucket_half_count - 1)) + self._sub_bucket_half_count
+        if bucket_index < 0:
+            sub_bucket_index -= self._sub_bucket_half_count
+            bucket_index = 0
+        return (sub_bucket_index << bucket_index) + (1 << bucket_index) - 1
+
+    def record(self, value, count=1):
+        value = max(int(value), 0)
+        index = self._index_for(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total_count += count
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+        if self.max_value is None or value > self.max_value:
+            self.max_value = value
+
+    def merge(self, other):
+        if other.significant_figures != self.significant_figures:
+            raise ValueError('Cannot merge histograms with different precision')
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total_count += other.total_count
+        if other.total_count:
+            self.min_value = other.min_value if self.min_value is None else min(self.min_value, other.min_value)
+            self.max_value = other.max_value if self.max_value is None else max(self.max_value, other.max_value)
+
+    def value_at_percentile(self, percentile):
+        """
+        Returns the highest value equivalent to the given percentile (0-1).
+        """
+        if not self.total_count:
+            return 0
+        if percentile >= 1:
+            return self.max_value
+
+        count_at_percentile = max(int(math.ceil(percentile * self.total_count)), 1)
+        running_count = 0
+        for index in sorted(self.counts):
+            running_count += self.counts[index]
+            if running_count >= count_at_percentile:
+                return min(self._highest_value_for(index), self.max_value)
+        return self.max_value
+
+    def to_dict(self):
+        """
+        Serializes the histogram to a dictionary of lists that can be
+        sent with Locust messages.
+        """
+        indices = sorted(self.counts)
+        return {
+            'significant_figures': self.significant_figures,
+            'indices': indices,
+            'counts': [self.counts[index] for index in indices],
+            'min': self.min_value,
+            'max': self.max_value
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['significant_figures'])
+        histogram.counts = dict(zip(data['indices'], data['counts']))
+        histogram.total_count = sum(data['counts'])
+        histogram.min_value = data['min']
+        histogram.max_value = data['max']
+        return histogram
+
+
+class HistogramRegistry(object):
+    """
+    A set of latency histograms keyed by a model deployment and a signature.
+    """
+
+    KEY_SEPARATOR = '|'
+
+    def __init__(self, significant_figures=DEFAULT_SIGNIFICANT_FIGURES):
+        self.significant_figures = significant_figures
+        self.histograms = {}
+
+    def get(self, model, signature):
+        key = (model, signature)
+        if key not in self.histograms:
+            self.histograms[key] = LatencyHistogram(self.significant_figures)
+        return self.histograms[key]
+
+    def record(self, model, signature, value):
+        self.get(model, signature).record(value)
+
+    def reset(self):
+        self.histograms = {}
+
+    def serialize(self):
+        return {self.KEY_SEPARATOR.join(key): histogram.to_dict()
+                for key, histogram in self.histograms.items()}
+
+    def merge_serialized(self, data):
+        for key, histogram in data.items():
+            model, signature = key.split(self.KEY_SEPARATOR, 1)
+            self.get(model, signature).merge(LatencyHistogram.from_dict(histogram))
+
+    def combined(self):
+        """
+        Returns a histogram merging all histograms in the registry.
+        """
+        histogram = LatencyHistogram(self.significant_figures)
+        for other in self.histograms.values():
+            histogram.merge(other)
+        return histogram
+
+    def percentiles(self, model, signature, scale=1e-3):
+        """
+        Returns the reported percentiles and the maximum of a histogram,
+        multiplied by the scale, e.g. converted from microseconds to milliseconds.
+        """
+        histogram = self.histograms.get((model, signature))
+        if histogram is None or not histogram.total_count:
+            return {}
+
+        spectrum = {name: histogram.value_at_percentile(percentile) * scale
+                    for name, percentile in REPORTED_PERCENTILES}
+        spectrum['max'] = histogram.max_value * scale
+        spectrum['count'] = histogram.total_count
+        return spectrum
+
+    def report(self, scale=1e-3):
+        """
+        Returns the percentile spectra of all histograms.
+        """
+        return [dict(model=model, signature=signature,
+                     **self.percentiles(model, signature, scale))
+                for model, signature in sorted(self.histograms)]
@@ -0,0 +1,129 @@
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Open-loop arrival schedules for the load test.
+
+In the open-loop mode requests are sent at a target arrival rate that does not
+depend on how fast the endpoint responds. The schedule is defined in the test
+config JSON, for example:
+
+    "load_pattern": {
+        "mode": "open",
+        "arrival_process": "poisson",
+        "max_in_flight": 64,
+        "stages": [
+            {"duration": 300, "rate": 50},
+            {"duration": 300, "rate": 50, "end_rate": 200},
+            {"duration": 600, "rate": 200}
+        ]
+    }
+
+Rates are total requests per second across the whole test. A stage with
+an `end_rate` ramps linearly from `rate` to `end_rate`. The rate of the last
+stage is held until the test is stopped.
+"""
+
+import random
+
+
+CLOSED_LOOP = 'closed'
+OPEN_LOOP = 'open'
+CAPACITY = 'capacity'
+REPLAY = 'replay'
+BATCH_SWEEP = 'batch_sweep'
+POISSON = 'poisson'
+CONSTANT = 'constant'
+
+DEFAULT_MAX_IN_FLIGHT = 64
+
+# How long an idle generator waits before re-checking a zero rate schedule
+IDLE_INTERVAL_SEC = 0.5
+
+
+class ArrivalSchedule(object):
+    """
+    A piecewise linear schedule of the target arrival rate.
+    """
+
+    def __init__(self, stages, arrival_process=POISSON, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        if not stages:
+            raise ValueError('The arrival schedule requires at least one stage')
+        if arrival_process not in (POISSON, CONSTANT):
+            raise ValueError('Unsupported arrival process: {}'.format(arrival_process))
+
+        self.stages = [(float(stage['duration']),
+                        float(stage['rate']),
+                        float(stage.get('end_rate', stage['rate'])))
+                       for stage in stages]
+        self.arrival_process = arrival_process
+        self.max_in_flight = max_in_flight
+
+    @classmethod
+    def from_config(cls, test_config):
+        """
+        Creates a schedule from the test config or returns None
+        if the test runs in the closed-loop mode.
+
+        In the capacity mode the schedule starts at the minimum rate
+        and the rate is then set by the capacity test controller.
+        A batch sweep runs open-loop if it defines the stages.
+        """
+        load_pattern = test_config.get('load_pattern', {})
+        mode = load_pattern.get('mode', CLOSED_LOOP)
+        if mode == CAPACITY:
+            return cls(
+                stages=[{'duration': 0, 'rate': load_pattern['min_rate']}],
+                arrival_process=load_pattern.get('arrival_process', POISSON),
+                max_in_flight=load_pattern.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT))
+        if mode != OPEN_LOOP and not (mode == BATCH_SWEEP and 'stages' in load_pattern):
+            return None
+
+        return cls(
+            stages=load_pattern['stages'],
+            arrival_process=load_pattern.get('arrival_process', POISSON),
+            max_in_flight=load_pattern.get('max_in_flight', DEFAULT_MAX_IN_FLIGHT))
+
+    @property
+    def duration(self):
+        return sum(stage[0] for stage in self.stages)
+
+    def rate_at(self, elapsed):
+        """
+        Returns the total target arrival rate at the given number
+        of seconds since the start of the test.
+        """
+        stage_start = 0.0
+        for duration, rate, end_rate in self.stages:
+            if elapsed < stage_start + duration:
+                return rate + (end_rate - rate) * (elapsed - stage_start) / duration
+            stage_start += duration
+
+        return self.stages[-1][2]
+
+    def next_interval(self, elapsed, share=1.0, rate=None):
+        """
+        Returns the time in seconds until the next arrival of a generator
+        that produces the given share of the total arrival rate, or None
+        if the target rate is zero. If the total rate is given it overrides
+        the scheduled rate.
+        """
+        if rate is None:
+            rate = self.rate_at(elapsed)
+        rate *= share
+        if rate <= 0:
+            return None
+        if self.arrival_process == POISSON:
+            return random.expovariate(rate)
+
+        return 1.0 / rate
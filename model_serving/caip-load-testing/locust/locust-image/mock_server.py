@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A local stand-in for the AI Platform Prediction predict endpoint.
+
+The server models a serving node as a queue in front of a fixed number of
+model replicas. Each request holds a replica for a service time drawn from
+a constant or exponential distribution, plus `instance_time_ms` for every
+instance in the request, so latency grows with the offered load like a real
+endpoint and explodes once the arrival rate approaches
+`replicas / service_time`. Requests that wait in the queue longer than
+`max_queue_ms` are rejected with an error, which shows up as failures.
+
+Run the server and point Locust at it with authentication disabled:
+
+    python mock_server.py --port 8080 --replicas 4 --service_time_ms 20
+    LOCUST_AUTH=false locust -f tasks.py --host http://localhost:8080
+"""
+
+import argparse
+import http.server
+import json
+import random
+import threading
+import time
+
+
+DEFAULT_REPLICAS = 4
+DEFAULT_SERVICE_TIME_MS = 20
+DEFAULT_MAX_QUEUE_MS = 1000
+DEFAULT_INSTANCE_TIME_MS = 0
+
+
+class MockPredictServer(http.server.ThreadingHTTPServer):
+    """
+    A threaded HTTP server simulating a predict endpoint with limited capacity.
+    """
+
+    daemon_threads = True
+
+    def __init__(self,
+                 server_address,
+                 replicas=DEFAULT_REPLICAS,
+                 service_time_ms=DEFAULT_SERVICE_TIME_MS,
+                 service_time_distribution='exponential',
+                 max_queue_ms=DEFAULT_MAX_QUEUE_MS,
+                 instance_time_ms=DEFAULT_INSTANCE_TIME_MS):
+        super(MockPredictServer, self).__init__(server_address, MockPredictHandler)
+        self.replica_count = replicas
+        self.replicas = threading.BoundedSemaphore(replicas)
+        self.service_time_ms = service_time_ms
+        self.service_time_distribution = service_time_distribution
+        self.max_queue_ms = max_queue_ms
+        self.instance_time_ms = instance_time_ms
+        self.request_count = 0
+        self.rejected_count = 0
+        self._counter_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    @property
+    def capacity_rps(self):
+        return self.replica_count * 1000.0 / self.service_time_ms
+
+    def service_time(self, instance_count=1):
+        batch_time = self.instance_time_ms * instance_count / 1000.0
+        if self.service_time_distribution == 'exponential':
+            return random.expovariate(1000.0 / self.service_time_ms) + batch_time
+        return self.service_time_ms / 1000.0 + batch_time
+
+    def predict(self, instances):
+        """
+        Waits for a free replica and simulates the inference.
+        Returns None if the request timed out in the queue.
+        """
+        with self._counter_lock:
+            self.request_count += 1
+        if not self.replicas.acquire(timeout=self.max_queue_ms / 1000.0):
+            with self._counter_lock:
+                self.rejected_count += 1
+            return None
+        try:
+            time.sleep(self.service_time(len(instances)))
+        finally:
+            self.replicas.release()
+
+        return [[1.0] for _ in instances]
+
+
+class MockPredictHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately, which Nagle's
+    # algorithm would delay on the persistent connections
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        predictions = self.server.predict(request.get('instances', []))
+        if predictions is None:
+            status, response = 503, {'error': 'The model is overloaded'}
+        else:
+            status, response = 200, {'predictions': predictions}
+
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_mock_server(port=0, **kwargs):
+    """
+    Starts the mock server in a background thread and returns it.
+    """
+    server = MockPredictServer(('localhost', port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--replicas', type=int, default=DEFAULT_REPLICAS)
+    parser.add_argument('--service_time_ms', type=float, default=DEFAULT_SERVICE_TIME_MS)
+    parser.add_argument('--service_time_distribution', default='exponential',
+                        choices=['exponential', 'constant'])
+    parser.add_argument('--max_queue_ms', type=float, default=DEFAULT_MAX_QUEUE_MS)
+    parser.add_argument('--instance_time_ms', type=float, default=DEFAULT_INSTANCE_TIME_MS)
+    args = parser.parse_args()
+
+    server = MockPredictServer(
+        ('', args.port),
+        replicas=args.replicas,
+        service_time_ms=args.service_time_ms,
+        service_time_distribution=args.service_time_distribution,
+        max_queue_ms=args.max_queue_ms,
+        instance_time_ms=args.instance_time_ms)
+    print('Serving mock predictions on port {}, capacity {:.0f} requests/sec'.format(
+        args.port, server.capacity_rps))
+    server.serve_forever()
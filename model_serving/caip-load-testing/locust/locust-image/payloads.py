@@ -0,0 +1,287 @@
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A memory-mapped pool of predict request payloads with weighted sampling.
+
+The instances of the test data are serialized to JSON once and written to
+a memory-mapped temporary file, so the payloads of tens of thousands of
+logged requests live in the page cache rather than on the Python heap.
+One pool is shared by all users of a worker process.
+
+Each request samples a signature and a batch size with alias tables in
+constant time. The traffic mix is configured in the `payload_mix` section
+of the test config JSON:
+
+    "payload_mix": {
+        "signature_weights": {"serving_default": 3, "serving_preprocess": 1},
+        "batch_sizes": {"1": 0.7, "8": 0.2, "32": 0.1}
+    }
+
+The test data JSON array is read in chunks from a file and decoded one
+entry at a time while the pool is built, so only the serialized instances
+are kept, off the Python heap.
+
+Signatures are weighted by their number of requests in the test data by
+default. Without `batch_sizes` every request replays the instances of
+a randomly chosen test data request. With `batch_sizes` the instances
+of a request are sampled independently from all instances of the signature.
+"""
+
+import array
+import codecs
+import json
+import mmap
+import random
+import re
+import tempfile
+
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+class _ChunkedText(object):
+    """
+    The text of a JSON document read in chunks. Only the unparsed text,
+    from `index` on, is kept.
+    """
+
+    def __init__(self, source, chunk_size):
+        if isinstance(source, bytes):
+            source = source.decode('utf-8')
+        self.text = source if isinstance(source, str) else ''
+        self.index = 0
+        self.eof = isinstance(source, str)
+        self._source = source
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def read_more(self):
+        """
+        Appends the next chunk to the text. Returns False at the end of the source.
+        """
+        while not self.eof:
+            chunk = self._source.read(self._chunk_size)
+            self.eof = not chunk
+            text = self._decoder.decode(chunk, final=self.eof)
+            if text:
+                self.text = self.text[self.index:] + text
+                self.index = 0
+                return True
+        return False
+
+    def skip_whitespace(self):
+        while True:
+            self.index = _WHITESPACE.match(self.text, self.index).end()
+            if self.index < len(self.text) or not self.read_more():
+                return
+
+    def peek(self):
+        self.skip_whitespace()
+        return self.text[self.index:self.index + 1]
+
+
+def iter_json_array(source, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields the elements of a JSON array, decoding one element at a time.
+    The source is the array as bytes or a string, or a binary file it is
+    read from in chunks, so that only the element being decoded is held
+    in memory.
+    """
+    decoder = json.JSONDecoder()
+    text = _ChunkedText(source, chunk_size)
+    if text.peek() != '[':
+        raise ValueError('The test data must be a JSON array')
+    text.index += 1
+    if text.peek() == ']':
+        return
+    while True:
+        text.skip_whitespace()
+        while True:
+            try:
+                element, end = decoder.raw_decode(text.text, text.index)
+                # A number at the end of the text may continue in the next chunk
+                if end < len(text.text) or text.eof:
+                    break
+            except ValueError:
+                if text.eof:
+                    raise
+            text.read_more()
+        text.index = end
+        yield element
+        separator = text.peek()
+        text.index += 1
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError('Invalid JSON array at position {}'.format(text.index))
+
+
+class AliasTable(object):
+    """
+    Samples indices with given weights in O(1) time with Vose's alias method.
+    """
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+        if not count or total <= 0 or min(weights) < 0:
+            raise ValueError('The weights must be non-negative with a positive sum')
+
+        scaled = [weight * count / total for weight in weights]
+        self._probabilities = [1.0] * count
+        self._aliases = list(range(count))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._probabilities[less] = scaled[less]
+            self._aliases[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+
+    def __len__(self):
+        return len(self._probabilities)
+
+    def sample(self, rng=random):
+        index = int(rng.random() * len(self._probabilities))
+        if rng.random() < self._probabilities[index]:
+            return index
+        return self._aliases[index]
+
+
+class _SignaturePayloads(object):
+    """
+    The offsets of the serialized instances and requests of a signature.
+    The instances of different signatures may be interleaved in the file.
+    """
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.body_prefix = '{{"signature_name":{},"instances":['.format(
+            json.dumps(signature)).encode('utf-8')
+        # Instance i spans bytes [instance_starts[i], instance_ends[i])
+        self.instance_starts = array.array('q')
+        self.instance_ends = array.array('q')
+        # Request j spans instances [request_starts[j], request_starts[j + 1])
+        self.request_starts = array.array('q', [0])
+
+    @property
+    def instance_count(self):
+        return len(self.instance_starts)
+
+    @property
+    def request_count(self):
+        return len(self.request_starts) - 1
+
+
+class PayloadPool(object):
+    """
+    Serialized predict request instances shared by all users of a process.
+    """
+
+    def __init__(self, test_data, signature_weights=None, batch_sizes=None):
+        """
+        Builds the pool from an iterable of test data entries, i.e.
+        dictionaries with a signature and a list of instances. The entries
+        are consumed one at a time.
+        """
+
+        self._file = tempfile.TemporaryFile()
+        self._payloads = {}
+        offset = 0
+        for entry in test_data:
+            payloads = self._payloads.get(entry['signature'])
+            if payloads is None:
+                payloads = self._payloads[entry['signature']] = _SignaturePayloads(
+                    entry['signature'])
+            if not entry['instances']:
+                continue
+            for instance in entry['instances']:
+                data = json.dumps(instance, separators=(',', ':')).encode('utf-8')
+                self._file.write(data)
+                payloads.instance_starts.append(offset)
+                offset += len(data)
+                payloads.instance_ends.append(offset)
+            payloads.request_starts.append(payloads.instance_count)
+
+        self._payloads = {signature: payloads for signature, payloads in self._payloads.items()
+                          if payloads.request_count}
+        if not self._payloads:
+            raise ValueError('The test data does not contain any instances')
+        self._file.flush()
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.signatures = sorted(self._payloads)
+        if signature_weights is None:
+            weights = [self._payloads[signature].request_count for signature in self.signatures]
+        else:
+            weights = [signature_weights.get(signature, 0) for signature in self.signatures]
+        self._signature_table = AliasTable(weights)
+
+        self.batch_sizes = None
+        if batch_sizes:
+            self.batch_sizes = [int(size) for size in batch_sizes]
+            self._batch_size_table = AliasTable(list(batch_sizes.values()))
+
+    @classmethod
+    def from_config(cls, test_data, test_config):
+        """
+        Builds the pool with the traffic mix of the test config. The test
+        data is an iterable of entries, or the bytes or a binary file of a
+        JSON array of entries.
+        """
+        payload_mix = test_config.get('payload_mix', {})
+        if isinstance(test_data, (bytes, str)) or hasattr(test_data, 'read'):
+            test_data = iter_json_array(test_data)
+        return cls(test_data,
+                   signature_weights=payload_mix.get('signature_weights'),
+                   batch_sizes=payload_mix.get('batch_sizes'))
+
+    @property
+    def size_bytes(self):
+        return len(self._buffer)
+
+    def _instance(self, payloads, index):
+        return self._buffer[payloads.instance_starts[index]:payloads.instance_ends[index]]
+
+    def _encode(self, payloads, instance_indices):
+        return b''.join([payloads.body_prefix,
+                         b','.join([self._instance(payloads, i) for i in instance_indices]),
+                         b']}'])
+
+    def sample(self, rng=random, batch_size=None):
+        """
+        Returns a (signature, request body) tuple drawn from the traffic mix.
+        If the batch size is given it overrides the batch size distribution.
+        """
+        payloads = self._payloads[self.signatures[self._signature_table.sample(rng)]]
+        if batch_size is not None:
+            indices = [int(rng.random() * payloads.instance_count) for _ in range(batch_size)]
+        elif self.batch_sizes is None:
+            request = int(rng.random() * payloads.request_count)
+            indices = range(payloads.request_starts[request], payloads.request_starts[request + 1])
+        else:
+            batch_size = self.batch_sizes[self._batch_size_table.sample(rng)]
+            indices = [int(rng.random() * payloads.instance_count) for _ in range(batch_size)]
+
+        return payloads.signature, self._encode(payloads, indices)
+
+    def close(self):
+        self._buffer.close()
+        self._file.close()
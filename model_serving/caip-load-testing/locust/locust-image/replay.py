@@ -0,0 +1,157 @@
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Replay of logged prediction requests with their original timing.
+
+The source is an AI Platform Prediction request-response log exported
+from BigQuery to CSV, with at least the `time` and `raw_data` columns.
+The log is streamed row by row and must be sorted by time. Each Locust
+worker replays one partition of the log: the rows are assigned to the
+workers round-robin, so every worker sees the same traffic shape.
+
+A replay test is configured in the `load_pattern` section of the test
+config JSON:
+
+    "load_pattern": {
+        "mode": "replay",
+        "source": "gs://bucket/prediction_logs.csv",
+        "speedup": 10,
+        "max_gap_sec": 60,
+        "loop": true,
+        "max_in_flight": 64
+    }
+
+The inter-arrival times are divided by `speedup` and gaps longer than
+`max_gap_sec` (measured after the speedup) are shortened to it.
+With `loop` the log is replayed again when it is exhausted.
+"""
+
+import csv
+import datetime
+import re
+import sys
+
+
+DEFAULT_SPEEDUP = 1.0
+DEFAULT_SIGNATURE = 'serving_default'
+
+TIME_COLUMN = 'time'
+RAW_DATA_COLUMN = 'raw_data'
+TIME_FORMATS = ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']
+
+SIGNATURE_PATTERN = re.compile(r'"signature_name"\s*:\s*"([^"]*)"')
+
+
+def parse_log_time(value):
+    """
+    Returns the POSIX timestamp of a BigQuery TIMESTAMP exported to CSV,
+    e.g. 2020-06-03 10:30:00 UTC.
+    """
+    value = value.strip()
+    if value.endswith(' UTC'):
+        value = value[:-4]
+    for time_format in TIME_FORMATS:
+        try:
+            timestamp = datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        return timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+    raise ValueError('Unsupported log time format: {}'.format(value))
+
+
+def read_request_log(path, partition=0, partition_count=1):
+    """
+    Yields (timestamp, signature, request body) tuples of a partition
+    of a request-response log CSV file.
+    """
+    # The request bodies can exceed the default CSV field size limit
+    csv.field_size_limit(sys.maxsize)
+    with open(path, newline='') as f:
+        for index, row in enumerate(csv.DictReader(f)):
+            if index % partition_count != partition:
+                continue
+            raw_data = row[RAW_DATA_COLUMN]
+            # Avoid decoding the request body just to get the signature
+            match = SIGNATURE_PATTERN.search(raw_data)
+            signature = match.group(1) if match else DEFAULT_SIGNATURE
+            yield parse_log_time(row[TIME_COLUMN]), signature, raw_data.encode('utf-8')
+
+
+class RequestLogReplay(object):
+    """
+    A stream of logged requests with their replay offsets in seconds.
+
+    The stream is shared by all users of a process. It is read lazily,
+    so only the requests being sent are held in memory.
+    """
+
+    def __init__(self,
+                 path,
+                 partition=0,
+                 partition_count=1,
+                 speedup=DEFAULT_SPEEDUP,
+                 max_gap_sec=None,
+                 loop=False):
+        if not 0 <= partition < partition_count:
+            raise ValueError('The partition must be between 0 and partition_count - 1')
+        if speedup <= 0:
+            raise ValueError('speedup must be positive')
+
+        self.path = path
+        self.partition = partition
+        self.partition_count = partition_count
+        self.speedup = float(speedup)
+        self.max_gap_sec = max_gap_sec
+        self.loop = loop
+        self.replayed_count = 0
+        self._rows = self._open()
+        self._previous_time = None
+        self._offset = 0.0
+
+    @classmethod
+    def from_config(cls, load_pattern, path, partition=0, partition_count=1):
+        return cls(path,
+                   partition=partition,
+                   partition_count=partition_count,
+                   speedup=load_pattern.get('speedup', DEFAULT_SPEEDUP),
+                   max_gap_sec=load_pattern.get('max_gap_sec'),
+                   loop=load_pattern.get('loop', False))
+
+    def _open(self):
+        return read_request_log(self.path, self.partition, self.partition_count)
+
+    def next(self):
+        """
+        Returns the next (offset, signature, body) tuple, where the offset is
+        the time in seconds since the start of the replay, or None if the
+        log is exhausted.
+        """
+        row = next(self._rows, None)
+        if row is None and self.loop and self.replayed_count:
+            # Replay the log again right after its last request
+            self._rows = self._open()
+            self._previous_time = None
+            row = next(self._rows, None)
+        if row is None:
+            return None
+
+        timestamp, signature, body = row
+        if self._previous_time is not None:
+            gap = max(timestamp - self._previous_time, 0) / self.speedup
+            if self.max_gap_sec is not None:
+                gap = min(gap, self.max_gap_sec)
+            self._offset += gap
+        self._previous_time = timestamp
+        self.replayed_count += 1
+        return self._offset, signature, body
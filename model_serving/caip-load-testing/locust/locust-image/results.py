@@ -0,0 +1,101 @@
+# Copyright 2020 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+A compact columnar store of the time series of a test run.
+
+The master appends a row per model and signature at every logging interval.
+At the end of the test the columns are written as Parquet if pyarrow is
+installed, or otherwise as gzipped columnar JSON, i.e. a JSON object
+mapping each column name to the list of its values.
+"""
+
+import gzip
+import io
+import json
+
+
+COLUMNS = [
+    'timestamp',
+    'model',
+    'signature',
+    'user_count',
+    'rps',
+    'num_requests',
+    'num_failures',
+    'latency_p50',
+    'latency_p90',
+    'latency_p99',
+    'latency_p999',
+    'latency_max'
+]
+
+PARQUET_FORMAT = 'parquet'
+JSON_FORMAT = 'json.gz'
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def default_format():
+    return PARQUET_FORMAT if pyarrow else JSON_FORMAT
+
+
+class ResultsTable(object):
+    """
+    The columns of the time series of a test run.
+    """
+
+    def __init__(self, columns=None):
+        self.columns = columns or {name: [] for name in COLUMNS}
+
+    def __len__(self):
+        return len(self.columns['timestamp'])
+
+    def append(self, row):
+        """
+        Appends a row. Missing values, e.g. the latency of an interval
+        without successful requests, are stored as nulls.
+        """
+        for name, values in self.columns.items():
+            values.append(row.get(name))
+
+    def rows(self):
+        names = list(self.columns)
+        for values in zip(*[self.columns[name] for name in names]):
+            yield dict(zip(names, values))
+
+    def to_bytes(self, format=None):
+        format = format or default_format()
+        if format == PARQUET_FORMAT:
+            stream = io.BytesIO()
+            pyarrow.parquet.write_table(
+                pyarrow.Table.from_pydict(self.columns), stream, compression='snappy')
+            return stream.getvalue()
+        if format == JSON_FORMAT:
+            return gzip.compress(json.dumps(self.columns, separators=(',', ':')).encode('utf-8'))
+        raise ValueError('Unsupported results format: {}'.format(format))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Reads a results file in any of the supported formats.
+        """
+        if data[:2] == b'\x1f\x8b':
+            return cls(json.loads(gzip.decompress(data)))
+        if pyarrow is None:
+            raise ImportError('Reading Parquet results requires the pyarrow package')
+        return cls(pyarrow.parquet.read_table(io.BytesIO(data)).to_pydict())
@@ -22,10 +22,15 @@ import inspect
 import json
 import logging
 import os
-import random
+import re
+import socket
+import tempfile
+import threading
 import time
 
 import gevent
+import gevent.pool
+import requests
 
 from functools import partial
 from datetime import datetime
@@ -35,19 +40,32 @@ import google.auth
 import google.auth.transport.requests
 
 from google.cloud import storage
-from google.api_core.exceptions import GoogleAPICallError
-from google.api_core.exceptions import RetryError
 from google.auth.credentials import Credentials
 from google.auth.transport.requests import AuthorizedSession
-from google.cloud.logging_v2 import LoggingServiceV2Client
-from google.cloud.logging_v2.types import LogEntry
-from google.protobuf.timestamp_pb2 import Timestamp
-from google.protobuf.struct_pb2 import Struct
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 from locust import User, task, between, events
 from locust.runners import MasterRunner, WorkerRunner, LocalRunner
 from locust.runners import STATE_STOPPING, STATE_STOPPED, STATE_CLEANUP, STATE_RUNNING
 
+from backends import TFServingGRPCClient, model_version_fields
+from backends import DEFAULT_INPUT_NAME
+from batching import BatchSweep, batch_label
+from capacity import SaturationSearch
+from capacity import DEFAULT_STEP_DURATION_SEC, DEFAULT_WARMUP_SEC
+from exporters import MetricsExporter, create_sink
+from exporters import METRICS_SINK_ENV, DEFAULT_METRICS_SINK
+from gcs_cache import GCSCache
+from histograms import HistogramRegistry
+from load_patterns import ArrivalSchedule, BATCH_SWEEP, CAPACITY, REPLAY
+from load_patterns import DEFAULT_MAX_IN_FLIGHT, IDLE_INTERVAL_SEC
+from payloads import PayloadPool
+from replay import RequestLogReplay
+from results import ResultsTable
+from results import default_format as default_results_format
+
 
 LOG_STATS_INTERVAL_SEC = 5
 LOG_NAME = 'locust'
@@ -55,6 +73,92 @@ LOG_NAME = 'locust'
 TEST_BUCKET_ENV = 'LOCUST_TEST_BUCKET'
 TEST_DATA_ENV= 'LOCUST_TEST_DATA'
 TEST_CONFIG_ENV = 'LOCUST_TEST_CONFIG'
+TEST_REPORTS_ENV = 'LOCUST_TEST_REPORTS'
+POOL_SIZE_ENV = 'LOCUST_POOL_SIZE'
+HTTP2_ENV = 'LOCUST_HTTP2'
+AUTH_ENV = 'LOCUST_AUTH'
+CONFIG_PUSH_ENV = 'LOCUST_CONFIG_PUSH'
+BACKEND_ENV = 'LOCUST_BACKEND'
+GRPC_INPUT_NAME_ENV = 'LOCUST_GRPC_INPUT_NAME'
+
+AIPP_BACKEND = 'aipp'
+TF_SERVING_REST_BACKEND = 'tf_serving_rest'
+TF_SERVING_GRPC_BACKEND = 'tf_serving_grpc'
+
+DEFAULT_POOL_SIZE = 100
+CONNECTION_REQUEST_TYPE = 'connection'
+POOL_WAIT_REQUEST_TYPE = 'pool_wait'
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Matches AI Platform Prediction error responses, e.g. {"error": "..."},
+# without parsing the whole, potentially large, response body.
+ERROR_RESPONSE_PATTERN = re.compile(rb'\s*\{\s*"error"\s*:')
+
+ARRIVAL_SHARE_MESSAGE = 'arrival_share'
+ARRIVAL_RATE_MESSAGE = 'arrival_rate'
+REPLAY_PARTITION_MESSAGE = 'replay_partition'
+TEST_CONFIG_MESSAGE = 'test_config'
+BATCH_SIZE_MESSAGE = 'batch_size'
+HISTOGRAMS_REPORT_KEY = 'latency_histograms'
+CONNECTION_HISTOGRAMS_REPORT_KEY = 'connection_histograms'
+DEFAULT_TEST_REPORTS = 'locust-test/reports'
+# Give the workers time to send their last stats reports before the
+# end-of-test report is written. Workers report every 3 seconds.
+FINAL_REPORT_DELAY_SEC = 5
+
+# High resolution latency histograms in microseconds. On the workers
+# they hold the latencies recorded since the last report to the master.
+# On the master they hold the merged latencies of the whole test and of the
+# current logging interval respectively.
+latency_histograms = HistogramRegistry()
+interval_histograms = HistogramRegistry()
+# The latencies of the current capacity test step on the master
+step_histograms = HistogramRegistry()
+# Registries the predict requests are recorded in by this process
+recording_histograms = [latency_histograms]
+# The connection setup times, kept apart from the Locust request stats so
+# that new connections do not count as requests. On the workers they hold
+# the times recorded since the last report to the master. On the master
+# they hold the merged times of the whole test and of the current logging
+# interval respectively.
+connection_histograms = HistogramRegistry()
+interval_connection_histograms = HistogramRegistry()
+# Registries the connection setup times are recorded in by this process
+recording_connection_histograms = [connection_histograms]
+
+# The background exporter of the test metrics, started on the master
+metrics_exporter = None
+# The time series of the test run, written to the reports location at the end
+results_table = ResultsTable()
+
+# The fraction of the total open-loop arrival rate generated by this process
+arrival_share = 1.0
+# The total arrival rate set by the capacity test controller.
+# If set, it overrides the scheduled arrival rate.
+target_arrival_rate = None
+# The (index, count) partition of the request log replayed by this process,
+# or None if the master did not assign a partition to this worker
+replay_partition = (0, 1)
+# The batch size set by the batch sweep controller. If set, the test
+# data instances are re-packed into requests of this size.
+target_batch_size = None
+# The test config read by the master at the test start
+test_config = None
+# The greenlet of the capacity test or the batch sweep controller
+load_controller = None
+# The test config pushed by the master to the workers
+pushed_test_config = None
+# The test start time and the summary of the test ramp-up on the master
+test_start_time = None
+test_summary = {}
+
+# The test config and the test data are downloaded once per process
+gcs_cache = GCSCache()
+
+# Connection setup time and connection pool wait time accumulated by the
+# current greenlet. Locust monkey patches threading, so the storage is
+# greenlet local.
+_connection_setup = threading.local()
 
 
 def greenlet_exception_handler():
@@ -71,7 +175,7 @@ def greenlet_exception_handler():
 
 def log_stats(environment):
     """
-    Logs current test stats to Cloud Logging.
+    Queues current test stats for export to the metrics sink.
     
     This function is executed as a greenlet.
     """
@@ -79,11 +183,7 @@ def log_stats(environment):
     global test_id
     test_id = None
     
-    logging.info('Entering the Cloud Logging logger greenlet')
-    
-    creds, project_id = google.auth.default()
-    client = LoggingServiceV2Client(credentials=creds)
-    project_path = client.project_path(project_id)
+    logging.info('Entering the metrics logger greenlet')
     
     while True:
         gevent.sleep(LOG_STATS_INTERVAL_SEC)
@@ -91,15 +191,12 @@ def log_stats(environment):
         if not environment.runner.state in [STATE_RUNNING] or not test_id:
             continue
             
-        log_path = client.log_path(project_id, LOG_NAME)             
-        timestamp = Timestamp()
-        timestamp.FromDatetime(datetime.now())   
-        log_entries = []
+        timestamp = datetime.utcnow()
+        records = []
         for key in sorted(environment.stats.entries.keys()):
             
             r = environment.stats.entries[key]
-            payload = Struct()
-            payload.update({
+            payload = {
                 'test_id': test_id,
                 'signature': r.name,
                 'model': r.method,
@@ -107,26 +204,41 @@ def log_stats(environment):
                 'user_count': environment.runner.user_count,
                 'num_requests': environment.runner.stats.total.num_requests,
                 'num_failures': environment.runner.stats.total.num_failures,
+            }
+            # Add the full latency spectrum over the logging interval
+            payload.update({
+                'latency_{}'.format(name): value 
+                for name, value in interval_histograms.percentiles(r.method, r.name).items()
+                if name != 'count'
             })
             
-            log_entry = LogEntry(
-                log_name=log_path,
-                resource={'type': 'global'},
-                timestamp=timestamp,
-                json_payload=payload
-            )
-            log_entries.append(log_entry)
+            records.append({'timestamp': timestamp, 'payload': payload})
+            
+            results_table.append(dict(
+                payload,
+                timestamp=(timestamp - datetime(1970, 1, 1)).total_seconds(),
+                rps=r.current_rps,
+                num_requests=r.num_requests,
+                num_failures=r.num_failures))
+        interval_histograms.reset()
+
+        # Export the connection setup times of the interval separately
+        for model, signature in sorted(interval_connection_histograms.histograms):
+            payload = {
+                'test_id': test_id,
+                'signature': signature,
+                'model': model,
+                'user_count': environment.runner.user_count
+            }
+            payload.update({
+                'latency_{}'.format(name): value
+                for name, value in interval_connection_histograms.percentiles(
+                    model, signature).items()
+            })
+            records.append({'timestamp': timestamp, 'payload': payload})
+        interval_connection_histograms.reset()
   
-        if log_entries:
-            try:
-                response = client.write_log_entries(
-                    entries=log_entries)
-            except GoogleAPICallError as e: 
-                logging.error('GoogleAPICallError: %s', e.message)
-            except RetryError:
-                logging.error('RetryError')
-            except:
-                logging.error('Unknow exception')
+        metrics_exporter.submit(records)
                                        
     
 @events.init.add_listener
@@ -138,38 +250,567 @@ def on_locust_init(environment, **kwargs):
     # Start the Cloud Logging greenlet on the master 
     if isinstance(environment.runner, MasterRunner):
         logging.info("Starting the master pod.")
+        global metrics_exporter
+        metrics_exporter = MetricsExporter(create_sink(
+            os.getenv(METRICS_SINK_ENV, DEFAULT_METRICS_SINK), LOG_NAME))
+        metrics_exporter.start().link_exception(greenlet_exception_handler())
         gevent.spawn(log_stats, 
                 environment).link_exception(greenlet_exception_handler())
-        logging.info("Spawned the Cloud Monitoring logger.")
+        logging.info("Spawned the metrics logger.")
+        environment.events.worker_report.add_listener(on_worker_report)
+
+    # Ship the latency histograms to the master with the stats reports
+    if isinstance(environment.runner, WorkerRunner):
+        environment.events.report_to_master.add_listener(on_report_to_master)
+
+    # Receive the worker's share of the open-loop arrival rate 
+    # and the capacity test arrival rate from the master
+    if isinstance(environment.runner, WorkerRunner):
+        environment.runner.register_message(
+            ARRIVAL_SHARE_MESSAGE, on_arrival_share)
+        environment.runner.register_message(
+            ARRIVAL_RATE_MESSAGE, on_arrival_rate)
+        environment.runner.register_message(
+            REPLAY_PARTITION_MESSAGE, on_replay_partition)
+        environment.runner.register_message(
+            TEST_CONFIG_MESSAGE, on_test_config)
+        environment.runner.register_message(
+            BATCH_SIZE_MESSAGE, on_batch_size)
+
+    # Measure the time it takes to spawn all users
+    if not isinstance(environment.runner, WorkerRunner):
+        environment.events.spawning_complete.add_listener(on_spawning_complete)
+
+    # Without workers the latencies are recorded directly in all registries
+    if isinstance(environment.runner, LocalRunner):
+        recording_histograms.extend([interval_histograms, step_histograms])
+        recording_connection_histograms.append(interval_connection_histograms)
             
+
+def on_report_to_master(client_id, data, **kwargs):
+    data[HISTOGRAMS_REPORT_KEY] = latency_histograms.serialize()
+    latency_histograms.reset()
+    data[CONNECTION_HISTOGRAMS_REPORT_KEY] = connection_histograms.serialize()
+    connection_histograms.reset()
+
+
+def on_worker_report(client_id, data, **kwargs):
+    if HISTOGRAMS_REPORT_KEY in data:
+        latency_histograms.merge_serialized(data[HISTOGRAMS_REPORT_KEY])
+        interval_histograms.merge_serialized(data[HISTOGRAMS_REPORT_KEY])
+        step_histograms.merge_serialized(data[HISTOGRAMS_REPORT_KEY])
+    if CONNECTION_HISTOGRAMS_REPORT_KEY in data:
+        connection_histograms.merge_serialized(data[CONNECTION_HISTOGRAMS_REPORT_KEY])
+        interval_connection_histograms.merge_serialized(
+            data[CONNECTION_HISTOGRAMS_REPORT_KEY])
+
+
+def on_arrival_share(environment, msg, **kwargs):
+    global arrival_share
+    arrival_share = msg.data
+    logging.info("Setting the arrival rate share to: {}".format(arrival_share))
+
+
+def on_arrival_rate(environment, msg, **kwargs):
+    global target_arrival_rate
+    target_arrival_rate = msg.data
+    logging.info("Setting the target arrival rate to: {}".format(target_arrival_rate))
+
+
+def on_test_config(environment, msg, **kwargs):
+    global pushed_test_config
+    pushed_test_config = msg.data
+    logging.info("Received the test config: {}".format(pushed_test_config['test_id']))
+
+
+def on_spawning_complete(user_count, **kwargs):
+    if test_start_time and 'time_to_full_user_count_sec' not in test_summary:
+        test_summary['user_count'] = user_count
+        test_summary['time_to_full_user_count_sec'] = round(time.time() - test_start_time, 3)
+        logging.info("Spawned {} users in {} seconds".format(
+            user_count, test_summary['time_to_full_user_count_sec']))
+
+
+def load_test_config(max_age_sec=None):
+    """
+    Returns the test config pushed by the master or reads it from GCS.
+    """
+    if pushed_test_config:
+        return pushed_test_config
+    return json.loads(gcs_cache.get(
+        os.getenv(TEST_BUCKET_ENV), os.getenv(TEST_CONFIG_ENV), max_age_sec))
+
+
+def on_replay_partition(environment, msg, **kwargs):
+    global replay_partition
+    partition = msg.data['partitions'].get(environment.runner.client_id)
+    if partition is None:
+        # The worker was not connected when the partitions were assigned,
+        # e.g. it joined late, so the log is replayed by the other workers
+        replay_partition = None
+        logging.warning("No request log partition was assigned to this worker, "
+                        "it will not replay requests")
+        return
+    replay_partition = (partition, msg.data['count'])
+    logging.info("Replaying the request log partition: {} of {}".format(*replay_partition))
+
+
+def send_replay_partitions(environment):
+    """
+    Assigns a partition of the request log to each worker.
+    """
+    runner = environment.runner
+    client_ids = sorted(client.id for client in 
+                        runner.clients.ready + runner.clients.running + runner.clients.spawning)
+    runner.send_message(REPLAY_PARTITION_MESSAGE, {
+        'partitions': {client_id: index for index, client_id in enumerate(client_ids)},
+        'count': len(client_ids)
+    })
+
+
+def set_arrival_rate(environment, rate):
+    """
+    Sets the total arrival rate of the test on this process and the workers.
+    """
+    global target_arrival_rate
+    target_arrival_rate = rate
+    if isinstance(environment.runner, MasterRunner):
+        environment.runner.send_message(ARRIVAL_RATE_MESSAGE, rate)
+
+
+def on_batch_size(environment, msg, **kwargs):
+    global target_batch_size
+    target_batch_size = msg.data
+    logging.info("Setting the batch size to: {}".format(target_batch_size))
+
+
+def set_batch_size(environment, batch_size):
+    """
+    Sets the request batch size on this process and the workers.
+    """
+    global target_batch_size
+    target_batch_size = batch_size
+    if isinstance(environment.runner, MasterRunner):
+        environment.runner.send_message(BATCH_SIZE_MESSAGE, batch_size)
+
+
+def _predict_request_counts(stats):
+    """
+    Returns the total number of predict requests and failures.
+    """
+    return stats.total.num_requests, stats.total.num_failures
+
+
+def run_capacity_test(environment, load_pattern, test_id):
+    """
+    Finds the maximum arrival rate that meets the latency SLO.
+    
+    The controller steps the arrival rate of the open-loop users, measures
+    the p99 latency and the error rate of each step, and uploads
+    a capacity report when the search completes. The test is then stopped.
+
+    This function is executed as a greenlet on the master.
+    """
+    
+    search = SaturationSearch.from_config(load_pattern)
+    warmup = load_pattern.get('warmup_sec', DEFAULT_WARMUP_SEC)
+    step_duration = load_pattern.get('step_duration_sec', DEFAULT_STEP_DURATION_SEC)
+    
+    rate = search.next_rate()
+    while rate is not None:
+        set_arrival_rate(environment, rate)
+        gevent.sleep(warmup)
+        
+        step = measure_step(environment, step_duration)
+        p99_ms = step['histogram'].value_at_percentile(0.99) / 1000.0
+        num_requests = step['num_requests']
+        error_rate = float(step['num_failures']) / num_requests if num_requests else 1.0
+        passed = search.report(rate, p99_ms, error_rate, 
+                               achieved_rate=num_requests / step['duration'])
+        logging.info("Capacity test step: rate={}, p99={:.1f}ms, error_rate={:.4f}, passed={}".format(
+            rate, p99_ms, error_rate, passed))
+        rate = search.next_rate()
+    
+    report = search.to_report(
+        test_id=test_id, 
+        model=test_config['model'], 
+        version=test_config['version'])
+    logging.info("Maximum sustainable arrival rate: {}".format(report['max_sustainable_rate']))
+    upload_test_report(test_id, 'capacity.json', report)
+    environment.runner.stop()
+
+
+def run_batch_sweep(environment, load_pattern, test_id):
+    """
+    Measures the latency and the throughput in instances per second
+    of each configured request batch size.
+    
+    The controller sets the batch size of the users step by step and 
+    uploads a batching report when all batch sizes are measured.
+    The test is then stopped.
+
+    This function is executed as a greenlet on the master.
+    """
+    
+    sweep = BatchSweep.from_config(load_pattern)
+    warmup = load_pattern.get('warmup_sec', DEFAULT_WARMUP_SEC)
+    step_duration = load_pattern.get('step_duration_sec', DEFAULT_STEP_DURATION_SEC)
+    
+    for batch_size in sweep.batch_sizes:
+        set_batch_size(environment, batch_size)
+        gevent.sleep(warmup)
+        
+        step = measure_step(environment, step_duration)
+        summary = sweep.report(
+            batch_size, 
+            duration=step['duration'], 
+            num_requests=step['num_requests'], 
+            num_failures=step['num_failures'],
+            p50_ms=step['histogram'].value_at_percentile(0.5) / 1000.0,
+            p99_ms=step['histogram'].value_at_percentile(0.99) / 1000.0)
+        logging.info("Batch sweep step: batch_size={}, instances/sec={:.1f}, p99={:.1f}ms".format(
+            batch_size, summary['instances_per_sec'], summary['p99_ms']))
+    
+    report = sweep.to_report(
+        test_id=test_id, 
+        model=test_config['model'], 
+        version=test_config['version'])
+    logging.info("Batch size with the highest throughput: {}".format(report['best_batch_size']))
+    upload_test_report(test_id, 'batching.json', report)
+    environment.runner.stop()
+
+
+def measure_step(environment, duration):
+    """
+    Waits for the duration of a load controller step and returns the 
+    number of predict requests and failures and the merged latency 
+    histogram of the step.
+    """
+    
+    step_histograms.reset()
+    start_requests, start_failures = _predict_request_counts(environment.runner.stats)
+    start_time = time.time()
+    gevent.sleep(duration)
+    num_requests, num_failures = _predict_request_counts(environment.runner.stats)
+    return {
+        'duration': time.time() - start_time,
+        'num_requests': num_requests - start_requests,
+        'num_failures': num_failures - start_failures,
+        'histogram': step_histograms.combined()
+    }
+
         
 @events.test_start.add_listener
-def on_test_start(**kwargs):
+def on_test_start(environment=None, **kwargs):
 
-    global test_id
+    global test_id, test_config, load_controller, test_start_time, test_summary, results_table
     
     # Read the test config file and set the test_id global variable
-    client = storage.Client()
-    bucket = client.get_bucket(os.getenv(TEST_BUCKET_ENV))
-    blob = storage.Blob(os.getenv(TEST_CONFIG_ENV), bucket)
-    test_id = json.loads(blob.download_as_string())['test_id']    
+    test_start_time = time.time()
+    test_summary = {}
+    test_config = load_test_config(max_age_sec=0)
+    test_id = test_config['test_id']    
+    latency_histograms.reset()
+    interval_histograms.reset()
+    connection_histograms.reset()
+    interval_connection_histograms.reset()
+    results_table = ResultsTable()
+
+    # Push the test config to the workers so they don't have to read it
+    if environment and isinstance(environment.runner, MasterRunner):
+        if _env_flag(CONFIG_PUSH_ENV, 'true'):
+            environment.runner.send_message(TEST_CONFIG_MESSAGE, test_config)
+
+    # Split the open-loop arrival rate evenly between the workers
+    if environment and isinstance(environment.runner, MasterRunner):
+        if environment.runner.worker_count:
+            environment.runner.send_message(
+                ARRIVAL_SHARE_MESSAGE, 1.0 / environment.runner.worker_count)
+            send_replay_partitions(environment)
+
+    # Start the capacity test or the batch sweep controller
+    if environment and not isinstance(environment.runner, WorkerRunner):
+        set_arrival_rate(environment, None)
+        set_batch_size(environment, None)
+        load_pattern = test_config.get('load_pattern', {})
+        controllers = {CAPACITY: run_capacity_test, BATCH_SWEEP: run_batch_sweep}
+        if load_pattern.get('mode') in controllers:
+            load_controller = gevent.spawn(
+                controllers[load_pattern['mode']], environment, load_pattern, test_id)
+            load_controller.link_exception(greenlet_exception_handler())
     
     
 @events.test_stop.add_listener
-def on_test_stop(**kwargs):
-    global test_id
+def on_test_stop(environment=None, **kwargs):
+    global test_id, load_controller
+    if load_controller is not None:
+        if load_controller is not gevent.getcurrent():
+            load_controller.kill(block=False)
+        load_controller = None
+    if test_id and environment and not isinstance(environment.runner, WorkerRunner):
+        delay = FINAL_REPORT_DELAY_SEC if isinstance(environment.runner, MasterRunner) else 0
+        gevent.spawn_later(delay, write_test_report, 
+                           test_id).link_exception(greenlet_exception_handler())
     test_id = None
 
+    # Export the records queued during the last flush interval of the test
+    if metrics_exporter is not None:
+        gevent.spawn(metrics_exporter.flush).link_exception(greenlet_exception_handler())
+
+
+@events.quitting.add_listener
+def on_quitting(environment=None, **kwargs):
+    # The exporter greenlet dies with the master, so flush it first
+    if metrics_exporter is not None:
+        metrics_exporter.stop(flush=True)
+
+
+def upload_test_file(test_id, file_name, data, content_type):
+    """
+    Uploads a file to the test reports location in GCS.
+    """
+    
+    client = storage.Client()
+    bucket = client.get_bucket(os.getenv(TEST_BUCKET_ENV))
+    blob_name = '{}/{}/{}'.format(
+        os.getenv(TEST_REPORTS_ENV, DEFAULT_TEST_REPORTS), test_id, file_name)
+    storage.Blob(blob_name, bucket).upload_from_string(data, content_type=content_type)
+    logging.info("Uploaded the test report to: gs://{}/{}".format(bucket.name, blob_name))
+
+
+def upload_test_report(test_id, report_name, report):
+    """
+    Uploads a JSON test report to the test reports location in GCS.
+    """
+    
+    upload_test_file(test_id, report_name, json.dumps(report, indent=2), 'application/json')
+
+
+def write_test_report(test_id):
+    """
+    Uploads the end-of-test latency report and the results 
+    time series to GCS.
+    """
+    
+    report = {
+        'test_id': test_id,
+        'summary': test_summary,
+        'latency_unit': 'ms',
+        'latency': latency_histograms.report(),
+        'connection_setup': connection_histograms.report()
+    }
+    upload_test_report(test_id, 'latency.json', report)
+    
+    if len(results_table):
+        results_format = default_results_format()
+        upload_test_file(test_id, 'results.{}'.format(results_format), 
+                         results_table.to_bytes(results_format), 'application/octet-stream')
+
+
+def _record_connection_setup(duration):
+    """Adds a connection setup duration to the current greenlet's total."""
+    _connection_setup.duration = getattr(_connection_setup, 'duration', 0) + duration
+
+
+def _record_pool_wait(duration):
+    """Adds a connection pool wait to the current greenlet's total."""
+    _connection_setup.pool_wait = getattr(_connection_setup, 'pool_wait', 0) + duration
+
+
+def _record_connection_time(model_deployment_name, request_type, duration):
+    if duration:
+        for histograms in recording_connection_histograms:
+            histograms.record(model_deployment_name, request_type, duration * 1e6)
+
+
+def record_connection_setup_time(model_deployment_name, setup_time):
+    """
+    Records the time in seconds a request spent establishing new connections.
+    """
+    _record_connection_time(model_deployment_name, CONNECTION_REQUEST_TYPE, setup_time)
+
+
+def record_pool_wait_time(model_deployment_name, wait_time):
+    """
+    Records the time in seconds a request waited for a free pooled connection.
+    """
+    _record_connection_time(model_deployment_name, POOL_WAIT_REQUEST_TYPE, wait_time)
+
+
+def pop_connection_setup_time():
+    """
+    Returns and resets the time in seconds the current greenlet spent
+    establishing new connections.
+    """
+    duration = getattr(_connection_setup, 'duration', 0)
+    _connection_setup.duration = 0
+    return duration
+
+
+def pop_pool_wait_time():
+    """
+    Returns and resets the time in seconds the current greenlet waited
+    for free connections of the pool.
+    """
+    duration = getattr(_connection_setup, 'pool_wait', 0)
+    _connection_setup.pool_wait = 0
+    return duration
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """An HTTP connection that records the time spent connecting."""
+
+    def connect(self):
+        start_time = time.time()
+        super(TimedHTTPConnection, self).connect()
+        _record_connection_setup(time.time() - start_time)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """An HTTPS connection that records the time spent on the TCP and TLS handshakes."""
+
+    def connect(self):
+        start_time = time.time()
+        super(TimedHTTPSConnection, self).connect()
+        _record_connection_setup(time.time() - start_time)
+
+
+class PoolWaitTimer(object):
+    """A connection pool mixin that records the time spent waiting for a free connection."""
+
+    def _get_conn(self, timeout=None):
+        start_time = time.time()
+        try:
+            return super(PoolWaitTimer, self)._get_conn(timeout)
+        finally:
+            _record_pool_wait(time.time() - start_time)
+
+
+class TimedHTTPConnectionPool(PoolWaitTimer, HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(PoolWaitTimer, HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    A transport adapter with a fixed size pool of persistent connections.
+
+    The pool blocks when all connections are in use instead of opening
+    throw-away connections, so connections are reused across requests.
+    The time a request waits for a free connection is recorded as the
+    pool wait time and excluded from its latency.
+    """
+
+    def __init__(self, pool_size):
+        super(KeepAliveAdapter, self).__init__(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super(KeepAliveAdapter, self).init_poolmanager(
+            connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+
+class HTTP2Session(object):
+    """
+    A minimal authorized HTTP/2 session built on httpx.
+
+    Requests are multiplexed over a small number of connections. Connection
+    setup time is captured with the httpcore trace extension, until the TLS
+    handshake completes or, for plain HTTP, until the TCP connection does.
+    """
+
+    def __init__(self, credentials, pool_size):
+        import httpx
+
+        self._credentials = credentials
+        self._auth_request = google.auth.transport.requests.Request()
+        self._lock = threading.Lock()
+        self._client = httpx.Client(
+            http2=True,
+            timeout=None,
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size))
+
+    def _trace(self, event_name, info, tls):
+        if event_name == 'connection.connect_tcp.started':
+            _connection_setup.started = time.time()
+        elif event_name in ('connection.start_tls.complete',
+                            'connection.connect_tcp.failed',
+                            'connection.start_tls.failed') or (
+                                event_name == 'connection.connect_tcp.complete' and not tls):
+            _record_connection_setup(time.time() - _connection_setup.started)
+
+    def post(self, url, data, headers=None):
+        headers = dict(headers or {})
+        if self._credentials:
+            with self._lock:
+                if not self._credentials.valid:
+                    self._credentials.refresh(self._auth_request)
+                self._credentials.apply(headers)
+        return self._client.post(
+            url, content=data, headers=headers,
+            extensions={'trace': partial(self._trace, tls=url.startswith('https://'))})
+
+
+def _env_flag(name, default):
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes')
+
+
+def create_session(pool_size=None, http2=None, auth=None):
+    """
+    Creates an authorized session with a pool of persistent connections.
+
+    The pool size, the HTTP/2 mode and the authentication default to the
+    values of the LOCUST_POOL_SIZE, LOCUST_HTTP2 and LOCUST_AUTH environment
+    variables. Authentication can be disabled to test against a local server.
+    """
+    if pool_size is None:
+        pool_size = int(os.getenv(POOL_SIZE_ENV, DEFAULT_POOL_SIZE))
+    if http2 is None:
+        http2 = _env_flag(HTTP2_ENV, 'false')
+    if auth is None:
+        auth = _env_flag(AUTH_ENV, 'true')
+
+    credentials = google.auth.default()[0] if auth else None
+    if http2:
+        logging.info("Using HTTP/2 with {} connections".format(pool_size))
+        return HTTP2Session(credentials, pool_size)
+
+    logging.info("Using HTTP/1.1 with {} persistent connections".format(pool_size))
+    session = AuthorizedSession(credentials) if auth else requests.Session()
+    adapter = KeepAliveAdapter(pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 
 class AIPPClient(object):
     """
     A convenience wrapper around AI Platform Prediction REST API.
+
+    All clients in a worker process share one session, so the size
+    of the connection pool is controlled per worker.
     """
-    
+
+    _session = None
+    _session_lock = threading.Lock()
+
     def __init__(self, service_endpoint):
         logging.info("Setting the AIPP service endpoint: {}".format(service_endpoint))
-        credentials, _ = google.auth.default()
-        self._authed_session = AuthorizedSession(credentials)
+        with AIPPClient._session_lock:
+            if AIPPClient._session is None:
+                AIPPClient._session = create_session()
+        self._authed_session = AIPPClient._session
         self._service_endpoint = service_endpoint
     
     def predict(self, project_id, model, version, signature, instances):
@@ -177,15 +818,74 @@ class AIPPClient(object):
         Invokes the predict method on the specified signature.
         """
         
-        url = '{}/v1/projects/{}/models/{}/versions/{}:predict'.format(self._service_endpoint, project_id, model, version)    
-            
-        request_body = {
-            'signature_name': signature,
-            'instances': instances
-        }
+        return self.predict_encoded(
+            project_id, model, version, encode_request_body(signature, instances))
+
+    def predict_encoded(self, project_id, model, version, body):
+        """
+        Invokes the predict method with a pre-serialized JSON request body.
+        """
+
+        url = self.predict_url(project_id, model, version)
     
-        response = self._authed_session.post(url, data=json.dumps(request_body))
+        response = self._authed_session.post(url, data=body, headers=JSON_HEADERS)
         return response
+
+    def predict_url(self, project_id, model, version):
+        return '{}/v1/projects/{}/models/{}/versions/{}:predict'.format(self._service_endpoint, project_id, model, version)    
+
+
+class TFServingRESTClient(AIPPClient):
+    """
+    A client of the TensorFlow Serving REST API.
+    
+    The predict requests use the same JSON format as AI Platform Prediction.
+    Numeric versions select a model version, anything else a version label.
+    """
+    
+    def predict_url(self, project_id, model, version):
+        fields = model_version_fields(version)
+        if 'version' in fields:
+            return '{}/v1/models/{}/versions/{}:predict'.format(self._service_endpoint, model, fields['version'])
+        return '{}/v1/models/{}/labels/{}:predict'.format(self._service_endpoint, model, fields['version_label'])
+
+
+def create_client(service_endpoint, backend=None):
+    """
+    Creates a client of the target backend set by the LOCUST_BACKEND 
+    environment variable: aipp (default), tf_serving_rest or tf_serving_grpc.
+    """
+    backend = backend or os.getenv(BACKEND_ENV, AIPP_BACKEND)
+    if backend == AIPP_BACKEND:
+        return AIPPClient(service_endpoint)
+    if backend == TF_SERVING_REST_BACKEND:
+        return TFServingRESTClient(service_endpoint)
+    if backend == TF_SERVING_GRPC_BACKEND:
+        return TFServingGRPCClient(
+            service_endpoint, input_name=os.getenv(GRPC_INPUT_NAME_ENV, DEFAULT_INPUT_NAME))
+    raise ValueError('Unsupported backend: {}'.format(backend))
+
+
+def encode_request_body(signature, instances):
+    """
+    Serializes a predict request body to compact JSON bytes.
+    """
+    
+    request_body = {
+        'signature_name': signature,
+        'instances': instances
+    }
+    
+    return json.dumps(request_body, separators=(',', ':')).encode('utf-8')
+
+
+def is_error_response(response):
+    """
+    Checks if a predict response reports an error without decoding it.
+    """
+
+    return (response.status_code >= 400 or 
+            ERROR_RESPONSE_PATTERN.match(response.content, 0, 64) is not None)
  
 
 def predict_task(
@@ -194,24 +894,39 @@ def predict_task(
         model:str, 
         version:str, 
         signature:str,
-        instances: dict):
+        body: bytes,
+        intended_time: float=None):
     """
-    Calls a predict method on AIPP endpoint and tracks
-    the response latency and status with Locust.
+    Calls a predict method on AIPP endpoint with a pre-serialized
+    request body and tracks the response latency and status with Locust.
+
+    If the intended send time is given the latency is measured from it
+    rather than from the actual send time.
     """
 
-    start_time = time.time()
+    # Convert the body to the request format of the client, if it has its
+    # own, before the request is timed
+    prepare_request = getattr(user.client, 'prepare_request', None)
+    if prepare_request:
+        body = prepare_request(model, version, body)
+
+    start_time = intended_time or time.time()
     model_deployment_name = '{}-{}'.format(model,version)
+    pop_connection_setup_time()
+    pop_pool_wait_time()
     try:
-        response = user.client.predict(
+        response = user.client.predict_encoded(
             project_id=project_id,
             model=model,
             version=version,
-            signature=signature,
-            instances=instances
+            body=body
         )
     except Exception as e:
-        total_time = int((time.time() - start_time) * 1000)
+        setup_time = pop_connection_setup_time()
+        wait_time = pop_pool_wait_time()
+        record_connection_setup_time(model_deployment_name, setup_time)
+        record_pool_wait_time(model_deployment_name, wait_time)
+        total_time = int((time.time() - start_time - setup_time - wait_time) * 1000)
         events.request_failure.fire(
                 request_type=model_deployment_name,
                 name=signature,
@@ -219,62 +934,295 @@ def predict_task(
                 response_length=0,
                 exception=e)
     else:
-        total_time = int((time.time() - start_time) * 1000)
-        if 'error' in response.json():
+        # Report the connection setup and the wait for a pooled connection
+        # separately from the server latency
+        setup_time = pop_connection_setup_time()
+        wait_time = pop_pool_wait_time()
+        latency = time.time() - start_time - setup_time - wait_time
+        total_time = int(latency * 1000)
+        record_connection_setup_time(model_deployment_name, setup_time)
+        record_pool_wait_time(model_deployment_name, wait_time)
+        if is_error_response(response):
             events.request_failure.fire(
                     request_type=model_deployment_name,
                     name=signature,
                     response_time=total_time,
-                    response_length=len(response.text),
+                    response_length=len(response.content),
                     exception=response.text)
         else:
+            for histograms in recording_histograms:
+                histograms.record(model_deployment_name, signature, latency * 1e6)
             events.request_success.fire(
                     request_type=model_deployment_name,
                     name=signature,
                     response_time=total_time,
-                    response_length = len(response.text))
+                    response_length = len(response.content))
+
+
+def sampled_predict_task(
+        user:object, 
+        project_id:str, 
+        model:str, 
+        version:str, 
+        payload_pool:PayloadPool):
+    """
+    Calls a predict method with a request sampled from the payload pool.
+    """
+
+    name, body = sample_request(payload_pool)
+    predict_task(user, 
+                 project_id=project_id,
+                 model=model,
+                 version=version,
+                 signature=name,
+                 body=body)
+
+
+def sample_request(payload_pool:PayloadPool):
+    """
+    Samples a request body and returns it with the name it is tracked under.
+    
+    During a batch sweep the request is re-packed to the current batch size
+    and tracked separately for each batch size.
+    """
+    
+    batch_size = target_batch_size
+    signature, body = payload_pool.sample(batch_size=batch_size)
+    if batch_size is not None:
+        return batch_label(signature, batch_size), body
+    return signature, body
+
+
+def open_loop_task(
+        user:object, 
+        schedule:ArrivalSchedule,
+        schedule_start:float,
+        project_id:str, 
+        model:str, 
+        version:str, 
+        payload_pool:PayloadPool):
+    """
+    Generates requests at the scheduled arrival rate regardless of the
+    response times.
+
+    The task never returns. Each user generates an equal part of the
+    process's share of the arrival rate, so the total rate adapts as users
+    are spawned. Requests are sent from a bounded pool of greenlets. If the
+    pool is exhausted, sends are delayed but their latency is still measured
+    from the intended send time.
+    """
+
+    pool = gevent.pool.Pool(schedule.max_in_flight)
+    intended_time = time.time()
+    try:
+        while True:
+            share = arrival_share / max(user.environment.runner.user_count, 1)
+            interval = schedule.next_interval(
+                intended_time - schedule_start, share, rate=target_arrival_rate)
+            if interval is None:
+                intended_time = max(intended_time, time.time()) + IDLE_INTERVAL_SEC
+                gevent.sleep(IDLE_INTERVAL_SEC)
+                continue
+
+            intended_time += interval
+            delay = intended_time - time.time()
+            if delay > 0:
+                gevent.sleep(delay)
+
+            name, body = sample_request(payload_pool)
+            pool.spawn(predict_task, user, 
+                       project_id=project_id,
+                       model=model,
+                       version=version,
+                       signature=name,
+                       body=body,
+                       intended_time=intended_time)
+    finally:
+        pool.kill(block=False)
        
         
+def replay_task(
+        user:object, 
+        replay:RequestLogReplay,
+        replay_start:float,
+        project_id:str, 
+        model:str, 
+        version:str, 
+        max_in_flight:int):
+    """
+    Sends logged requests at their replay offsets.
+
+    The replay stream is shared by all users of the process. Every user
+    takes the next logged request, waits until it is due and sends it from
+    a bounded pool of greenlets. The latency is measured from the intended
+    send time. Once the log is exhausted the users idle.
+    """
+
+    pool = gevent.pool.Pool(max_in_flight)
+    try:
+        while True:
+            request = replay.next()
+            if request is None:
+                gevent.sleep(IDLE_INTERVAL_SEC)
+                continue
+
+            offset, signature, body = request
+            intended_time = replay_start + offset
+            delay = intended_time - time.time()
+            if delay > 0:
+                gevent.sleep(delay)
+
+            pool.spawn(predict_task, user, 
+                       project_id=project_id,
+                       model=model,
+                       version=version,
+                       signature=signature,
+                       body=body,
+                       intended_time=intended_time)
+    finally:
+        pool.kill(block=False)
+
+
+def idle_task(user:object):
+    """
+    Keeps a user that has no requests to send idle.
+    """
+
+    while True:
+        gevent.sleep(IDLE_INTERVAL_SEC)
+
+
+def open_request_log(source):
+    """
+    Returns a local path of a request log. Logs in GCS are downloaded
+    to a temporary file, so they can be streamed from the local disk.
+    """
+    if not source.startswith('gs://'):
+        return source
+    
+    bucket_name, blob_name = source[len('gs://'):].split('/', 1)
+    client = storage.Client()
+    local_file = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+    local_file.close()
+    storage.Blob(blob_name, client.get_bucket(bucket_name)).download_to_filename(local_file.name)
+    logging.info("Downloaded the request log {} to {}".format(source, local_file.name))
+    return local_file.name
+
+
 class AIPPUser(User):
     """
     A class simulating calls to AI Platform Prediction.
     """
     
     wait_time = between(1, 2)
-    test_data = None
+    payload_pool = None
+    replay = None
+    # The request log downloaded to a temporary file for the replay
+    request_log_file = None
     test_config = None
+    schedule_start = None
+    _load_lock = threading.Lock()
+    # The number of started users sharing the test data
+    _user_count = 0
     
     def __init__(self, *args, **kwargs):
         super(AIPPUser, self).__init__(*args, **kwargs) 
-        self.client = AIPPClient(self.environment.host)
+        self.client = create_client(self.environment.host)
+
+    @classmethod
+    def load_test_data(cls):
+        """
+        Loads the test config and the test data shared by all users.
+        Users spawned concurrently wait for the first one to load them.
+        """
+        with cls._load_lock:
+            if cls.test_config:
+                cls._user_count += 1
+                return
+            
+            test_config = load_test_config()
+            load_pattern = test_config.get('load_pattern', {})
+            if load_pattern.get('mode') == REPLAY and replay_partition is None:
+                logging.warning("Not replaying the request log on this worker")
+            elif load_pattern.get('mode') == REPLAY:
+                # Stream the logged requests instead of the test data
+                partition, partition_count = replay_partition
+                path = open_request_log(load_pattern['source'])
+                if path != load_pattern['source']:
+                    cls.request_log_file = path
+                cls.replay = RequestLogReplay.from_config(
+                    load_pattern, path, partition, partition_count)
+            else:
+                # Serialize the instances once and share them across all users.
+                # The test data is streamed from its local copy.
+                with gcs_cache.open(os.getenv(TEST_BUCKET_ENV), os.getenv(TEST_DATA_ENV)) as f:
+                    cls.payload_pool = PayloadPool.from_config(f, test_config)
+                logging.info("Loaded {} bytes of test instances".format(
+                    cls.payload_pool.size_bytes))
+            cls.test_config = test_config
+            cls.schedule_start = time.time()
+            cls._user_count += 1
 
     def on_start(self):
-        if not AIPPUser.test_data:
-            bucket = os.getenv(TEST_BUCKET_ENV)
-            config_blob = os.getenv(TEST_CONFIG_ENV)
-            test_data_blob = os.getenv(TEST_DATA_ENV)
-            client = storage.Client()
-            bucket = client.get_bucket(bucket)
-            blob = storage.Blob(config_blob, bucket)
-            AIPPUser.test_config = json.loads(blob.download_as_string())
-            blob = storage.Blob(test_data_blob, bucket)
-            AIPPUser.test_data = json.loads(blob.download_as_string())
+        AIPPUser.load_test_data()
         
-        self.tasks.clear()
-        for test_instance in AIPPUser.test_data:          
-            task = partial(predict_task,
+        schedule = ArrivalSchedule.from_config(AIPPUser.test_config)
+        load_pattern = AIPPUser.test_config.get('load_pattern', {})
+        if load_pattern.get('mode') == REPLAY and not AIPPUser.replay:
+            task = idle_task
+        elif AIPPUser.replay:
+            task = partial(replay_task,
+                            replay=AIPPUser.replay,
+                            replay_start=AIPPUser.schedule_start,
                             project_id=AIPPUser.test_config['project_id'],
                             model=AIPPUser.test_config['model'],
                             version=AIPPUser.test_config['version'],
-                            signature=test_instance['signature'],
-                            instances=test_instance['instances']
+                            max_in_flight=AIPPUser.test_config['load_pattern'].get(
+                                'max_in_flight', DEFAULT_MAX_IN_FLIGHT)
                             )
-                
-            self.tasks.append(task)
+        elif schedule:
+            task = partial(open_loop_task,
+                            schedule=schedule,
+                            schedule_start=AIPPUser.schedule_start,
+                            project_id=AIPPUser.test_config['project_id'],
+                            model=AIPPUser.test_config['model'],
+                            version=AIPPUser.test_config['version'],
+                            payload_pool=AIPPUser.payload_pool
+                            )
+        else:
+            task = partial(sampled_predict_task,
+                            project_id=AIPPUser.test_config['project_id'],
+                            model=AIPPUser.test_config['model'],
+                            version=AIPPUser.test_config['version'],
+                            payload_pool=AIPPUser.payload_pool
+                            )
+        
+        # A single task per user instead of one task per test data entry
+        self.tasks = [task]
+
+    @classmethod
+    def release_test_data(cls):
+        """
+        Releases the test data shared by the users when the last user stops.
+        The users stopped while others keep running, e.g. when the user
+        count is lowered, do not reset the shared replay position.
+        """
+        with cls._load_lock:
+            cls._user_count = max(cls._user_count - 1, 0)
+            if cls._user_count:
+                return
+            if cls.payload_pool:
+                cls.payload_pool.close()
+            if cls.request_log_file:
+                try:
+                    os.remove(cls.request_log_file)
+                except FileNotFoundError:
+                    pass
+            cls.payload_pool = None
+            cls.replay = None
+            cls.request_log_file = None
+            cls.test_config = None
 
     def on_stop(self):
-        AIPPUser.test_data = None
-        AIPPUser.test_config = None
-        self.tasks.clear()
-                    
-            
+        self.tasks = []
+        AIPPUser.release_test_data()
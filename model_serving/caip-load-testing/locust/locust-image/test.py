@@ -14,13 +14,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import csv
+import datetime
+import http.server
+import io
+import json
+import os
+import random
+import threading
+import time
+import types
+
+import gevent
 import pytest
+import requests
 
 from locust.env import Environment
 from locust import User, task, between, events
 
 import tasks
 from tasks import AIPPUser, on_test_start, on_test_stop
+from tasks import KeepAliveAdapter, pop_connection_setup_time
+from tasks import encode_request_body, is_error_response
+from tasks import create_client, TFServingRESTClient
+from backends import TFServingGRPCClient, instances_to_inputs
+from batching import BatchSweep, batch_label
+from capacity import SaturationSearch, find_max_sustainable_rate
+from compare import compare, main as compare_main, summarize
+from exporters import JsonlSink, MetricsExporter
+from gcs_cache import GCSCache
+from histograms import HistogramRegistry, LatencyHistogram
+from load_patterns import ArrivalSchedule
+from mock_server import start_mock_server
+from payloads import AliasTable, PayloadPool, iter_json_array
+from replay import RequestLogReplay, parse_log_time
+from results import ResultsTable
 
 LOCUST_TEST_BUCKET=''
 LOCUST_TEST_DATA='test-config/test-payload.json'
@@ -28,10 +57,33 @@ LOCUST_TEST_CONFIG='test-config/test-config.json'
 
 @pytest.fixture(autouse=True)
 def env_setup(monkeypatch):
-    monkeypatch.setenv('LOCUST_TEST_BUCKET')
+    monkeypatch.setenv('LOCUST_TEST_BUCKET', LOCUST_TEST_BUCKET)
     monkeypatch.setenv('LOCUST_TEST_DATA', 'locust-test/test-payload.json')
     monkeypatch.setenv('LOCUST_TEST_CONFIG', 'locust-test/test-config.json')
 
+@pytest.fixture
+def predict_server():
+
+    class PredictHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            body = b'{"predictions": [[0.1, 0.9]]}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('localhost', 0), PredictHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://localhost:{}'.format(server.server_port)
+    server.shutdown()
+
 @pytest.fixture
 def environment():
     
@@ -58,4 +110,646 @@ def test_on_test_start():
     on_test_stop()
     on_test_start()
     on_test_stop()
-    
\ No newline at end of file
+
+
+def test_keep_alive_adapter_reuses_connections(predict_server):
+    session = requests.Session()
+    session.mount('http://', KeepAliveAdapter(pool_size=2))
+    
+    pop_connection_setup_time()
+    session.post(predict_server + '/v1/projects/p/models/m/versions/v:predict', data='{}')
+    assert pop_connection_setup_time() > 0
+    
+    for _ in range(10):
+        session.post(predict_server + '/v1/projects/p/models/m/versions/v:predict', data='{}')
+    assert pop_connection_setup_time() == 0
+
+
+def test_connection_setup_is_not_a_request(monkeypatch):
+
+    class Response(object):
+        status_code = 200
+        content = b'{"predictions": []}'
+
+    class Client(object):
+        def predict_encoded(self, **kwargs):
+            tasks._record_connection_setup(0.01)
+            tasks._record_pool_wait(0.02)
+            return Response()
+
+    class FakeUser(object):
+        client = Client()
+
+    fired = []
+    def on_request_success(request_type, response_time, **kwargs):
+        fired.append(request_type)
+        assert response_time < 10
+
+    connection_histograms = HistogramRegistry()
+    monkeypatch.setattr(tasks, 'recording_histograms', [HistogramRegistry()])
+    monkeypatch.setattr(tasks, 'recording_connection_histograms', [connection_histograms])
+    events.request_success.add_listener(on_request_success)
+    try:
+        tasks.predict_task(FakeUser(), project_id='p', model='m', version='v',
+                           signature='serving_default', body=b'{}')
+    finally:
+        events.request_success.remove_listener(on_request_success)
+
+    assert fired == ['m-v']
+    assert connection_histograms.percentiles('m-v', 'connection')['count'] == 1
+    assert connection_histograms.percentiles('m-v', 'pool_wait')['count'] == 1
+
+
+def test_keep_alive_adapter_times_pool_wait():
+    
+    server = start_mock_server(replicas=2, service_time_ms=100,
+                               service_time_distribution='constant')
+    session = requests.Session()
+    session.mount('http://', KeepAliveAdapter(pool_size=1))
+    url = server.url + '/v1/projects/p/models/m/versions/v:predict'
+    body = encode_request_body('serving_default', [[1.0]])
+    
+    def send():
+        tasks.pop_pool_wait_time()
+        session.post(url, data=body)
+        return tasks.pop_pool_wait_time()
+    
+    try:
+        send()
+        # The second request waits for the single connection
+        waits = sorted(greenlet.get() for greenlet in
+                       [gevent.spawn(send), gevent.spawn(send)])
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert waits[0] < 0.05 and waits[1] >= 0.08
+
+
+def test_http2_session_times_plain_connections(predict_server):
+    
+    session = tasks.HTTP2Session(None, pool_size=1)
+    pop_connection_setup_time()
+    session.post(predict_server + '/v1/projects/p/models/m/versions/v:predict', data=b'{}')
+    assert pop_connection_setup_time() > 0
+    session.post(predict_server + '/v1/projects/p/models/m/versions/v:predict', data=b'{}')
+    assert pop_connection_setup_time() == 0
+
+
+def test_error_response_detection():
+    
+    class Response(object):
+        def __init__(self, content, status_code=200):
+            self.content = content
+            self.status_code = status_code
+    
+    assert is_error_response(Response(b'{"error": "Prediction failed"}'))
+    assert is_error_response(Response(b' {\n  "error" : "Bad request"}'))
+    assert is_error_response(Response(b'{"predictions": []}', status_code=503))
+    assert not is_error_response(Response(b'{"predictions": [{"error": 0.1}]}'))
+    assert encode_request_body('serving_default', [[1, 2]]) == (
+        b'{"signature_name":"serving_default","instances":[[1,2]]}')
+
+
+def test_arrival_schedule():
+    
+    assert ArrivalSchedule.from_config({'test_id': 'closed-loop'}) is None
+    
+    schedule = ArrivalSchedule.from_config({
+        'load_pattern': {
+            'mode': 'open',
+            'arrival_process': 'constant',
+            'stages': [
+                {'duration': 10, 'rate': 0},
+                {'duration': 10, 'rate': 10, 'end_rate': 30},
+                {'duration': 10, 'rate': 40}
+            ]
+        }
+    })
+    
+    assert schedule.duration == 30
+    assert schedule.next_interval(5) is None
+    assert schedule.rate_at(15) == pytest.approx(20)
+    assert schedule.rate_at(100) == 40
+    assert schedule.next_interval(25, share=0.25) == pytest.approx(0.1)
+    
+    schedule.arrival_process = 'poisson'
+    intervals = [schedule.next_interval(25) for _ in range(10000)]
+    assert sum(intervals) / len(intervals) == pytest.approx(1 / 40, rel=0.1)
+
+
+def test_latency_histogram_precision():
+    
+    histogram = LatencyHistogram(significant_figures=3)
+    for value in range(1, 100001):
+        histogram.record(value)
+    
+    assert histogram.total_count == 100000
+    assert histogram.value_at_percentile(0.5) == pytest.approx(50000, rel=1e-3)
+    assert histogram.value_at_percentile(0.999) == pytest.approx(99900, rel=1e-3)
+    assert histogram.value_at_percentile(1.0) == 100000
+    
+
+def test_histogram_registry_merge():
+    
+    worker1 = HistogramRegistry()
+    worker2 = HistogramRegistry()
+    for value in range(1000):
+        worker1.record('model-v1', 'serving_default', value)
+        worker2.record('model-v1', 'serving_default', value + 1000)
+    worker2.record('model-v1', 'serving_preprocess', 5000)
+    
+    master = HistogramRegistry()
+    master.merge_serialized(worker1.serialize())
+    master.merge_serialized(worker2.serialize())
+    
+    spectrum = master.percentiles('model-v1', 'serving_default', scale=1)
+    assert spectrum['count'] == 2000
+    assert spectrum['p50'] == pytest.approx(1000, rel=1e-3)
+    assert spectrum['max'] == 1999
+    assert len(master.report()) == 2
+
+
+def _metrics_record(signature, num_requests):
+    return {
+        'timestamp': datetime.datetime(2020, 9, 1, 12, 0, 0),
+        'payload': {'test_id': 'test-1', 'model': 'model-v1', 'signature': signature,
+                    'num_requests': num_requests}
+    }
+
+
+def test_metrics_exporter_batches_to_jsonl(tmp_path):
+    
+    path = tmp_path / 'metrics.jsonl'
+    exporter = MetricsExporter(JsonlSink(str(path)), max_batch_size=2)
+    exporter.submit([_metrics_record('serving_default', n) for n in range(5)])
+    exporter.flush()
+    
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line['num_requests'] for line in lines] == list(range(5))
+    assert lines[0]['timestamp'] == '2020-09-01T12:00:00'
+    assert exporter.exported_count == 5 and len(exporter) == 0
+    
+
+def test_metrics_exporter_backpressure():
+    
+    class FailingSink(object):
+        def write(self, records):
+            raise IOError('Backend unavailable')
+    
+    exporter = MetricsExporter(FailingSink(), max_queue_size=3)
+    exporter.submit([_metrics_record('serving_default', 1),
+                     _metrics_record('serving_preprocess', 1),
+                     _metrics_record('serving_default', 2),
+                     _metrics_record('serving_default', 3)])
+    
+    # The oldest record of the same series is superseded by the new one
+    assert len(exporter) == 3 and exporter.dropped_count == 1
+    assert [r['payload']['num_requests'] for r in exporter._queue] == [1, 2, 3]
+    assert exporter._queue[0]['payload']['signature'] == 'serving_preprocess'
+    
+    exporter.flush()
+    assert len(exporter) == 3 and exporter.exported_count == 0
+
+
+def test_metrics_exporter_drops_oldest_interval_record():
+    
+    class FailingSink(object):
+        def write(self, records):
+            raise IOError('Backend unavailable')
+    
+    def interval_record(signature, num_requests):
+        record = _metrics_record(signature, num_requests)
+        record['payload']['latency_p99'] = 10.0 * num_requests
+        return record
+    
+    exporter = MetricsExporter(FailingSink(), max_queue_size=3)
+    exporter.submit([interval_record('serving_default', 1),
+                     interval_record('serving_preprocess', 1),
+                     interval_record('serving_default', 2),
+                     interval_record('serving_default', 3)])
+    
+    # The latency percentiles are per interval, so no record supersedes
+    # another one and the oldest is dropped
+    assert len(exporter) == 3 and exporter.dropped_count == 1
+    assert [(r['payload']['signature'], r['payload']['num_requests'])
+            for r in exporter._queue] == [
+                ('serving_preprocess', 1), ('serving_default', 2), ('serving_default', 3)]
+
+
+def test_metrics_exporter_flushed_on_quitting(monkeypatch):
+    
+    class ListSink(object):
+        def __init__(self):
+            self.records = []
+            
+        def write(self, records):
+            self.records.extend(records)
+    
+    sink = ListSink()
+    exporter = MetricsExporter(sink, flush_interval=3600)
+    monkeypatch.setattr(tasks, 'metrics_exporter', exporter)
+    exporter.start()
+    exporter.submit([_metrics_record('serving_default', n) for n in range(3)])
+    
+    events.quitting.fire(environment=None, reverse=True)
+    assert [r['payload']['num_requests'] for r in sink.records] == [0, 1, 2]
+    assert exporter.exported_count == 3 and len(exporter) == 0
+    assert exporter._greenlet is None
+
+
+def test_saturation_search():
+    
+    # An M/M/1-like endpoint with a capacity of 400 requests/sec
+    def measure(rate):
+        if rate >= 400:
+            return float('inf'), 0.5
+        return 10.0 / (1 - rate / 400.0), 0.0
+    
+    search = SaturationSearch(slo_p99_ms=100, min_rate=10, max_rate=1000, tolerance=0.02)
+    max_rate = find_max_sustainable_rate(search, measure)
+    
+    # The SLO is violated above 360 requests/sec
+    assert 360 * 0.98 <= max_rate <= 360
+    assert [step['target_rate'] for step in search.steps[:6]] == [10, 20, 40, 80, 160, 320]
+    report = search.to_report(model='model', version='v1')
+    assert report['saturated'] and report['max_sustainable_rate'] == max_rate
+    
+    # Even the minimum rate fails
+    search = SaturationSearch(slo_p99_ms=5, min_rate=10, max_rate=1000)
+    assert find_max_sustainable_rate(search, measure) is None
+    assert len(search.steps) == 1
+    
+    
+def test_mock_server_saturates():
+    
+    server = start_mock_server(replicas=2, service_time_ms=50, 
+                               service_time_distribution='constant', max_queue_ms=80)
+    try:
+        body = encode_request_body('serving_default', [[1.0]])
+        
+        def send():
+            response = requests.post(server.url + '/v1/projects/p/models/m/versions/v:predict', data=body)
+            results.append(response.status_code)
+        
+        results = []
+        send()
+        assert results == [200]
+        
+        # Pause the server by holding all replicas, so that the requests
+        # time out in the queue
+        for _ in range(server.replica_count):
+            server.replicas.acquire()
+        results = []
+        send()
+        send()
+        assert results == [503, 503]
+
+        for _ in range(server.replica_count):
+            server.replicas.release()
+        results = []
+        send()
+        assert results == [200]
+        assert server.request_count == 4 and server.rejected_count == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_capacity_test_finds_mock_server_knee(monkeypatch):
+    
+    # A capacity of 2 replicas / 20ms = 100 requests/sec
+    server = start_mock_server(replicas=2, service_time_ms=20,
+                               service_time_distribution='constant', max_queue_ms=100)
+    test_config = {
+        'test_id': 'capacity-test',
+        'project_id': 'p',
+        'model': 'm',
+        'version': 'v',
+        'load_pattern': {
+            'mode': 'capacity',
+            'arrival_process': 'constant',
+            'slo_p99_ms': 60,
+            'min_rate': 20,
+            'max_rate': 400,
+            'tolerance': 0.1,
+            'warmup_sec': 0.5,
+            'step_duration_sec': 1.5
+        }
+    }
+    test_data = json.dumps([{'signature': 'serving_default', 'instances': [[1.0]]}])
+    
+    class FakeGCSCache(object):
+        def open(self, bucket_name, blob_name):
+            return io.BytesIO(test_data.encode('utf-8'))
+    
+    reports = {}
+    monkeypatch.setenv('LOCUST_AUTH', 'false')
+    monkeypatch.setattr(tasks, 'pushed_test_config', test_config)
+    monkeypatch.setattr(tasks, 'gcs_cache', FakeGCSCache())
+    monkeypatch.setattr(tasks, 'upload_test_report',
+                        lambda test_id, name, report: reports.update({name: report}))
+    monkeypatch.setattr(tasks, 'write_test_report', lambda test_id: None)
+    monkeypatch.setattr(tasks, 'recording_histograms', [
+        tasks.latency_histograms, tasks.interval_histograms, tasks.step_histograms])
+    monkeypatch.setattr(tasks, 'target_arrival_rate', None)
+    monkeypatch.setattr(tasks.AIPPClient, '_session', None)
+    monkeypatch.setattr(AIPPUser, 'test_config', None)
+    monkeypatch.setattr(AIPPUser, '_user_count', 0)
+    
+    environment = Environment(user_classes=[AIPPUser], events=events, host=server.url)
+    runner = environment.create_local_runner()
+    try:
+        runner.start(4, spawn_rate=100)
+        deadline = time.time() + 120
+        while 'capacity.json' not in reports and time.time() < deadline:
+            gevent.sleep(0.5)
+    finally:
+        runner.quit()
+        server.shutdown()
+        server.server_close()
+    
+    report = reports['capacity.json']
+    assert report['saturated']
+    assert 0.75 * server.capacity_rps <= report['max_sustainable_rate'] <= 1.1 * server.capacity_rps
+    assert report['first_failing_rate'] <= 1.6 * server.capacity_rps
+    assert server.request_count > 0
+
+
+def test_payload_pool_sampling():
+    
+    rng = random.Random(42)
+    table = AliasTable([1, 0, 3])
+    counts = collections.Counter(table.sample(rng) for _ in range(40000))
+    assert counts[1] == 0
+    assert abs(counts[2] / counts[0] - 3) < 0.15
+    
+    test_data = [
+        {'signature': 'serving_preprocess', 'instances': [{'b64': 'aaa'}]},
+        {'signature': 'serving_default', 'instances': [[1.0, 2.0], [3.0, 4.0]]},
+        {'signature': 'serving_preprocess', 'instances': [{'b64': 'bbb'}, {'b64': 'ccc'}]}
+    ]
+    
+    # Replays the test data requests as they are, decoding the JSON
+    # array entry by entry
+    pool = PayloadPool.from_config(json.dumps(test_data, indent=1).encode('utf-8'), {})
+    bodies = {pool.sample(rng)[1] for _ in range(200)}
+    assert bodies == {encode_request_body(entry['signature'], entry['instances']) 
+                      for entry in test_data}
+    pool.close()
+    
+    # Streams the JSON array from a file in chunks, which split the
+    # numbers and the multi-byte characters
+    data = json.dumps([123456, 'caf\u00e9', {'a': [1.5, 2]}, 78], ensure_ascii=False)
+    for chunk_size in [1, 2, 3, 1 << 20]:
+        assert list(iter_json_array(io.BytesIO(data.encode('utf-8')), chunk_size)) == [
+            123456, 'caf\u00e9', {'a': [1.5, 2]}, 78]
+    pool = PayloadPool.from_config(io.BytesIO(json.dumps(test_data).encode('utf-8')), {})
+    assert {pool.sample(rng)[1] for _ in range(200)} == bodies
+    pool.close()
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.BytesIO(b'[{"signature": '), chunk_size=4))
+    assert list(iter_json_array(b' [ ] ')) == []
+    with pytest.raises(ValueError):
+        list(iter_json_array(b'{"signature": "serving_default"}'))
+    
+    # Samples the instances with the configured batch size and signature
+    pool = PayloadPool.from_config(test_data, {'payload_mix': {
+        'signature_weights': {'serving_preprocess': 1},
+        'batch_sizes': {'4': 1}}})
+    for _ in range(20):
+        signature, body = pool.sample(rng)
+        request = json.loads(body)
+        assert signature == request['signature_name'] == 'serving_preprocess'
+        assert len(request['instances']) == 4
+        assert all(instance['b64'] in ('aaa', 'bbb', 'ccc') for instance in request['instances'])
+    pool.close()
+
+
+def test_test_data_released_by_last_user(monkeypatch):
+
+    pool = PayloadPool([{'signature': 'serving_default', 'instances': [[1.0]]}])
+    monkeypatch.setattr(AIPPUser, 'payload_pool', pool)
+    monkeypatch.setattr(AIPPUser, 'test_config', {'test_id': 'test-1'})
+    monkeypatch.setattr(AIPPUser, '_user_count', 2)
+
+    AIPPUser.release_test_data()
+    assert AIPPUser.payload_pool is pool
+    assert pool.sample()[0] == 'serving_default'
+
+    AIPPUser.release_test_data()
+    assert AIPPUser.payload_pool is None and AIPPUser.test_config is None
+    assert pool._buffer.closed
+
+
+def test_replay_partition_of_late_worker(monkeypatch, tmp_path):
+
+    class Message(object):
+        data = {'partitions': {'worker-1': 0, 'worker-2': 1}, 'count': 2}
+
+    class Runner(object):
+        client_id = 'worker-3'
+
+    class Env(object):
+        runner = Runner()
+
+    monkeypatch.setattr(tasks, 'replay_partition', (0, 1))
+    tasks.on_replay_partition(Env(), Message())
+    assert tasks.replay_partition is None
+
+    Runner.client_id = 'worker-2'
+    tasks.on_replay_partition(Env(), Message())
+    assert tasks.replay_partition == (1, 2)
+
+    # The downloaded request log is removed when the last user stops
+    request_log_file = tmp_path / 'requests.csv'
+    request_log_file.write_text('')
+    monkeypatch.setattr(AIPPUser, 'request_log_file', str(request_log_file))
+    monkeypatch.setattr(AIPPUser, '_user_count', 1)
+    AIPPUser.release_test_data()
+    assert not request_log_file.exists() and AIPPUser.request_log_file is None
+
+
+def test_request_log_replay(tmp_path):
+    
+    path = tmp_path / 'bq_prediction_logs.csv'
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['model', 'model_version', 'time', 'raw_data', 'raw_prediction', 'groundtruth'])
+        for second in [0, 10, 20, 30, 1000, 1010]:
+            raw_data = json.dumps({'signature_name': 'serving_default', 'instances': [{'Elevation': [second]}]})
+            writer.writerow(['covertype_classifier', 'v1', 
+                             '2020-06-03 10:{:02d}:{:02d} UTC'.format(second // 60, second % 60), 
+                             raw_data, '', ''])
+    
+    assert parse_log_time('2020-06-03 10:30:00 UTC') - parse_log_time('2020-06-03 10:29:59.5 UTC') == 0.5
+    
+    replay = RequestLogReplay(str(path), speedup=10, max_gap_sec=5)
+    requests = [replay.next() for _ in range(6)]
+    assert [offset for offset, _, _ in requests] == [0, 1, 2, 3, 8, 9]
+    assert requests[1][1] == 'serving_default'
+    assert json.loads(requests[1][2])['instances'] == [{'Elevation': [10]}]
+    assert replay.next() is None
+    
+    # The rows are partitioned round-robin and the partition is replayed in a loop
+    replay = RequestLogReplay(str(path), partition=1, partition_count=2, loop=True)
+    requests = [replay.next() for _ in range(4)]
+    assert [json.loads(body)['instances'][0]['Elevation'][0] for _, _, body in requests] == [10, 30, 1010, 10]
+    assert [offset for offset, _, _ in requests] == [0, 20, 1000, 1000]
+
+
+def test_gcs_cache_validates_etags():
+    
+    class FakeBlob(object):
+        def __init__(self, content, etag):
+            self.content, self.etag = content, etag
+            
+        def download_to_filename(self, path):
+            with open(path, 'wb') as f:
+                f.write(self.content)
+    
+    class FakeClient(object):
+        blobs = {'config.json': FakeBlob(b'{"test_id": "test-1"}', 'etag-1')}
+        metadata_requests = 0
+        
+        def bucket(self, bucket_name):
+            return self
+            
+        def get_blob(self, blob_name):
+            FakeClient.metadata_requests += 1
+            return self.blobs.get(blob_name)
+    
+    cache = GCSCache(client=FakeClient(), max_age_sec=60)
+    assert cache.get('bucket', 'config.json') == b'{"test_id": "test-1"}'
+    
+    # Served from the cache without any requests within the max age
+    assert cache.get('bucket', 'config.json') == b'{"test_id": "test-1"}'
+    assert FakeClient.metadata_requests == 1 and cache.download_count == 1
+    
+    # Revalidated but not downloaded if the ETag did not change
+    assert cache.get('bucket', 'config.json', max_age_sec=0) == b'{"test_id": "test-1"}'
+    assert FakeClient.metadata_requests == 2 and cache.download_count == 1
+    
+    # Only the ETag and the path of the local copy are kept in memory
+    first_path = cache.get_path('bucket', 'config.json')
+    assert cache._entries[('bucket', 'config.json')][::2] == ('etag-1', first_path)
+    
+    FakeClient.blobs['config.json'] = FakeBlob(b'{"test_id": "test-2"}', 'etag-2')
+    with cache.open('bucket', 'config.json', max_age_sec=0) as f:
+        assert f.read() == b'{"test_id": "test-2"}'
+    assert cache.download_count == 2 and not os.path.exists(first_path)
+    
+    path = cache.get_path('bucket', 'config.json')
+    cache.clear()
+    assert not os.path.exists(path)
+    
+    with pytest.raises(FileNotFoundError):
+        cache.get('bucket', 'missing.json')
+
+
+def test_batch_sweep():
+    
+    sweep = BatchSweep([1, 8, 32])
+    sweep.report(1, duration=10, num_requests=1000, num_failures=0, p50_ms=10, p99_ms=20)
+    sweep.report(8, duration=10, num_requests=500, num_failures=0, p50_ms=20, p99_ms=40)
+    step = sweep.report(32, duration=10, num_requests=120, num_failures=20, p50_ms=80, p99_ms=200)
+    
+    assert step['instances_per_sec'] == 320 and step['error_rate'] == 20 / 120
+    assert sweep.best_batch_size == 8
+    assert sweep.to_report(model='model')['steps'][1]['instances_per_sec'] == 400
+    assert batch_label('serving_default', 8) == 'serving_default[batch=8]'
+    
+    pool = PayloadPool([{'signature': 'serving_default', 'instances': [[1.0], [2.0]]}])
+    signature, body = pool.sample(batch_size=5)
+    assert len(json.loads(body)['instances']) == 5
+
+
+def _results_table(rps, latency_p99, num_failures=0):
+    table = ResultsTable()
+    for interval in range(10):
+        table.append({'timestamp': 1600000000 + 5 * interval, 'model': 'model-v1', 
+                      'signature': 'serving_default', 'user_count': 10, 'rps': rps, 
+                      'num_requests': 100 * (interval + 1), 'num_failures': num_failures,
+                      'latency_p50': latency_p99 / 2, 'latency_p99': latency_p99})
+    return table
+
+
+@pytest.mark.parametrize('results_format', ['json.gz', 'parquet'])
+def test_results_table_round_trip(results_format):
+    
+    if results_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    table = _results_table(rps=50.0, latency_p99=120.0)
+    restored = ResultsTable.from_bytes(table.to_bytes(results_format))
+    assert len(restored) == 10
+    assert list(restored.rows())[3] == list(table.rows())[3]
+    assert restored.columns['latency_p90'] == [None] * 10
+
+
+def test_compare_flags_regressions(tmp_path):
+    
+    baseline = summarize(_results_table(rps=50.0, latency_p99=120.0))
+    assert baseline['serving_default']['throughput'] == 50.0
+    
+    _, regressions = compare(baseline, summarize(_results_table(rps=49.0, latency_p99=125.0)))
+    assert regressions == []
+    
+    _, regressions = compare(baseline, summarize(_results_table(rps=40.0, latency_p99=150.0, num_failures=50)))
+    assert [regression.split(':')[1].split()[0] for regression in regressions] == [
+        'throughput', 'latency_p50', 'latency_p99', 'error_rate']
+    
+    baseline_path, candidate_path = tmp_path / 'baseline.json.gz', tmp_path / 'candidate.json.gz'
+    baseline_path.write_bytes(_results_table(rps=50.0, latency_p99=120.0).to_bytes('json.gz'))
+    candidate_path.write_bytes(_results_table(rps=40.0, latency_p99=120.0).to_bytes('json.gz'))
+    assert compare_main([str(baseline_path), str(baseline_path)]) == 0
+    assert compare_main([str(baseline_path), str(candidate_path)]) == 1
+    assert compare_main([str(baseline_path), str(candidate_path), '--max_throughput_drop', '0.3']) == 0
+
+
+def test_tf_serving_backends(monkeypatch):
+    
+    monkeypatch.setenv('LOCUST_AUTH', 'false')
+    server = start_mock_server(service_time_ms=1)
+    try:
+        client = create_client(server.url, backend='tf_serving_rest')
+        assert isinstance(client, TFServingRESTClient)
+        assert client.predict_url('project', 'model', '3') == server.url + '/v1/models/model/versions/3:predict'
+        assert client.predict_url('project', 'model', 'stable') == server.url + '/v1/models/model/labels/stable:predict'
+        response = client.predict('project', 'model', '3', 'serving_default', [[1.0], [2.0]])
+        assert not is_error_response(response)
+        assert json.loads(response.content)['predictions'] == [[1.0], [1.0]]
+    finally:
+        server.shutdown()
+        server.server_close()
+    
+    # The converted gRPC requests are cached per model, version and body
+    class Tensor(object):
+        def CopyFrom(self, values):
+            self.values = values
+
+    class PredictRequest(object):
+        def __init__(self):
+            self.model_spec = types.SimpleNamespace(
+                name=None, signature_name=None, version_label=None,
+                version=types.SimpleNamespace(value=None))
+            self.inputs = collections.defaultdict(Tensor)
+
+    grpc_client = object.__new__(TFServingGRPCClient)
+    grpc_client._predict_pb2 = types.SimpleNamespace(PredictRequest=PredictRequest)
+    grpc_client._make_tensor_proto = lambda values: values
+    grpc_client.input_name = 'inputs'
+    monkeypatch.setattr(TFServingGRPCClient, '_requests', collections.OrderedDict())
+    body = encode_request_body('serving_default', [[1.0]])
+    request = grpc_client.prepare_request('model', '1', body)
+    assert grpc_client.prepare_request('model', '1', body) is request
+    other_request = grpc_client.prepare_request('other', '2', body)
+    assert other_request.model_spec.name == 'other'
+    assert other_request.model_spec.version.value == 2
+    assert request.model_spec.name == 'model'
+    assert request.inputs['inputs'].values == [[1.0]]
+
+    # The JSON instances are converted to gRPC inputs like TF Serving REST does
+    assert instances_to_inputs([[1.0, 2.0], [3.0, 4.0]]) == {'inputs': [[1.0, 2.0], [3.0, 4.0]]}
+    assert instances_to_inputs([{'b64': 'AQI='}], 'image_bytes') == {'image_bytes': [b'\x01\x02']}
+    assert instances_to_inputs([{'Elevation': [2758], 'Soil_Type': ['4744']},
+                                {'Elevation': [3477], 'Soil_Type': ['8776']}]) == {
+        'Elevation': [[2758], [3477]], 'Soil_Type': [['4744'], ['8776']]}
@@ -20,6 +20,26 @@ import logging
 
 from handlers import run_log_analyzer
 from handlers import schedule_log_analyzer
+from tracker import JobLedger
+from tracker import get_log_analyzer_job_status
+from tracker import wait_for_log_analyzer_jobs
+
+
+DEFAULT_LEDGER = 'log_analyzer_jobs.db'
+
+
+def _print_jobs(jobs):
+    """Prints a summary line for each ledger row."""
+
+    for job in jobs:
+        duration = job['duration_sec']
+        vcpu_hours = job['vcpu_hours']
+        print('{} {} duration={} vcpu_hours={} anomalies={}'.format(
+            job['job_id'],
+            job['current_state'],
+            '{:.0f}s'.format(duration) if duration is not None else 'N/A',
+            '{:.3f}'.format(vcpu_hours) if vcpu_hours is not None else 'N/A',
+            job['anomalies_count'] if job['anomalies_count'] is not None else 'N/A'))
 
 
 @click.group()
@@ -39,8 +59,9 @@ def cli():
 @click.option('--schema',  envvar='DM_SCHEMA', help='A GCS location of the schema file', required=True)
 @click.option('--baseline_stats', envvar='DM_STATS', help='A GCS location of the baseline stats file')
 @click.option('--time_window', envvar='DM_TIME_WINDOW', help='A time window for slice calculations')
+@click.option('--ledger', envvar='DM_LEDGER', help='A local SQLite ledger to record the run in', default=DEFAULT_LEDGER)
 def run(template_path, model, version, project, region, log_table, start_time,
-    end_time, output, schema, baseline_stats, time_window):
+    end_time, output, schema, baseline_stats, time_window, ledger):
 
     response = run_log_analyzer(
         project_id=project,
@@ -59,6 +80,17 @@ def run(template_path, model, version, project, region, log_table, start_time,
     print("Submitted a log analyzer template run: DataFlow Job ID={}".format(
         response['job']['id'])) 
 
+    JobLedger(ledger).record_launch(
+        job_id=response['job']['id'],
+        job_name=response['job']['name'],
+        project_id=project,
+        region=region,
+        output_location=response['output_location'],
+        model=model,
+        version=version,
+        start_time=start_time.isoformat(sep='T', timespec='seconds'),
+        end_time=end_time.isoformat(sep='T', timespec='seconds'))
+
 @cli.command()
 @click.option('--template_path', envvar='DM_TEMPLATE_PATH', help='A GCS path to the log analyzer flex template', required=True)
 @click.option('--execute_time', envvar='DM_EXECUTE_TIME', help='The log analyzer template will be triggered at this time', required=True, type=click.DateTime())
@@ -98,5 +130,42 @@ def schedule(template_path, model, version, queue, account, execute_time, projec
 
     print("Scheduled the log analyzer template to run at: {}".format( execute_time)) 
 
+@cli.command()
+@click.option('--project', envvar='DM_PROJECT_ID', help='A GCP project ID', required=True)
+@click.option('--region', envvar='DM_REGION', help='A GCP region', required=True)
+@click.option('--job_id', help='A DataFlow job ID. Defaults to all active jobs in the ledger', multiple=True)
+@click.option('--ledger', envvar='DM_LEDGER', help='A local SQLite ledger of log analyzer runs', default=DEFAULT_LEDGER)
+def status(project, region, job_id, ledger):
+
+    job_ledger = JobLedger(ledger)
+    job_ids = job_id or [job['job_id'] for job in job_ledger.list_jobs(active_only=True)]
+    for job_id in job_ids:
+        job_ledger.record_status(
+            job_id, get_log_analyzer_job_status(project, region, job_id))
+
+    _print_jobs([job_ledger.get_job(job_id) for job_id in job_ids])
+
+@cli.command()
+@click.option('--project', envvar='DM_PROJECT_ID', help='A GCP project ID', required=True)
+@click.option('--region', envvar='DM_REGION', help='A GCP region', required=True)
+@click.option('--job_id', help='A DataFlow job ID. Defaults to all active jobs in the ledger', multiple=True)
+@click.option('--ledger', envvar='DM_LEDGER', help='A local SQLite ledger of log analyzer runs', default=DEFAULT_LEDGER)
+@click.option('--poll_interval', help='An initial polling interval in seconds', default=10, type=float)
+@click.option('--max_poll_interval', help='A maximum polling interval in seconds', default=300, type=float)
+@click.option('--timeout', help='Stop waiting after this many seconds', type=float)
+def wait(project, region, job_id, ledger, poll_interval, max_poll_interval, timeout):
+
+    jobs = wait_for_log_analyzer_jobs(
+        ledger=JobLedger(ledger),
+        project_id=project,
+        region=region,
+        job_ids=list(job_id) or None,
+        poll_interval=poll_interval,
+        max_poll_interval=max_poll_interval,
+        timeout=timeout
+    )
+
+    _print_jobs(jobs)
+
 if __name__ == '__main__':
     cli()
\ No newline at end of file
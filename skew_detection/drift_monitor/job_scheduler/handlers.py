@@ -86,7 +86,11 @@ def run_log_analyzer(
     baseline_stats_location: Optional[Text]=None,
     time_window: Optional[Text]=None
 ) -> Dict:
-    """Runs the log analyzer Dataflow template."""
+    """Runs the log analyzer Dataflow template.
+
+    The resolved output location of the run is added to the returned
+    launch response under the `output_location` key.
+    """
 
     service = googleapiclient.discovery.build('dataflow', 'v1b3')
 
@@ -116,6 +120,7 @@ def run_log_analyzer(
         body=body)
 
     response = request.execute()
+    response['output_location'] = output_location
 
     return response
 
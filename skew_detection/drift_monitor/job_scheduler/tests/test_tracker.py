@@ -0,0 +1,144 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import mock
+import pytest
+
+from tracker import JobLedger
+from tracker import _parse_timestamp
+from tracker import get_log_analyzer_job_status
+from tracker import wait_for_log_analyzer_jobs
+
+DEFAULT_PROJECT_ID = 'mlops-dev-env'
+DEFAULT_REGION = 'us-central1'
+DEFAULT_OUTPUT_LOCATION ='gs://mlops-dev-workspace/drift_monitor/output/tf/tests'
+
+
+def _mock_dataflow_service(states):
+    """Returns a mock Dataflow service that walks through the given job states."""
+
+    jobs = iter([{
+        'name': 'log-analyzer-test',
+        'currentState': state,
+        'createTime': '2020-06-03T16:00:00.123456789Z',
+        'startTime': '2020-06-03T16:00:10.123456789Z',
+        'currentStateTime': '2020-06-03T16:10:10Z'
+    } for state in states])
+    metrics = {'metrics': [
+        {'name': {'origin': 'dataflow/v1b3', 'name': 'TotalVcpuTime'}, 'scalar': 7200},
+        {'name': {'origin': 'dataflow/v1b3', 'name': 'TotalVcpuTime',
+                  'context': {'tentative': 'true'}}, 'scalar': 1},
+        {'name': {'origin': 'dataflow/v1b3', 'name': 'TotalMemoryUsage'}, 'scalar': 3686400}
+    ]}
+
+    service = mock.MagicMock()
+    dataflow_jobs = service.projects.return_value.locations.return_value.jobs.return_value
+    dataflow_jobs.get.return_value.execute.side_effect = lambda: next(jobs)
+    dataflow_jobs.getMetrics.return_value.execute.return_value = metrics
+    return service
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return JobLedger(str(tmp_path / 'ledger.db'))
+
+
+def test_get_log_analyzer_job_status():
+
+    service = _mock_dataflow_service(['JOB_STATE_DONE'])
+    status = get_log_analyzer_job_status(
+        DEFAULT_PROJECT_ID, DEFAULT_REGION, 'job-1', service)
+
+    assert status['state'] == 'JOB_STATE_DONE'
+    assert status['duration_sec'] == pytest.approx(600, abs=1)
+    assert status['vcpu_hours'] == pytest.approx(2)
+    assert status['memory_gb_hours'] == pytest.approx(1)
+
+
+def test_ledger_records_state_transitions(ledger):
+
+    ledger.record_launch('job-1', 'log-analyzer-test', DEFAULT_PROJECT_ID,
+                         DEFAULT_REGION, DEFAULT_OUTPUT_LOCATION)
+    assert [job['job_id'] for job in ledger.list_jobs(active_only=True)] == ['job-1']
+
+    for state in ['JOB_STATE_PENDING', 'JOB_STATE_RUNNING', 'JOB_STATE_RUNNING',
+                  'JOB_STATE_DONE']:
+        ledger.record_status('job-1', {'state': state, 'duration_sec': 1})
+
+    transitions = [t['state'] for t in ledger.get_transitions('job-1')]
+    assert transitions == ['JOB_STATE_PENDING', 'JOB_STATE_RUNNING', 'JOB_STATE_DONE']
+    assert ledger.list_jobs(active_only=True) == []
+
+
+def test_wait_for_log_analyzer_jobs(ledger):
+
+    ledger.record_launch('job-1', 'log-analyzer-test', DEFAULT_PROJECT_ID,
+                         DEFAULT_REGION, DEFAULT_OUTPUT_LOCATION)
+    ledger.record_launch('job-2', 'log-analyzer-test', DEFAULT_PROJECT_ID,
+                         DEFAULT_REGION, DEFAULT_OUTPUT_LOCATION)
+    states = {
+        'job-1': ['JOB_STATE_RUNNING', 'JOB_STATE_RUNNING', 'JOB_STATE_DONE'],
+        'job-2': ['JOB_STATE_RUNNING', 'JOB_STATE_FAILED']
+    }
+    services = iter([_mock_dataflow_service(states['job-1']),
+                     _mock_dataflow_service(states['job-2'])])
+    summary = {'anomalies_path': DEFAULT_OUTPUT_LOCATION, 'anomalies_count': 2,
+               'features': {}}
+
+    with mock.patch('tracker.summarize_anomalies', return_value=summary) as summarize:
+        jobs = wait_for_log_analyzer_jobs(
+            ledger=ledger,
+            project_id=DEFAULT_PROJECT_ID,
+            region=DEFAULT_REGION,
+            job_ids=['job-1'],
+            poll_interval=0.01,
+            service_factory=lambda: next(services))
+
+    assert jobs[0]['current_state'] == 'JOB_STATE_DONE'
+    assert jobs[0]['anomalies_count'] == 2
+    summarize.assert_called_once()
+    assert [job['job_id'] for job in ledger.list_jobs(active_only=True)] == ['job-2']
+
+
+@pytest.mark.parametrize('timestamp,microsecond', [
+    ('2020-06-03T16:00:56.5Z', 500000),
+    ('2020-06-03T16:00:56.12345Z', 123450),
+    ('2020-06-03T16:00:56.123456789Z', 123456),
+])
+def test_parse_timestamp(timestamp, microsecond):
+
+    assert _parse_timestamp(timestamp).microsecond == microsecond
+
+
+def test_wait_for_log_analyzer_jobs_polls_at_deadline(ledger):
+
+    ledger.record_launch('job-1', 'log-analyzer-test', DEFAULT_PROJECT_ID,
+                         DEFAULT_REGION, DEFAULT_OUTPUT_LOCATION)
+    service = _mock_dataflow_service(['JOB_STATE_RUNNING', 'JOB_STATE_DONE'])
+
+    with mock.patch('tracker.summarize_anomalies', return_value=None):
+        jobs = wait_for_log_analyzer_jobs(
+            ledger=ledger,
+            project_id=DEFAULT_PROJECT_ID,
+            region=DEFAULT_REGION,
+            job_ids=['job-1'],
+            poll_interval=60,
+            timeout=0.2,
+            collect_anomalies=False,
+            service_factory=lambda: service)
+
+    assert jobs[0]['current_state'] == 'JOB_STATE_DONE'
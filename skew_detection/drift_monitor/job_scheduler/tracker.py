@@ -0,0 +1,343 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helper routines to track launched log analyzer Dataflow jobs. """
+
+
+import concurrent.futures
+import datetime
+import json
+import logging
+import sqlite3
+import time
+
+import googleapiclient.discovery
+
+from typing import Callable, Dict, List, Optional, Text
+from google.cloud import storage
+from google.protobuf import text_format
+from tensorflow_metadata.proto.v0 import anomalies_pb2
+
+
+_ANOMALIES_FILENAME = 'anomalies.pbtxt'
+_TERMINAL_STATES = frozenset([
+    'JOB_STATE_DONE',
+    'JOB_STATE_FAILED',
+    'JOB_STATE_CANCELLED',
+    'JOB_STATE_UPDATED',
+    'JOB_STATE_DRAINED'
+])
+_METRICS_ORIGIN = 'dataflow/v1b3'
+_VCPU_TIME_METRIC = 'TotalVcpuTime'
+_MEMORY_USAGE_METRIC = 'TotalMemoryUsage'
+
+_LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    job_name TEXT,
+    project_id TEXT,
+    region TEXT,
+    model TEXT,
+    version TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    output_location TEXT,
+    launch_time TEXT,
+    current_state TEXT,
+    current_state_time TEXT,
+    duration_sec REAL,
+    vcpu_hours REAL,
+    memory_gb_hours REAL,
+    anomalies_count INTEGER,
+    anomalies_summary TEXT
+);
+CREATE TABLE IF NOT EXISTS state_transitions (
+    job_id TEXT,
+    state TEXT,
+    state_time TEXT,
+    observed_time TEXT
+);
+"""
+
+
+def _parse_timestamp(timestamp: Optional[Text]) -> Optional[datetime.datetime]:
+    """Converts a Dataflow API RFC3339 timestamp to a datetime."""
+
+    if not timestamp:
+        return None
+    # The API returns nanosecond precision which datetime cannot parse.
+    timestamp = timestamp.rstrip('Z')
+    if '.' in timestamp:
+        seconds, fraction = timestamp.split('.')
+        # Before Python 3.11 fromisoformat only accepts 3 or 6 digits.
+        timestamp = '{}.{}'.format(seconds, fraction[:6].ljust(6, '0'))
+    return datetime.datetime.fromisoformat(timestamp)
+
+
+class JobLedger(object):
+    """A local SQLite ledger of the log analyzer runs.
+
+    The ledger keeps one row per launched job with its latest state, duration,
+    resource usage and anomaly summary, and a separate table with the history
+    of observed state transitions. A new connection is opened for every
+    operation so a ledger can be shared by the polling threads.
+    """
+
+    def __init__(self, path: Text):
+        self._path = path
+        with self._connect() as conn:
+            conn.executescript(_LEDGER_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def record_launch(
+        self,
+        job_id: Text,
+        job_name: Text,
+        project_id: Text,
+        region: Text,
+        output_location: Optional[Text]=None,
+        model: Optional[Text]=None,
+        version: Optional[Text]=None,
+        start_time: Optional[Text]=None,
+        end_time: Optional[Text]=None
+    ):
+        """Registers a newly launched job."""
+
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO jobs (job_id, job_name, project_id, region, '
+                'model, version, start_time, end_time, output_location, launch_time) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, job_name, project_id, region, model, version, start_time,
+                 end_time, output_location,
+                 datetime.datetime.utcnow().isoformat(timespec='seconds')))
+
+    def record_status(self, job_id: Text, status: Dict):
+        """Updates the job row and logs a state transition if the state changed."""
+
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT current_state FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row is None:
+                conn.execute(
+                    'INSERT INTO jobs (job_id, job_name, project_id, region) '
+                    'VALUES (?, ?, ?, ?)',
+                    (job_id, status.get('job_name'), status.get('project_id'),
+                     status.get('region')))
+            if row is None or row['current_state'] != status['state']:
+                conn.execute(
+                    'INSERT INTO state_transitions VALUES (?, ?, ?, ?)',
+                    (job_id, status['state'], status.get('state_time'),
+                     datetime.datetime.utcnow().isoformat(timespec='seconds')))
+            conn.execute(
+                'UPDATE jobs SET current_state = ?, current_state_time = ?, '
+                'duration_sec = ?, vcpu_hours = COALESCE(?, vcpu_hours), '
+                'memory_gb_hours = COALESCE(?, memory_gb_hours) WHERE job_id = ?',
+                (status['state'], status.get('state_time'), status.get('duration_sec'),
+                 status.get('vcpu_hours'), status.get('memory_gb_hours'), job_id))
+
+    def record_anomalies(self, job_id: Text, summary: Dict):
+        """Stores the anomaly report summary of a finished job."""
+
+        with self._connect() as conn:
+            conn.execute(
+                'UPDATE jobs SET anomalies_count = ?, anomalies_summary = ? '
+                'WHERE job_id = ?',
+                (summary['anomalies_count'], json.dumps(summary), job_id))
+
+    def get_job(self, job_id: Text) -> Optional[Dict]:
+        """Returns a ledger row as a dictionary."""
+
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list_jobs(self, active_only: bool=False) -> List[Dict]:
+        """Returns all ledger rows ordered by the launch time."""
+
+        query = 'SELECT * FROM jobs'
+        if active_only:
+            query += ' WHERE current_state IS NULL OR current_state NOT IN ({})'.format(
+                ', '.join('?' * len(_TERMINAL_STATES)))
+        query += ' ORDER BY launch_time'
+        with self._connect() as conn:
+            rows = conn.execute(
+                query, tuple(_TERMINAL_STATES) if active_only else ()).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_transitions(self, job_id: Text) -> List[Dict]:
+        """Returns the observed state transitions of a job."""
+
+        with self._connect() as conn:
+            rows = conn.execute(
+                'SELECT state, state_time, observed_time FROM state_transitions '
+                'WHERE job_id = ? ORDER BY rowid', (job_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+
+def get_log_analyzer_job_status(
+    project_id: Text,
+    region: Text,
+    job_id: Text,
+    service=None
+) -> Dict:
+    """Retrieves the state, duration and resource usage of a Dataflow job."""
+
+    if service is None:
+        service = googleapiclient.discovery.build('dataflow', 'v1b3')
+
+    job = service.projects().locations().jobs().get(
+        projectId=project_id,
+        location=region,
+        jobId=job_id,
+        view='JOB_VIEW_SUMMARY').execute()
+
+    state = job.get('currentState', 'JOB_STATE_UNKNOWN')
+    status = {
+        'job_id': job_id,
+        'job_name': job.get('name'),
+        'project_id': project_id,
+        'region': region,
+        'state': state,
+        'state_time': job.get('currentStateTime'),
+        'duration_sec': None,
+        'vcpu_hours': None,
+        'memory_gb_hours': None
+    }
+
+    started = _parse_timestamp(job.get('startTime') or job.get('createTime'))
+    if started:
+        finished = (_parse_timestamp(job.get('currentStateTime'))
+            if state in _TERMINAL_STATES else datetime.datetime.utcnow())
+        status['duration_sec'] = (finished - started).total_seconds()
+
+    if state in _TERMINAL_STATES:
+        metrics = service.projects().locations().jobs().getMetrics(
+            projectId=project_id,
+            location=region,
+            jobId=job_id).execute()
+        for metric in metrics.get('metrics', []):
+            name = metric['name']
+            if name.get('origin') != _METRICS_ORIGIN or 'tentative' in name.get('context', {}):
+                continue
+            if name['name'] == _VCPU_TIME_METRIC:
+                status['vcpu_hours'] = float(metric['scalar']) / 3600
+            elif name['name'] == _MEMORY_USAGE_METRIC:
+                status['memory_gb_hours'] = float(metric['scalar']) / 1024 / 3600
+
+    return status
+
+
+def summarize_anomalies(output_location: Text, storage_client=None) -> Dict:
+    """Downloads the anomalies report of a log analyzer run and summarizes it."""
+
+    if storage_client is None:
+        storage_client = storage.Client()
+
+    anomalies_path = '{}/{}'.format(output_location.rstrip('/'), _ANOMALIES_FILENAME)
+    blob = storage.Blob.from_string(anomalies_path, client=storage_client)
+    anomalies = text_format.Parse(
+        blob.download_as_string().decode('utf-8'), anomalies_pb2.Anomalies())
+
+    features = {}
+    for feature, info in anomalies.anomaly_info.items():
+        features[feature] = {
+            'severity': anomalies_pb2.AnomalyInfo.Severity.Name(info.severity),
+            'description': info.short_description
+        }
+
+    return {
+        'anomalies_path': anomalies_path,
+        'anomalies_count': len(features),
+        'features': features
+    }
+
+
+def wait_for_log_analyzer_jobs(
+    ledger: JobLedger,
+    project_id: Text,
+    region: Text,
+    job_ids: Optional[List[Text]]=None,
+    poll_interval: float=10,
+    max_poll_interval: float=300,
+    backoff_factor: float=2,
+    timeout: Optional[float]=None,
+    collect_anomalies: bool=True,
+    service_factory: Optional[Callable]=None,
+    storage_client=None
+) -> List[Dict]:
+    """Polls a set of log analyzer jobs concurrently until they finish.
+
+    Each job is polled from its own thread. The polling interval grows by
+    `backoff_factor` after every poll that does not observe a state change, up
+    to `max_poll_interval`, and is reset when the state changes. All observed
+    states are recorded in the ledger. When a job completes successfully its
+    anomalies report is downloaded and summarized.
+
+    Returns the final ledger rows of the tracked jobs.
+    """
+
+    if job_ids is None:
+        job_ids = [job['job_id'] for job in ledger.list_jobs(active_only=True)]
+    if service_factory is None:
+        service_factory = lambda: googleapiclient.discovery.build('dataflow', 'v1b3')
+
+    deadline = time.time() + timeout if timeout else None
+
+    def _track(job_id):
+        # Discovery clients are not thread-safe so each thread builds its own.
+        service = service_factory()
+        interval = poll_interval
+        state = None
+        while True:
+            status = get_log_analyzer_job_status(project_id, region, job_id, service)
+            ledger.record_status(job_id, status)
+            if status['state'] != state:
+                logging.info('Job %s is in state %s', job_id, status['state'])
+                state = status['state']
+                interval = poll_interval
+            else:
+                interval = min(interval * backoff_factor, max_poll_interval)
+
+            if state in _TERMINAL_STATES:
+                break
+            if deadline:
+                now = time.time()
+                if now >= deadline:
+                    logging.warning('Timed out waiting for job %s', job_id)
+                    return
+                # Poll a last time at the deadline.
+                interval = min(interval, deadline - now)
+            time.sleep(interval)
+
+        output_location = (ledger.get_job(job_id) or {}).get('output_location')
+        if collect_anomalies and state == 'JOB_STATE_DONE' and output_location:
+            summary = summarize_anomalies(output_location, storage_client)
+            ledger.record_anomalies(job_id, summary)
+
+    if job_ids:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(job_ids)) as executor:
+            futures = {executor.submit(_track, job_id): job_id for job_id in job_ids}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error('Failed to track job %s: %s', futures[future], e)
+
+    return [ledger.get_job(job_id) for job_id in job_ids]
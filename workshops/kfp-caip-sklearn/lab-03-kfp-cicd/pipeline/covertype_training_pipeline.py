@@ -15,9 +15,10 @@
 
 import os
 
+from helper_components import create_splits
 from helper_components import evaluate_model
 from helper_components import retrieve_best_run
-from jinja2 import Template
+from helper_components import retrieve_deployed_model
 import kfp
 from kfp.components import func_to_container_op
 from kfp.dsl.types import Dict
@@ -35,12 +36,17 @@ PYTHON_VERSION = os.getenv('PYTHON_VERSION')
 COMPONENT_URL_SEARCH_PREFIX = os.getenv('COMPONENT_URL_SEARCH_PREFIX')
 USE_KFP_SA = os.getenv('USE_KFP_SA')
 
-TRAINING_FILE_PATH = 'datasets/training/data.csv'
-VALIDATION_FILE_PATH = 'datasets/validation/data.csv'
-TESTING_FILE_PATH = 'datasets/testing/data.csv'
+# The paths of the splits, without the extension of the dataset format
+TRAINING_FILE_PATH = 'datasets/training/data'
+VALIDATION_FILE_PATH = 'datasets/validation/data'
+TESTING_FILE_PATH = 'datasets/testing/data'
+DATASET_CACHE_PATH = 'datasets/cache'
+STEP_CACHE_PATH = 'cache/steps'
 
 # Parameter defaults
 SPLITS_DATASET_ID = 'splits'
+# The format of the splits, csv or parquet
+DATASET_FORMAT = 'csv'
 HYPERTUNE_SETTINGS = """
 {
     "hyperparameters":  {
@@ -68,33 +74,20 @@ HYPERTUNE_SETTINGS = """
 """
 
 
-# Helper functions
-def generate_sampling_query(source_table_name, num_lots, lots):
-  """Prepares the data sampling query."""
-
-  sampling_query_template = """
-       SELECT *
-       FROM 
-           `{{ source_table }}` AS cover
-       WHERE 
-       MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(cover))), {{ num_lots }}) IN ({{ lots }})
-       """
-  query = Template(sampling_query_template).render(
-      source_table=source_table_name, num_lots=num_lots, lots=str(lots)[1:-1])
-
-  return query
-
-
 # Create component factories
 component_store = kfp.components.ComponentStore(
     local_search_paths=None, url_search_prefixes=[COMPONENT_URL_SEARCH_PREFIX])
 
-bigquery_query_op = component_store.load_component('bigquery/query')
 mlengine_train_op = component_store.load_component('ml_engine/train')
 mlengine_deploy_op = component_store.load_component('ml_engine/deploy')
+create_splits_op = func_to_container_op(
+    create_splits, base_image=TRAINER_IMAGE)
 retrieve_best_run_op = func_to_container_op(
     retrieve_best_run, base_image=BASE_IMAGE)
-evaluate_model_op = func_to_container_op(evaluate_model, base_image=BASE_IMAGE)
+retrieve_deployed_model_op = func_to_container_op(
+    retrieve_deployed_model, base_image=BASE_IMAGE)
+evaluate_model_op = func_to_container_op(
+    evaluate_model, base_image=TRAINER_IMAGE)
 
 
 @kfp.dsl.pipeline(
@@ -112,110 +105,133 @@ def covertype_train(project_id,
                     version_id,
                     replace_existing_version,
                     hypertune_settings=HYPERTUNE_SETTINGS,
-                    dataset_location='US'):
-  """Orchestrates training and deployment of an sklearn model."""
-
-  # Create the training split
-  query = generate_sampling_query(
-      source_table_name=source_table_name, num_lots=10, lots=[1, 2, 3, 4])
-
-  training_file_path = '{}/{}'.format(gcs_root, TRAINING_FILE_PATH)
-
-  create_training_split = bigquery_query_op(
-      query=query,
-      project_id=project_id,
-      dataset_id=dataset_id,
-      table_id='',
-      output_gcs_path=training_file_path,
-      dataset_location=dataset_location)
-
-  # Create the validation split
-  query = generate_sampling_query(
-      source_table_name=source_table_name, num_lots=10, lots=[8])
-
-  validation_file_path = '{}/{}'.format(gcs_root, VALIDATION_FILE_PATH)
-
-  create_validation_split = bigquery_query_op(
-      query=query,
-      project_id=project_id,
-      dataset_id=dataset_id,
-      table_id='',
-      output_gcs_path=validation_file_path,
-      dataset_location=dataset_location)
-
-  # Create the testing split
-  query = generate_sampling_query(
-      source_table_name=source_table_name, num_lots=10, lots=[9])
-
-  testing_file_path = '{}/{}'.format(gcs_root, TESTING_FILE_PATH)
-
-  create_testing_split = bigquery_query_op(
-      query=query,
+                    dataset_location='US',
+                    dataset_format=DATASET_FORMAT,
+                    full_retrain='True',
+                    new_data_path=''):
+  """Orchestrates training and deployment of an sklearn model.
+
+  If full_retrain is 'False', the deployed model continues training on
+  the data in new_data_path instead of being retrained from scratch with
+  hyperparameter tuning.
+  """
+
+  # The splits, the hypertune trials and the training are skipped if their
+  # inputs and code are unchanged since a previous run
+  step_cache_path = '{}/{}'.format(gcs_root, STEP_CACHE_PATH)
+
+  # Create the training, validation and testing splits in a single pass
+  # over the source table. The splits are written as CSV or Parquet
+  # depending on their extension.
+  create_dataset_splits = create_splits_op(
       project_id=project_id,
+      source_table_name=source_table_name,
       dataset_id=dataset_id,
-      table_id='',
-      output_gcs_path=testing_file_path,
-      dataset_location=dataset_location)
-
-  # Tune hyperparameters
-  tune_args = [
-      '--training_dataset_path',
-      create_training_split.outputs['output_gcs_path'],
-      '--validation_dataset_path',
-      create_validation_split.outputs['output_gcs_path'], '--hptune', 'True'
-  ]
-
-  job_dir = '{}/{}/{}'.format(gcs_root, 'jobdir/hypertune',
-                              kfp.dsl.RUN_ID_PLACEHOLDER)
-
-  hypertune = mlengine_train_op(
-      project_id=project_id,
-      region=region,
-      master_image_uri=TRAINER_IMAGE,
-      job_dir=job_dir,
-      args=tune_args,
-      training_input=hypertune_settings)
-
-  # Retrieve the best trial
-  get_best_trial = retrieve_best_run_op(project_id, hypertune.outputs['job_id'])
-
-  # Train the model on a combined training and validation datasets
+      training_file_path='{}/{}.{}'.format(gcs_root, TRAINING_FILE_PATH,
+                                           dataset_format),
+      validation_file_path='{}/{}.{}'.format(gcs_root, VALIDATION_FILE_PATH,
+                                             dataset_format),
+      testing_file_path='{}/{}.{}'.format(gcs_root, TESTING_FILE_PATH,
+                                          dataset_format),
+      dataset_location=dataset_location,
+      step_cache_dir=step_cache_path)
+
+  dataset_cache_path = '{}/{}'.format(gcs_root, DATASET_CACHE_PATH)
   job_dir = '{}/{}/{}'.format(gcs_root, 'jobdir', kfp.dsl.RUN_ID_PLACEHOLDER)
 
-  train_args = [
-      '--training_dataset_path',
-      create_training_split.outputs['output_gcs_path'],
-      '--validation_dataset_path',
-      create_validation_split.outputs['output_gcs_path'], '--alpha',
-      get_best_trial.outputs['alpha'], '--max_iter',
-      get_best_trial.outputs['max_iter'], '--hptune', 'False'
-  ]
-
-  train_model = mlengine_train_op(
-      project_id=project_id,
-      region=region,
-      master_image_uri=TRAINER_IMAGE,
-      job_dir=job_dir,
-      args=train_args)
-
-  # Evaluate the model on the testing split
-  eval_model = evaluate_model_op(
-      dataset_path=str(create_testing_split.outputs['output_gcs_path']),
-      model_path=str(train_model.outputs['job_dir']),
-      metric_name=evaluation_metric_name)
-
-  # Deploy the model if the primary metric is better than threshold
-  with kfp.dsl.Condition(
-      eval_model.outputs['metric_value'] > evaluation_metric_threshold):
-    deploy_model = mlengine_deploy_op(
-        model_uri=train_model.outputs['job_dir'],
+  def evaluate_and_deploy(train_model):
+    # Evaluate the model on the testing split
+    eval_model = evaluate_model_op(
+        dataset_path=str(create_dataset_splits.outputs['testing_file_path']),
+        model_path=str(train_model.outputs['job_dir']),
+        metric_name=evaluation_metric_name)
+
+    # Deploy the model if the primary metric is better than threshold
+    with kfp.dsl.Condition(
+        eval_model.outputs['metric_value'] > evaluation_metric_threshold):
+      mlengine_deploy_op(
+          model_uri=train_model.outputs['job_dir'],
+          project_id=project_id,
+          model_id=model_id,
+          version_id=version_id,
+          runtime_version=RUNTIME_VERSION,
+          python_version=PYTHON_VERSION,
+          replace_existing_version=replace_existing_version)
+
+  # Retrain from scratch, e.g. on a schedule or after a schema change
+  with kfp.dsl.Condition(full_retrain == 'True'):
+    # Tune hyperparameters. The trials share the parsed datasets
+    # through the dataset cache.
+    tune_args = [
+        '--training_dataset_path',
+        create_dataset_splits.outputs['training_file_path'],
+        '--validation_dataset_path',
+        create_dataset_splits.outputs['validation_file_path'], '--hptune',
+        'True', '--cache_dir', dataset_cache_path, '--step_cache_dir',
+        step_cache_path
+    ]
+
+    hypertune_job_dir = '{}/{}/{}'.format(gcs_root, 'jobdir/hypertune',
+                                          kfp.dsl.RUN_ID_PLACEHOLDER)
+
+    hypertune = mlengine_train_op(
+        project_id=project_id,
+        region=region,
+        master_image_uri=TRAINER_IMAGE,
+        job_dir=hypertune_job_dir,
+        args=tune_args,
+        training_input=hypertune_settings)
+
+    # Retrieve the best trial
+    get_best_trial = retrieve_best_run_op(project_id,
+                                          hypertune.outputs['job_id'])
+
+    # Train the model on a combined training and validation datasets
+    train_args = [
+        '--training_dataset_path',
+        create_dataset_splits.outputs['training_file_path'],
+        '--validation_dataset_path',
+        create_dataset_splits.outputs['validation_file_path'], '--alpha',
+        get_best_trial.outputs['alpha'], '--max_iter',
+        get_best_trial.outputs['max_iter'], '--hptune', 'False',
+        '--cache_dir', dataset_cache_path, '--step_cache_dir', step_cache_path
+    ]
+
+    train_model = mlengine_train_op(
         project_id=project_id,
-        model_id=model_id,
-        version_id=version_id,
-        runtime_version=RUNTIME_VERSION,
-        python_version=PYTHON_VERSION,
-        replace_existing_version=replace_existing_version)
-  
+        region=region,
+        master_image_uri=TRAINER_IMAGE,
+        job_dir=job_dir,
+        args=train_args)
+
+    evaluate_and_deploy(train_model)
+
+  # Continue training the deployed model on the new data. The trainer
+  # retrains from scratch with the hyperparameters of the deployed model
+  # if the schema of the new data changed.
+  with kfp.dsl.Condition(full_retrain == 'False'):
+    # Runs in parallel with the splits, which it does not depend on
+    get_deployed_model = retrieve_deployed_model_op(project_id, model_id)
+
+    warm_start_args = [
+        '--training_dataset_path',
+        create_dataset_splits.outputs['training_file_path'],
+        '--validation_dataset_path',
+        create_dataset_splits.outputs['validation_file_path'],
+        '--warm_start_dir', get_deployed_model.outputs['model_dir'],
+        '--new_data_path', new_data_path, '--hptune', 'False', '--cache_dir',
+        dataset_cache_path, '--step_cache_dir', step_cache_path
+    ]
+
+    warm_start_model = mlengine_train_op(
+        project_id=project_id,
+        region=region,
+        master_image_uri=TRAINER_IMAGE,
+        job_dir=job_dir,
+        args=warm_start_args)
+
+    evaluate_and_deploy(warm_start_model)
+
   # Configure the pipeline to run using the service account defined
   # in the user-gcp-sa k8s secret
   if USE_KFP_SA == 'True':
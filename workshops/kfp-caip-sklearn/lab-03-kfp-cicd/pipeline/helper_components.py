@@ -15,6 +15,45 @@
 from typing import NamedTuple
 
 
+def create_splits(
+    project_id: str,
+    source_table_name: str,
+    dataset_id: str,
+    training_file_path: str,
+    validation_file_path: str,
+    testing_file_path: str,
+    dataset_location: str = 'US',
+    step_cache_dir: str = ''
+) -> NamedTuple('Outputs', [('training_file_path', str),
+                            ('validation_file_path', str),
+                            ('testing_file_path', str)]):
+  """Creates the training, validation and testing splits in one pass.
+
+  If step_cache_dir is set, the splits are created only if the query or
+  the source table changed since the last run.
+
+  The component runs in the trainer image, which provides the splits
+  module.
+  """
+
+  import splits
+  import step_cache
+
+  engine = splits.BigQueryEngine(project_id, dataset_id, dataset_location)
+  cache = step_cache.StepCache(step_cache_dir) if step_cache_dir else None
+  output_paths = splits.create_splits(
+      engine,
+      source_table_name, {
+          'training': training_file_path,
+          'validation': validation_file_path,
+          'testing': testing_file_path
+      },
+      cache=cache)
+
+  return (output_paths['training'], output_paths['validation'],
+          output_paths['testing'])
+
+
 def retrieve_best_run(
     project_id: str, job_id: str
 ) -> NamedTuple('Outputs', [('metric_value', float), ('alpha', float),
@@ -47,51 +86,75 @@ def retrieve_best_run(
   return (metric_value, alpha, max_iter)
 
 
+def retrieve_deployed_model(
+    project_id: str, model_id: str
+) -> NamedTuple('Outputs', [('model_dir', str)]):
+  """Retrieves the location of the default version of a model.
+
+  The location is empty if the model has no default version.
+  """
+
+  from googleapiclient import discovery
+  from googleapiclient import errors
+
+  ml = discovery.build('ml', 'v1')
+
+  model_name = 'projects/{}/models/{}'.format(project_id, model_id)
+  request = ml.projects().models().get(name=model_name)
+
+  try:
+    response = request.execute()
+  except errors.HttpError as err:
+    print(err)
+    return ('',)
+
+  model_dir = response.get('defaultVersion', {}).get('deploymentUri', '')
+  print(model_dir)
+
+  return (model_dir,)
+
+
 def evaluate_model(
-    dataset_path: str, model_path: str, metric_name: str
+    dataset_path: str,
+    model_path: str,
+    metric_name: str,
+    batch_size: int = 50000,
+    slice_features: str = 'Wilderness_Area'
 ) -> NamedTuple('Outputs', [('metric_name', str), ('metric_value', float),
                             ('mlpipeline_metrics', 'Metrics')]):
-  """Evaluates a trained sklearn model."""
-  #import joblib
-  import pickle
-  import json
-  import pandas as pd
-  import subprocess
-  import sys
+  """Evaluates a trained sklearn model.
 
-  from sklearn.metrics import accuracy_score, recall_score
+  The testing split is streamed in batches of batch_size rows. The
+  metrics of the split, of its classes and of the slices by the comma
+  separated slice_features are exported as KFP metrics.
 
-  df_test = pd.read_csv(dataset_path)
-
-  X_test = df_test.drop('Cover_Type', axis=1)
-  y_test = df_test['Cover_Type']
+  The component runs in the trainer image, which provides the modules
+  used to load the model and to parse the testing split with the same
+  dtypes as the training splits.
+  """
+  import json
 
-  # Copy the model from GCS
-  model_filename = 'model.pkl'
-  gcs_model_filepath = '{}/{}'.format(model_path, model_filename)
-  print(gcs_model_filepath)
-  subprocess.check_call(['gsutil', 'cp', gcs_model_filepath, model_filename],
-                        stderr=sys.stdout)
+  import artifacts
+  import evaluation
 
-  with open(model_filename, 'rb') as model_file:
-    model = pickle.load(model_file)
+  print(artifacts.model_path(model_path))
+  model = artifacts.load_model(model_path)
 
-  y_hat = model.predict(X_test)
+  slice_features = [
+      feature.strip() for feature in slice_features.split(',')
+      if feature.strip()
+  ]
+  overall, slices = evaluation.evaluate(model, dataset_path, batch_size,
+                                        slice_features)
+  print('Metrics: {}'.format(overall.metrics()))
+  print('Class metrics: {}'.format(overall.class_metrics()))
 
-  if metric_name == 'accuracy':
-    metric_value = accuracy_score(y_test, y_hat)
-  elif metric_name == 'recall':
-    metric_value = recall_score(y_test, y_hat)
-  else:
+  metric_value = evaluation.metric_value(overall, metric_name)
+  if metric_value is None:
     metric_name = 'N/A'
     metric_value = 0
 
-  # Export the metric
-  metrics = {
-      'metrics': [{
-          'name': metric_name,
-          'numberValue': float(metric_value)
-      }]
-  }
+  # Export the metrics
+  metrics = {'metrics': evaluation.kfp_metrics(overall, slices)}
 
   return (metric_name, metric_value, json.dumps(metrics))
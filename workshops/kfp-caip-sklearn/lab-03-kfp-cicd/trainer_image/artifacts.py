@@ -0,0 +1,70 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Saving and loading of the trained models.
+
+The models are serialized with joblib, which stores the numpy arrays of
+the model efficiently, and are streamed to and from GCS with the client
+library. The models are saved as model.joblib, one of the file names
+recognized by AI Platform Prediction.
+"""
+
+import joblib
+
+import fileio
+
+MODEL_FILENAME = 'model.joblib'
+
+# The zlib level of the saved models
+DEFAULT_COMPRESS = 3
+
+
+def model_path(model_dir):
+  return fileio.join(model_dir, MODEL_FILENAME)
+
+
+def save_model(model, model_dir, compress=DEFAULT_COMPRESS):
+  """Saves a model in a local directory or a gs:// URI.
+
+  Args:
+    model: The model to save.
+    model_dir: The directory of the model.
+    compress: The zlib compression level. Models saved uncompressed to a
+      local directory can be memory mapped when loaded.
+
+  Returns:
+    The path of the saved model.
+  """
+  path = model_path(model_dir)
+  with fileio.open_file(path, 'wb') as f:
+    joblib.dump(model, f, compress=compress)
+  return path
+
+
+def load_model(model_dir, mmap_mode=None):
+  """Loads a model from a local directory or a gs:// URI.
+
+  Args:
+    model_dir: The directory of the model.
+    mmap_mode: If set, the arrays of an uncompressed local model are
+      memory mapped with this mode instead of being read.
+
+  Returns:
+    The model.
+  """
+  path = model_path(model_dir)
+  if mmap_mode and not fileio.is_gcs_path(path):
+    return joblib.load(path, mmap_mode=mmap_mode)
+  with fileio.open_file(path, 'rb') as f:
+    return joblib.load(f)
@@ -0,0 +1,92 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of the inference kernel against the pipeline.
+
+Both predict batches of rows of a split, for each batch size, and the
+median latency per batch and the agreement of their predictions are
+printed:
+
+  python benchmark_kernel.py --model_dir gs://.../model \
+    --dataset_path gs://.../testing/data.csv
+"""
+
+import time
+
+import fire
+import numpy as np
+
+import artifacts
+import data
+import kernel
+
+DEFAULT_BATCH_SIZES = (1, 10, 100, 1000, 10000)
+
+
+def _median_latency(predict, X, repeats):
+  latencies = []
+  for _ in range(repeats):
+    start_time = time.perf_counter()
+    predict(X)
+    latencies.append(time.perf_counter() - start_time)
+  return float(np.median(latencies))
+
+
+def benchmark(model_dir, dataset_path, batch_sizes=DEFAULT_BATCH_SIZES,
+              repeats=20):
+  """Benchmarks the kernel saved with a model against the model.
+
+  Args:
+    model_dir: The directory of the model and the kernel.
+    dataset_path: The path or the gs:// URI of the CSV or Parquet split
+      the batches are taken from.
+    batch_sizes: The batch sizes to benchmark.
+    repeats: The number of predictions timed per batch size.
+
+  Returns:
+    A list of dictionaries with the batch size, the median latencies of
+    the pipeline and of the kernel in seconds and the agreement of their
+    predictions.
+  """
+  pipeline = artifacts.load_model(model_dir)
+  compiled = kernel.load_kernel(model_dir)
+  X, _ = data.split_features(data.load_dataset(dataset_path))
+
+  results = []
+  print('{:>10} {:>14} {:>14} {:>8} {:>10}'.format(
+      'batch_size', 'pipeline_ms', 'kernel_ms', 'speedup', 'agreement'))
+  for batch_size in batch_sizes:
+    batch = X.iloc[:batch_size]
+    if len(batch) < batch_size:
+      print('Skipping batch size {}, the split has {} rows'.format(
+          batch_size, len(X)))
+      continue
+    pipeline_latency = _median_latency(pipeline.predict, batch, repeats)
+    kernel_latency = _median_latency(compiled.predict, batch, repeats)
+    agreement = float(
+        np.mean(pipeline.predict(batch) == compiled.predict(batch)))
+    results.append({
+        'batch_size': batch_size,
+        'pipeline_latency': pipeline_latency,
+        'kernel_latency': kernel_latency,
+        'agreement': agreement
+    })
+    print('{:>10} {:>14.3f} {:>14.3f} {:>7.1f}x {:>10.4f}'.format(
+        batch_size, pipeline_latency * 1000, kernel_latency * 1000,
+        pipeline_latency / kernel_latency, agreement))
+  return results
+
+
+if __name__ == '__main__':
+  fire.Fire(benchmark)
@@ -0,0 +1,275 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Covertype dataset ingestion.
+
+The splits are CSV or Parquet files, and are read with explicit compact
+dtypes. If pyarrow is available the CSV files are parsed by its
+multithreaded CSV reader and the parsed frames are cached in the Feather
+format, keyed by the source path and version, so repeated trials on the
+same split skip the parsing. The Parquet files are memory mapped and
+only the columns of the covertype schema are decoded.
+"""
+
+import contextlib
+import hashlib
+import os
+import tempfile
+
+import pandas as pd
+
+import fileio
+
+try:
+  import pyarrow
+  import pyarrow.csv
+  import pyarrow.feather
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+LABEL = 'Cover_Type'
+
+NUMERIC_FEATURES = [
+    'Elevation', 'Aspect', 'Slope', 'Horizontal_Distance_To_Hydrology',
+    'Vertical_Distance_To_Hydrology', 'Horizontal_Distance_To_Roadways',
+    'Hillshade_9am', 'Hillshade_Noon', 'Hillshade_3pm',
+    'Horizontal_Distance_To_Fire_Points'
+]
+
+CATEGORICAL_FEATURES = ['Wilderness_Area', 'Soil_Type']
+
+SCHEMA_COLUMNS = NUMERIC_FEATURES + CATEGORICAL_FEATURES + [LABEL]
+
+# The covertype values fit in 16 bits. The categorical features are
+# read as strings, as the soil types are numeric codes.
+NUMERIC_DTYPE = 'int16'
+LABEL_DTYPE = 'int16'
+
+CACHE_FORMAT_VERSION = 1
+
+PARQUET_EXTENSION = '.parquet'
+
+
+def _csv_dtypes():
+  dtypes = {feature: NUMERIC_DTYPE for feature in NUMERIC_FEATURES}
+  dtypes.update({feature: 'category' for feature in CATEGORICAL_FEATURES})
+  dtypes[LABEL] = LABEL_DTYPE
+  return dtypes
+
+
+def _read_csv_arrow(path):
+  """Parses a CSV file with the multithreaded Arrow CSV reader."""
+  column_types = {feature: pyarrow.int16() for feature in NUMERIC_FEATURES}
+  column_types.update(
+      {feature: pyarrow.string() for feature in CATEGORICAL_FEATURES})
+  column_types[LABEL] = pyarrow.int16()
+  table = pyarrow.csv.read_csv(
+      path,
+      read_options=pyarrow.csv.ReadOptions(use_threads=True),
+      convert_options=pyarrow.csv.ConvertOptions(column_types=column_types))
+  df = table.to_pandas()
+  for feature in CATEGORICAL_FEATURES:
+    if feature in df:
+      df[feature] = df[feature].astype('category')
+  return df
+
+
+def read_csv(path):
+  """Parses a local CSV split into a frame with compact dtypes."""
+  if pyarrow is not None:
+    return _read_csv_arrow(path)
+  return pd.read_csv(path, dtype=_csv_dtypes())
+
+
+def is_parquet(path):
+  return path.endswith(PARQUET_EXTENSION)
+
+
+def _compact(df):
+  """Converts the columns of a frame to the compact dtypes.
+
+  The categorical features are converted to strings first, as when they
+  are parsed from CSV.
+  """
+  dtypes = _csv_dtypes()
+  for feature in CATEGORICAL_FEATURES:
+    if feature in df and df[feature].dtype != object:
+      df[feature] = df[feature].astype(str)
+  return df.astype({column: dtypes[column] for column in df.columns})
+
+
+def read_parquet(path, columns=None):
+  """Reads a local Parquet split into a frame with compact dtypes.
+
+  The file is memory mapped and decoded by multiple threads. Only the
+  columns of the covertype schema, or the given columns, are decoded.
+  """
+  if pyarrow is None:
+    raise ImportError('Reading Parquet splits requires the pyarrow package')
+  table = pyarrow.parquet.read_table(
+      path,
+      columns=columns or SCHEMA_COLUMNS,
+      memory_map=True,
+      use_threads=True)
+  return _compact(table.to_pandas())
+
+
+def _iter_parquet(path, batch_size):
+  parquet_file = pyarrow.parquet.ParquetFile(path, memory_map=True)
+  if hasattr(parquet_file, 'iter_batches'):
+    for batch in parquet_file.iter_batches(
+        batch_size=batch_size, columns=SCHEMA_COLUMNS):
+      yield _compact(batch.to_pandas())
+    return
+  # Older pyarrow versions read whole row groups
+  for i in range(parquet_file.num_row_groups):
+    df = _compact(
+        parquet_file.read_row_group(i, columns=SCHEMA_COLUMNS).to_pandas())
+    for start in range(0, len(df), batch_size):
+      yield df.iloc[start:start + batch_size]
+
+
+def iter_dataset(path, batch_size):
+  """Reads a CSV or Parquet split from a local path or GCS in batches.
+
+  A GCS object is downloaded to a temporary file first, so only one batch
+  is held in memory at a time.
+
+  Args:
+    path: The path or the gs:// URI of the split. Splits with the .parquet
+      extension are read as Parquet, the others as CSV.
+    batch_size: The number of rows of each batch.
+
+  Yields:
+    pandas DataFrames with compact dtypes.
+  """
+  with tempfile.TemporaryDirectory() as temp_dir:
+    local_path = path
+    if fileio.is_gcs_path(path):
+      local_path = os.path.join(temp_dir, os.path.basename(path))
+      fileio.copy(path, local_path)
+    if is_parquet(path):
+      for batch in _iter_parquet(local_path, batch_size):
+        yield batch
+    else:
+      for batch in pd.read_csv(
+          local_path, dtype=_csv_dtypes(), chunksize=batch_size):
+        yield batch
+
+
+@contextlib.contextmanager
+def local_copies(paths):
+  """Downloads the splits in GCS to a temporary directory.
+
+  The splits read several times, e.g. once per epoch, are downloaded only
+  once. The local splits are used in place.
+
+  Args:
+    paths: The paths or gs:// URIs of the splits.
+
+  Yields:
+    The local paths of the splits, in the same order.
+  """
+  with tempfile.TemporaryDirectory() as temp_dir:
+    local_paths = []
+    for i, path in enumerate(paths):
+      local_path = path
+      if fileio.is_gcs_path(path):
+        local_path = os.path.join(temp_dir, '{}-{}'.format(
+            i, os.path.basename(path)))
+        fileio.copy(path, local_path)
+      local_paths.append(local_path)
+    yield local_paths
+
+
+def _cache_path(cache_dir, path):
+  key = '{}|{}|{}'.format(CACHE_FORMAT_VERSION, path, fileio.version(path))
+  return fileio.join(cache_dir,
+                     hashlib.sha1(key.encode('utf-8')).hexdigest() + '.feather')
+
+
+def load_dataset(path, cache_dir=None):
+  """Loads a CSV split from a local path or GCS.
+
+  Args:
+    path: The path or the gs:// URI of the split. Splits with the .parquet
+      extension are read as Parquet, the others as CSV.
+    cache_dir: A local directory or a gs:// URI used to cache the parsed
+      CSV frames. The cache is used only if pyarrow is available.
+
+  Returns:
+    A pandas DataFrame with compact dtypes.
+  """
+  if is_parquet(path):
+    return _load_parquet(path)
+
+  cache_path = None
+  if cache_dir and pyarrow is not None:
+    cache_path = _cache_path(cache_dir, path)
+    if fileio.exists(cache_path):
+      print('Loading {} from the cache: {}'.format(path, cache_path))
+      return _read_feather(cache_path)
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    local_path = path
+    if fileio.is_gcs_path(path):
+      local_path = os.path.join(temp_dir, 'data.csv')
+      fileio.copy(path, local_path)
+    df = read_csv(local_path)
+
+    if cache_path:
+      local_cache_path = os.path.join(temp_dir, 'data.feather')
+      pyarrow.feather.write_feather(df, local_cache_path)
+      fileio.copy(local_cache_path, cache_path)
+      print('Cached {} in: {}'.format(path, cache_path))
+
+  return df
+
+
+def _load_parquet(path):
+  if not fileio.is_gcs_path(path):
+    return read_parquet(path)
+  with tempfile.TemporaryDirectory() as temp_dir:
+    local_path = os.path.join(temp_dir, 'data.parquet')
+    fileio.copy(path, local_path)
+    return read_parquet(local_path)
+
+
+def _read_feather(path):
+  if not fileio.is_gcs_path(path):
+    return pyarrow.feather.read_feather(path)
+  with tempfile.TemporaryDirectory() as temp_dir:
+    local_path = os.path.join(temp_dir, 'data.feather')
+    fileio.copy(path, local_path)
+    return pyarrow.feather.read_feather(local_path)
+
+
+def concat(frames):
+  """Concatenates splits keeping the categorical dtypes.
+
+  The categories of the splits are unified first, otherwise pandas would
+  fall back to the object dtype.
+  """
+  for feature in CATEGORICAL_FEATURES:
+    categories = pd.api.types.union_categoricals(
+        [df[feature] for df in frames]).categories
+    for df in frames:
+      df[feature] = df[feature].cat.set_categories(categories)
+  return pd.concat(frames, ignore_index=True, copy=False)
+
+
+def split_features(df):
+  """Returns the features and the labels of a split."""
+  return df.drop(LABEL, axis=1), df[LABEL]
@@ -0,0 +1,221 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Chunked evaluation of the Covertype Classifier.
+
+The testing split is streamed in batches and a confusion matrix is
+accumulated for the whole split and for every value of the slicing
+features. All the metrics are derived from the confusion matrices, so
+the split is read and predicted once.
+"""
+
+import re
+
+import numpy as np
+
+import data
+
+DEFAULT_BATCH_SIZE = 50000
+
+# The aliases of the averaged metrics. Covertype is a multiclass
+# problem, so the metrics are macro averaged by default.
+METRIC_ALIASES = {
+    'precision': 'precision_macro',
+    'recall': 'recall_macro',
+    'f1': 'f1_macro'
+}
+
+
+def _divide(numerator, denominator):
+  """Divides elementwise, returning 0 where the denominator is 0."""
+  numerator = np.asarray(numerator, dtype=np.float64)
+  denominator = np.asarray(denominator, dtype=np.float64)
+  return np.divide(
+      numerator,
+      denominator,
+      out=np.zeros_like(numerator),
+      where=denominator != 0)
+
+
+class ConfusionMatrix(object):
+  """A confusion matrix accumulated over batches.
+
+  The rows are the true labels and the columns the predicted labels.
+  Labels that were not known when the matrix was created are added as
+  they are seen.
+  """
+
+  def __init__(self, labels=()):
+    self.labels = []
+    self._index = {}
+    self.matrix = np.zeros((0, 0), dtype=np.int64)
+    self._add_labels(labels)
+
+  def _add_labels(self, labels):
+    new_labels = [label for label in labels if label not in self._index]
+    if not new_labels:
+      return
+    for label in new_labels:
+      self._index[label] = len(self.labels)
+      self.labels.append(label)
+    matrix = np.zeros((len(self.labels), len(self.labels)), dtype=np.int64)
+    matrix[:self.matrix.shape[0], :self.matrix.shape[1]] = self.matrix
+    self.matrix = matrix
+
+  def update(self, y_true, y_pred):
+    """Adds a batch of true and predicted labels."""
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
+    self._add_labels(np.unique(np.concatenate([y_true, y_pred])).tolist())
+
+    num_labels = len(self.labels)
+    true_index = np.array([self._index[label] for label in y_true.tolist()],
+                          dtype=np.int64)
+    pred_index = np.array([self._index[label] for label in y_pred.tolist()],
+                          dtype=np.int64)
+    self.matrix += np.bincount(
+        true_index * num_labels + pred_index,
+        minlength=num_labels * num_labels).reshape(num_labels, num_labels)
+
+  @property
+  def count(self):
+    return int(self.matrix.sum())
+
+  def metrics(self):
+    """Returns the averaged metrics.
+
+    Returns:
+      A dictionary with the accuracy and the macro and micro averaged
+      precision, recall and F1 score.
+    """
+    true_positives = np.diag(self.matrix)
+    predicted = self.matrix.sum(axis=0)
+    actual = self.matrix.sum(axis=1)
+    precision = _divide(true_positives, predicted)
+    recall = _divide(true_positives, actual)
+    f1 = _divide(2 * precision * recall, precision + recall)
+
+    # Every error is both a false positive and a false negative, so the
+    # micro averages are equal to the accuracy
+    accuracy = float(_divide(true_positives.sum(), self.count))
+    # The macro averages are over the classes present in the split
+    present = actual > 0
+    if not present.any():
+      present = np.ones_like(present)
+    return {
+        'accuracy': accuracy,
+        'precision_macro': float(precision[present].mean()),
+        'recall_macro': float(recall[present].mean()),
+        'f1_macro': float(f1[present].mean()),
+        'precision_micro': accuracy,
+        'recall_micro': accuracy,
+        'f1_micro': accuracy
+    }
+
+  def class_metrics(self):
+    """Returns a dictionary mapping the labels to their precision, recall,
+    F1 score and support."""
+    true_positives = np.diag(self.matrix)
+    precision = _divide(true_positives, self.matrix.sum(axis=0))
+    recall = _divide(true_positives, self.matrix.sum(axis=1))
+    f1 = _divide(2 * precision * recall, precision + recall)
+    support = self.matrix.sum(axis=1)
+    return {
+        label: {
+            'precision': float(precision[i]),
+            'recall': float(recall[i]),
+            'f1': float(f1[i]),
+            'support': int(support[i])
+        } for i, label in enumerate(self.labels)
+    }
+
+
+def evaluate(model, dataset_path, batch_size=DEFAULT_BATCH_SIZE,
+             slice_features=()):
+  """Evaluates a model on a split in batches.
+
+  Args:
+    model: The trained pipeline.
+    dataset_path: The path or the gs:// URI of the CSV or Parquet split.
+    batch_size: The number of rows predicted at a time.
+    slice_features: The names of the features to slice the split by.
+
+  Returns:
+    A tuple of the confusion matrix of the split and a dictionary mapping
+    each slicing feature to a dictionary of the confusion matrices of its
+    values.
+  """
+  labels = getattr(model, 'classes_', ())
+  overall = ConfusionMatrix(labels)
+  slices = {feature: {} for feature in slice_features}
+
+  for batch in data.iter_dataset(dataset_path, batch_size):
+    X, y = data.split_features(batch)
+    y_true = y.values
+    y_pred = model.predict(X)
+    overall.update(y_true, y_pred)
+
+    for feature in slice_features:
+      values = X[feature].astype(str).values
+      for value in np.unique(values):
+        mask = values == value
+        if value not in slices[feature]:
+          slices[feature][value] = ConfusionMatrix(labels)
+        slices[feature][value].update(y_true[mask], y_pred[mask])
+
+  return overall, slices
+
+
+def metric_value(confusion_matrix, metric_name):
+  """Returns a metric of a confusion matrix, or None if it is unknown."""
+  metric_name = METRIC_ALIASES.get(metric_name, metric_name)
+  return confusion_matrix.metrics().get(metric_name)
+
+
+def _kfp_metric_name(*parts):
+  """Converts to a KFP metric name, i.e. lowercase letters, digits and
+  dashes, starting with a letter."""
+  name = re.sub(r'[^a-z0-9]+', '-', '-'.join(str(part) for part in parts)
+                .lower()).strip('-')
+  if not name or not name[0].isalpha():
+    name = 'm-' + name
+  return name[:63].rstrip('-')
+
+
+def kfp_metrics(overall, slices):
+  """Returns the KFP metrics of an evaluation.
+
+  The metrics are the averaged metrics and the per class metrics of the
+  split and the accuracy and the macro F1 score of each slice.
+  """
+  metrics = []
+
+  def add(value, *name_parts):
+    metrics.append({
+        'name': _kfp_metric_name(*name_parts),
+        'numberValue': float(value),
+        'format': 'RAW'
+    })
+
+  for name, value in sorted(overall.metrics().items()):
+    add(value, name)
+  for label, class_metrics in sorted(overall.class_metrics().items()):
+    for name in ['precision', 'recall', 'f1']:
+      add(class_metrics[name], 'class', label, name)
+  for feature, values in sorted(slices.items()):
+    for value, confusion_matrix in sorted(values.items()):
+      slice_metrics = confusion_matrix.metrics()
+      for name in ['accuracy', 'f1_macro']:
+        add(slice_metrics[name], feature, value, name)
+  return metrics
@@ -0,0 +1,146 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""File utilities working with local paths and GCS URIs."""
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+
+GCS_PREFIX = 'gs://'
+
+_storage_client = None
+
+
+def is_gcs_path(path):
+  return path.startswith(GCS_PREFIX)
+
+
+def _get_blob(path):
+  """Returns the GCS blob of a gs:// URI."""
+  global _storage_client
+  from google.cloud import storage
+
+  if _storage_client is None:
+    _storage_client = storage.Client()
+  bucket_name, blob_name = path[len(GCS_PREFIX):].split('/', 1)
+  return _storage_client.bucket(bucket_name).blob(blob_name)
+
+
+def join(path, *paths):
+  if is_gcs_path(path):
+    return '/'.join([path.rstrip('/')] + list(paths))
+  return os.path.join(path, *paths)
+
+
+def exists(path):
+  if is_gcs_path(path):
+    return _get_blob(path).exists()
+  return os.path.exists(path)
+
+
+def version(path):
+  """Returns a string identifying the version of a file's content.
+
+  The version is the generation of a GCS object or the modification time
+  and size of a local file.
+  """
+  if is_gcs_path(path):
+    blob = _get_blob(path)
+    blob.reload()
+    return 'generation={}'.format(blob.generation)
+  stat = os.stat(path)
+  return 'mtime={},size={}'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def copy(source_path, destination_path):
+  """Copies a file between local paths and GCS."""
+  if is_gcs_path(source_path) and is_gcs_path(destination_path):
+    source_blob = _get_blob(source_path)
+    destination_blob = _get_blob(destination_path)
+    source_blob.bucket.copy_blob(source_blob, destination_blob.bucket,
+                                 destination_blob.name)
+  elif is_gcs_path(source_path):
+    _get_blob(source_path).download_to_filename(destination_path)
+  elif is_gcs_path(destination_path):
+    _get_blob(destination_path).upload_from_filename(source_path)
+  else:
+    with open_file(destination_path, 'wb') as destination_file:
+      with open(source_path, 'rb') as source_file:
+        shutil.copyfileobj(source_file, destination_file)
+
+
+def _umask():
+  """Returns the umask of the process, which can only be read by setting it."""
+  mask = os.umask(0)
+  os.umask(mask)
+  return mask
+
+
+@contextlib.contextmanager
+def open_file(path, mode='rb'):
+  """Opens a local file or a GCS object as a binary file object.
+
+  GCS objects are streamed if the client library supports it, otherwise
+  they are buffered in memory. Local files are written to a temporary
+  file in the same directory, which replaces the file when it is closed,
+  so that concurrent readers never see a partially written file.
+
+  Args:
+    path: The path or the gs:// URI of the file.
+    mode: 'rb' or 'wb'.
+
+  Yields:
+    A binary file object.
+  """
+  if mode not in ('rb', 'wb'):
+    raise ValueError('Unsupported mode: {}'.format(mode))
+
+  if not is_gcs_path(path) and mode == 'rb':
+    with open(path, mode) as f:
+      yield f
+    return
+
+  if not is_gcs_path(path):
+    dirname = os.path.dirname(path)
+    if dirname:
+      os.makedirs(dirname, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=dirname or None, prefix='.tmp-')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        yield f
+      # mkstemp creates the file readable by its owner only
+      os.chmod(temp_path, 0o666 & ~_umask())
+      os.replace(temp_path, path)
+    finally:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+    return
+
+  blob = _get_blob(path)
+  if hasattr(blob, 'open'):
+    with blob.open(mode) as f:
+      yield f
+  elif mode == 'rb':
+    buffer = io.BytesIO()
+    blob.download_to_file(buffer)
+    buffer.seek(0)
+    yield buffer
+  else:
+    buffer = io.BytesIO()
+    yield buffer
+    buffer.seek(0)
+    blob.upload_from_file(buffer)
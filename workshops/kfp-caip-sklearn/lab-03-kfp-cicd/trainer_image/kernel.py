@@ -0,0 +1,250 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Flat NumPy inference kernel of the Covertype Classifier.
+
+The fitted pipeline is a scaler and a one-hot encoder followed by a
+linear classifier, so its decision function is linear in the raw
+features. The kernel folds the scaler statistics into the coefficients
+of the numeric features and turns the coefficients of the one-hot
+columns into one weight table per categorical feature, indexed by the
+position of the category. A prediction is then one matrix product, one
+table lookup per categorical feature and an argmax, without the Python
+overhead of the Pipeline and ColumnTransformer objects.
+
+The unknown categories, which the encoder ignores, are mapped to a last
+row of zeros of the weight tables.
+"""
+
+import numpy as np
+from sklearn.preprocessing import OneHotEncoder
+from sklearn.preprocessing import StandardScaler
+
+import fileio
+
+KERNEL_FILENAME = 'kernel.npz'
+
+
+def kernel_path(model_dir):
+  return fileio.join(model_dir, KERNEL_FILENAME)
+
+
+def _category_index(categories):
+  """Returns the categories as sorted strings and their positions."""
+  categories = np.asarray([str(category) for category in categories])
+  order = np.argsort(categories, kind='stable')
+  return categories[order], order
+
+
+class LinearKernel(object):
+  """The compiled decision function of a linear pipeline.
+
+  Args:
+    numeric_columns: The names of the numeric features.
+    numeric_weights: The coefficients of the numeric features with the
+      scaling folded in, of shape (len(numeric_columns), num_scores).
+    categorical_columns: The names of the categorical features.
+    categories: For each categorical feature, the array of its
+      categories in the order of the one-hot columns.
+    tables: For each categorical feature, the coefficients of its
+      categories, of shape (len(categories) + 1, num_scores). The last
+      row, for the unknown categories, is zero.
+    intercept: The intercept with the scaling folded in, of shape
+      (num_scores,).
+    classes: The class labels. There is a single score for two classes.
+  """
+
+  def __init__(self, numeric_columns, numeric_weights, categorical_columns,
+               categories, tables, intercept, classes):
+    self.numeric_columns = list(numeric_columns)
+    self.numeric_weights = np.asarray(numeric_weights, dtype=np.float64)
+    self.categorical_columns = list(categorical_columns)
+    self.categories = [np.asarray(values) for values in categories]
+    self.tables = [np.asarray(table, dtype=np.float64) for table in tables]
+    self.intercept = np.asarray(intercept, dtype=np.float64)
+    self.classes = np.asarray(classes)
+    self._index = [_category_index(values) for values in self.categories]
+
+  @property
+  def columns(self):
+    """The order of the features of the instances given as lists."""
+    return self.numeric_columns + self.categorical_columns
+
+  def _lookup(self, i, values):
+    """Returns the rows of the weight table of the values of a feature."""
+    sorted_categories, order = self._index[i]
+    unknown = len(order)
+    values = np.asarray(values).astype(str)
+    if not len(sorted_categories):
+      return np.full(len(values), unknown)
+    position = np.searchsorted(sorted_categories, values)
+    position = np.minimum(position, unknown - 1)
+    found = sorted_categories[position] == values
+    return np.where(found, order[position], unknown)
+
+  def _rows(self, i, column):
+    # The categories of a pandas categorical column are looked up once
+    # and its codes are mapped to the rows, -1 being a missing value
+    if hasattr(column, 'cat'):
+      rows = np.append(
+          self._lookup(i, column.cat.categories), len(self._index[i][1]))
+      return rows[column.cat.codes.values]
+    return self._lookup(i, column)
+
+  def decision_function(self, X):
+    """Returns the scores of the instances.
+
+    Args:
+      X: A DataFrame with the feature columns, or a list of instances with
+        the features in the order of the columns property.
+
+    Returns:
+      An array of shape (num_instances, num_scores).
+    """
+    if hasattr(X, 'columns'):
+      numeric = X[self.numeric_columns].values
+      categorical = [X[column] for column in self.categorical_columns]
+    else:
+      X = np.asarray(X, dtype=object)
+      if X.ndim == 1:
+        X = X.reshape(1, -1)
+      num_numeric = len(self.numeric_columns)
+      numeric = X[:, :num_numeric]
+      categorical = [
+          X[:, num_numeric + i] for i in range(len(self.categorical_columns))
+      ]
+
+    scores = np.asarray(numeric, dtype=np.float64).dot(self.numeric_weights)
+    scores += self.intercept
+    for i, column in enumerate(categorical):
+      scores += self.tables[i][self._rows(i, column)]
+    return scores
+
+  def predict(self, X):
+    """Returns the predicted classes of the instances."""
+    scores = self.decision_function(X)
+    if scores.shape[1] == 1:
+      return self.classes[(scores[:, 0] > 0).astype(np.int64)]
+    return self.classes[scores.argmax(axis=1)]
+
+  def save(self, model_dir):
+    """Saves the kernel in a local directory or a gs:// URI.
+
+    Returns:
+      The path of the saved kernel.
+    """
+    arrays = {
+        'numeric_columns': np.asarray(self.numeric_columns),
+        'numeric_weights': self.numeric_weights,
+        'categorical_columns': np.asarray(self.categorical_columns),
+        'intercept': self.intercept,
+        'classes': self.classes
+    }
+    for i, (values, table) in enumerate(zip(self.categories, self.tables)):
+      arrays['categories_{}'.format(i)] = np.asarray(
+          [str(value) for value in values])
+      arrays['table_{}'.format(i)] = table
+
+    path = kernel_path(model_dir)
+    with fileio.open_file(path, 'wb') as f:
+      np.savez(f, **arrays)
+    return path
+
+
+def load_kernel(model_dir):
+  """Loads a kernel from a local directory or a gs:// URI."""
+  with fileio.open_file(kernel_path(model_dir), 'rb') as f:
+    arrays = dict(np.load(f, allow_pickle=False))
+  categorical_columns = arrays['categorical_columns'].tolist()
+  features = range(len(categorical_columns))
+  return LinearKernel(
+      arrays['numeric_columns'].tolist(), arrays['numeric_weights'],
+      categorical_columns,
+      [arrays['categories_{}'.format(i)] for i in features],
+      [arrays['table_{}'.format(i)] for i in features], arrays['intercept'],
+      arrays['classes'])
+
+
+def compile_pipeline(pipeline):
+  """Compiles a fitted Covertype Classifier pipeline into a kernel.
+
+  Args:
+    pipeline: A fitted Pipeline of a ColumnTransformer of StandardScaler
+      and OneHotEncoder transformers, followed by a linear classifier.
+
+  Returns:
+    A LinearKernel with the same predictions as the pipeline.
+
+  Raises:
+    ValueError: If the pipeline has other steps.
+  """
+  preprocessor = pipeline.named_steps['preprocessor']
+  classifier = pipeline.named_steps['classifier']
+  # The coefficients of the transformed columns, one row per column
+  coef = np.asarray(classifier.coef_, dtype=np.float64).T
+  intercept = np.array(classifier.intercept_, dtype=np.float64)
+
+  numeric_columns = []
+  numeric_weights = []
+  categorical_columns = []
+  categories = []
+  tables = []
+  offset = 0
+  for name, transformer, columns in preprocessor.transformers_:
+    if isinstance(transformer, str) and transformer == 'drop':
+      continue
+    if isinstance(transformer, StandardScaler):
+      weights = coef[offset:offset + len(columns)]
+      offset += len(columns)
+      mean = transformer.mean_
+      if mean is None:
+        mean = np.zeros(len(columns))
+      scale = transformer.scale_
+      if scale is None:
+        scale = np.ones(len(columns))
+      # w * (x - mean) / scale = (w / scale) * x - w * mean / scale
+      weights = weights / scale[:, np.newaxis]
+      intercept -= mean.dot(weights)
+      numeric_columns += list(columns)
+      numeric_weights.append(weights)
+    elif isinstance(transformer, OneHotEncoder):
+      for column, column_categories in zip(columns, transformer.categories_):
+        table = coef[offset:offset + len(column_categories)]
+        offset += len(column_categories)
+        categorical_columns.append(column)
+        categories.append(column_categories)
+        tables.append(np.vstack([table, np.zeros((1, coef.shape[1]))]))
+    else:
+      raise ValueError('Cannot compile the {} transformer: {}'.format(
+          name, type(transformer).__name__))
+
+  if offset != coef.shape[0]:
+    raise ValueError('The classifier has {} coefficients, expected {}'.format(
+        coef.shape[0], offset))
+
+  if numeric_weights:
+    numeric_weights = np.vstack(numeric_weights)
+  else:
+    numeric_weights = np.zeros((0, coef.shape[1]))
+  return LinearKernel(numeric_columns, numeric_weights, categorical_columns,
+                      categories, tables, intercept, classifier.classes_)
+
+
+def export_kernel(pipeline, model_dir):
+  """Compiles a pipeline and saves its kernel next to the model.
+
+  Returns:
+    The path of the saved kernel.
+  """
+  return compile_pipeline(pipeline).save(model_dir)
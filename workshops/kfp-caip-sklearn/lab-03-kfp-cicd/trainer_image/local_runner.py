@@ -0,0 +1,185 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs the Covertype training pipeline on the local machine.
+
+The steps mirror the KFP pipeline: the splits are created by the local
+engine from a CSV file standing in for the source table, the
+hyperparameter trials run as independent steps, and the best trial is
+trained on the combined training and validation splits and evaluated.
+Independent steps run in parallel, and all the steps use the same step
+cache as the pipeline, so the runner exercises the cache logic without
+a cluster:
+
+  python local_runner.py --source_path covertype.csv --root /tmp/covertype
+"""
+
+import concurrent.futures
+import itertools
+import time
+
+import fire
+
+import artifacts
+import evaluation
+import fileio
+import search
+import splits
+import step_cache
+import train
+
+
+class LocalRunner(object):
+  """Runs a DAG of steps, each step as soon as its dependencies finished.
+
+  Args:
+    max_workers: The maximum number of steps running at a time.
+  """
+
+  def __init__(self, max_workers=None):
+    self.max_workers = max_workers
+    self.durations = {}
+
+  def run(self, steps):
+    """Runs the steps.
+
+    Args:
+      steps: A dictionary mapping the step names to tuples of a function
+        and the list of the names of the steps it depends on. The
+        function is called with the outputs of the dependencies, in order.
+
+    Returns:
+      A dictionary mapping the step names to their outputs.
+    """
+    outputs = {}
+    pending = dict(steps)
+    running = {}
+
+    def run_step(name, function, args):
+      start_time = time.time()
+      result = function(*args)
+      self.durations[name] = time.time() - start_time
+      return result
+
+    with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+      while pending or running:
+        for name, (function, dependencies) in list(pending.items()):
+          if all(dependency in outputs for dependency in dependencies):
+            del pending[name]
+            args = [outputs[dependency] for dependency in dependencies]
+            running[executor.submit(run_step, name, function, args)] = name
+        if not running:
+          raise ValueError('Unsatisfiable dependencies: {}'.format(
+              sorted(pending)))
+
+        done, _ = concurrent.futures.wait(
+            running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          outputs[running.pop(future)] = future.result()
+    return outputs
+
+
+def run_pipeline(source_path, root, alphas=None, max_iters=None,
+                 evaluation_metric_name='accuracy', dataset_format='csv',
+                 use_cache=True, max_workers=None):
+  """Runs the pipeline locally.
+
+  Args:
+    source_path: The CSV file standing in for the source table.
+    root: The local directory or gs:// URI of the pipeline files.
+    alphas: The alpha values of the trials.
+    max_iters: The max_iter values of the trials.
+    evaluation_metric_name: The name of the metric to report.
+    dataset_format: The format of the splits, csv or parquet.
+    use_cache: Whether to use the step cache in root/cache/steps.
+    max_workers: The maximum number of steps running at a time.
+
+  Returns:
+    The value of the evaluation metric.
+  """
+  step_cache_dir = None
+  if use_cache:
+    step_cache_dir = fileio.join(root, 'cache', 'steps')
+  dataset_cache_dir = fileio.join(root, 'datasets', 'cache')
+  output_paths = {
+      split: fileio.join(root, 'datasets', split, 'data.' + dataset_format)
+      for split in splits.SPLIT_LOTS
+  }
+  candidates = list(
+      itertools.product(alphas or search.DEFAULT_ALPHAS, max_iters or
+                        search.DEFAULT_MAX_ITERS))
+
+  def create_splits():
+    return splits.create_splits(
+        splits.LocalEngine({'source': source_path}),
+        'source',
+        output_paths,
+        cache=step_cache.StepCache(step_cache_dir) if use_cache else None)
+
+  def trial(alpha, max_iter):
+
+    def run_trial(split_paths):
+      return train.run_training(
+          fileio.join(root, 'jobdir', 'hypertune'),
+          split_paths['training'],
+          split_paths['validation'],
+          alpha=alpha,
+          max_iter=max_iter,
+          hptune=True,
+          cache_dir=dataset_cache_dir,
+          step_cache_dir=step_cache_dir)
+
+    return run_trial
+
+  def train_best(split_paths, *accuracies):
+    best_accuracy, alpha, max_iter = max(
+        (accuracy, alpha, max_iter)
+        for accuracy, (alpha, max_iter) in zip(accuracies, candidates))
+    print('Best trial: alpha={}, max_iter={}, accuracy={}'.format(
+        alpha, max_iter, best_accuracy))
+    job_dir = fileio.join(root, 'jobdir', 'model')
+    train.run_training(
+        job_dir,
+        split_paths['training'],
+        split_paths['validation'],
+        alpha=alpha,
+        max_iter=max_iter,
+        hptune=False,
+        cache_dir=dataset_cache_dir,
+        step_cache_dir=step_cache_dir)
+    return job_dir
+
+  def evaluate(split_paths, job_dir):
+    overall, _ = evaluation.evaluate(
+        artifacts.load_model(job_dir), split_paths['testing'])
+    return evaluation.metric_value(overall, evaluation_metric_name)
+
+  trial_steps = ['trial-{}'.format(i) for i in range(len(candidates))]
+  steps = {'create-splits': (create_splits, [])}
+  for name, (alpha, max_iter) in zip(trial_steps, candidates):
+    steps[name] = (trial(alpha, max_iter), ['create-splits'])
+  steps['train'] = (train_best, ['create-splits'] + trial_steps)
+  steps['evaluate'] = (evaluate, ['create-splits', 'train'])
+
+  runner = LocalRunner(max_workers)
+  outputs = runner.run(steps)
+
+  for name in steps:
+    print('{:<16} {:8.2f}s'.format(name, runner.durations[name]))
+  print('{}: {}'.format(evaluation_metric_name, outputs['evaluate']))
+  return outputs['evaluate']
+
+
+if __name__ == '__main__':
+  fire.Fire(run_pipeline)
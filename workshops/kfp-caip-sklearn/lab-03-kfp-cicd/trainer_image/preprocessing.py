@@ -0,0 +1,153 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Preprocessing of the Covertype splits.
+
+The hypertune trials fit the same preprocessor on the same training data,
+so the fitted preprocessor and the transformed splits are cached. The
+cache entries are keyed by a fingerprint of the preprocessor
+configuration and of the paths and versions of the splits.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+import numpy as np
+from scipy import sparse
+import sklearn
+from sklearn.compose import ColumnTransformer
+from sklearn.preprocessing import OneHotEncoder
+from sklearn.preprocessing import StandardScaler
+
+import data
+import fileio
+
+CACHE_FORMAT_VERSION = 1
+
+PREPROCESSOR_FILENAME = 'preprocessor.pkl'
+
+
+def make_preprocessor():
+  """Returns the unfitted preprocessor of the Covertype features.
+
+  The categories not seen in the training splits, e.g. in the validation
+  split or in the serving requests, are encoded as zeros.
+  """
+  return ColumnTransformer(transformers=[(
+      'num', StandardScaler(), data.NUMERIC_FEATURES), (
+          'cat', OneHotEncoder(handle_unknown='ignore'),
+          data.CATEGORICAL_FEATURES)])
+
+
+def fingerprint(training_dataset_paths, validation_dataset_path=None):
+  """Returns the cache key of the preprocessed splits."""
+  key = [
+      str(CACHE_FORMAT_VERSION), sklearn.__version__,
+      repr(make_preprocessor())
+  ]
+  for path in training_dataset_paths:
+    key.append('train={}|{}'.format(path, fileio.version(path)))
+  if validation_dataset_path:
+    key.append('validation={}|{}'.format(
+        validation_dataset_path, fileio.version(validation_dataset_path)))
+  return hashlib.sha1('\n'.join(key).encode('utf-8')).hexdigest()
+
+
+def _transform(preprocessor, df):
+  X, y = data.split_features(df)
+  return sparse.csr_matrix(preprocessor.transform(X)), y.values
+
+
+def _save(cache_path, preprocessor, splits):
+  """Saves a cache entry. The preprocessor is written last, so that
+  an entry is complete when its preprocessor exists."""
+  with tempfile.TemporaryDirectory() as temp_dir:
+    filenames = []
+    for name, (X, y) in splits.items():
+      sparse.save_npz(
+          os.path.join(temp_dir, name + '.npz'), X, compressed=False)
+      np.save(os.path.join(temp_dir, name + '_labels.npy'), y)
+      filenames += [name + '.npz', name + '_labels.npy']
+    with open(os.path.join(temp_dir, PREPROCESSOR_FILENAME), 'wb') as f:
+      pickle.dump(preprocessor, f)
+    filenames.append(PREPROCESSOR_FILENAME)
+
+    for filename in filenames:
+      fileio.copy(
+          os.path.join(temp_dir, filename), fileio.join(cache_path, filename))
+
+
+def _load(cache_path, names):
+  with tempfile.TemporaryDirectory() as temp_dir:
+
+    def local(filename):
+      local_path = os.path.join(temp_dir, filename)
+      fileio.copy(fileio.join(cache_path, filename), local_path)
+      return local_path
+
+    with open(local(PREPROCESSOR_FILENAME), 'rb') as f:
+      preprocessor = pickle.load(f)
+    splits = {
+        name: (sparse.load_npz(local(name + '.npz')),
+               np.load(local(name + '_labels.npy'))) for name in names
+    }
+  return preprocessor, splits
+
+
+def load_preprocessed(training_dataset_paths,
+                      validation_dataset_path=None,
+                      cache_dir=None):
+  """Returns the fitted preprocessor and the transformed splits.
+
+  The preprocessor is fitted on the concatenated training splits.
+
+  Args:
+    training_dataset_paths: The paths or gs:// URIs of the training splits.
+    validation_dataset_path: The path or the gs:// URI of the validation
+      split, which is transformed but not used for fitting.
+    cache_dir: A local directory or a gs:// URI of the cache.
+
+  Returns:
+    A tuple of the fitted preprocessor and a dictionary mapping 'train'
+    and, if a validation split is given, 'validation' to tuples of a CSR
+    feature matrix and a label array.
+  """
+  names = ['train'] + (['validation'] if validation_dataset_path else [])
+  cache_path = None
+  if cache_dir:
+    cache_path = fileio.join(
+        cache_dir, 'preprocessed',
+        fingerprint(training_dataset_paths, validation_dataset_path))
+    if fileio.exists(fileio.join(cache_path, PREPROCESSOR_FILENAME)):
+      print('Loading the preprocessed splits from the cache: {}'.format(
+          cache_path))
+      return _load(cache_path, names)
+
+  df_train = data.concat(
+      [data.load_dataset(path, cache_dir) for path in training_dataset_paths])
+  preprocessor = make_preprocessor()
+  X_train, y_train = data.split_features(df_train)
+  preprocessor.fit(X_train)
+  splits = {'train': _transform(preprocessor, df_train)}
+  del df_train, X_train, y_train
+  if validation_dataset_path:
+    splits['validation'] = _transform(
+        preprocessor, data.load_dataset(validation_dataset_path, cache_dir))
+
+  if cache_path:
+    _save(cache_path, preprocessor, splits)
+    print('Cached the preprocessed splits in: {}'.format(cache_path))
+  return preprocessor, splits
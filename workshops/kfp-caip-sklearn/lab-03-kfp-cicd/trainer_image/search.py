@@ -0,0 +1,272 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local parallel hyperparameter search for the Covertype Classifier.
+
+The splits are loaded and preprocessed once, or read from the
+preprocessing cache. The preprocessed matrices are written to
+memory-mapped files on a tmpfs, which the worker processes map without
+copying, and the alpha and max_iter candidates are evaluated in parallel
+with successive halving: every round trains the remaining candidates on
+a larger prefix of the shuffled training rows and keeps the best 1/eta
+of them, until the last round uses all the rows.
+
+The trial report has the shape of the AI Platform job returned by
+jobs.get, so it can be read the same way as the Hypertune trials.
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy import sparse
+from sklearn.linear_model import SGDClassifier
+
+import fileio
+import preprocessing
+
+DEFAULT_ALPHAS = [0.0001, 0.0004, 0.0007, 0.001]
+DEFAULT_MAX_ITERS = [500, 1000]
+DEFAULT_ETA = 2
+MIN_ROUND_ROWS = 1000
+METRIC_TAG = 'accuracy'
+SHARED_MEMORY_DIR = '/dev/shm'
+
+_ARRAYS = [
+    'train_data', 'train_indices', 'train_indptr', 'train_labels',
+    'validation_data', 'validation_indices', 'validation_indptr',
+    'validation_labels'
+]
+
+# The shared matrices mapped by a worker process
+_shared = {}
+
+
+def _preprocess(training_dataset_path, validation_dataset_path, cache_dir,
+                seed):
+  """Returns the preprocessed splits as CSR matrices and label arrays.
+
+  The training rows are shuffled, so that the prefixes used by the
+  successive halving rounds are random samples.
+  """
+  _, splits = preprocessing.load_preprocessed([training_dataset_path],
+                                              validation_dataset_path,
+                                              cache_dir)
+  X_train, y_train = splits['train']
+  X_validation, y_validation = splits['validation']
+  order = np.random.RandomState(seed).permutation(X_train.shape[0])
+  return X_train[order], y_train[order], X_validation, y_validation
+
+
+def _share(directory, X_train, y_train, X_validation, y_validation):
+  """Writes the matrices to memory-mapped files.
+
+  Returns:
+    A dictionary of the shapes and dtypes of the arrays.
+  """
+  arrays = dict(
+      zip(_ARRAYS, [
+          X_train.data, X_train.indices, X_train.indptr, y_train,
+          X_validation.data, X_validation.indices, X_validation.indptr,
+          y_validation
+      ]))
+  layout = {}
+  for name, array in arrays.items():
+    shared_array = np.memmap(
+        os.path.join(directory, name),
+        dtype=array.dtype,
+        mode='w+',
+        shape=array.shape)
+    shared_array[:] = array
+    shared_array.flush()
+    layout[name] = (array.dtype.str, array.shape)
+  layout['num_features'] = X_train.shape[1]
+  return layout
+
+
+def _attach(directory, layout):
+  """Maps the shared matrices in a worker process."""
+  arrays = {}
+  for name in _ARRAYS:
+    dtype, shape = layout[name]
+    # The pages are copied on write only
+    arrays[name] = np.memmap(
+        os.path.join(directory, name), dtype=dtype, mode='c', shape=shape)
+  _shared.update(arrays)
+  _shared['num_features'] = layout['num_features']
+
+
+def _rows(prefix, num_rows):
+  """Returns the first rows of a shared CSR matrix without copying."""
+  indptr = _shared[prefix + '_indptr'][:num_rows + 1]
+  end = indptr[-1]
+  return sparse.csr_matrix(
+      (_shared[prefix + '_data'][:end], _shared[prefix + '_indices'][:end],
+       indptr),
+      shape=(num_rows, _shared['num_features']),
+      copy=False)
+
+
+def _evaluate(args):
+  """Trains a candidate on the training prefix and scores it."""
+  alpha, max_iter, num_rows, seed = args
+  classifier = SGDClassifier(
+      loss='log', alpha=alpha, max_iter=max_iter, random_state=seed)
+  classifier.fit(
+      _rows('train', num_rows), _shared['train_labels'][:num_rows])
+  num_validation_rows = len(_shared['validation_labels'])
+  return classifier.score(
+      _rows('validation', num_validation_rows), _shared['validation_labels'])
+
+
+def _round_sizes(num_candidates, num_rows, eta):
+  """Returns the number of training rows of each round."""
+  num_rounds = 1
+  while eta**num_rounds < num_candidates:
+    num_rounds += 1
+  return [
+      max(min(num_rows, MIN_ROUND_ROWS), num_rows // eta**(num_rounds - i - 1))
+      for i in range(num_rounds)
+  ]
+
+
+def successive_halving(candidates, num_rows, pool, eta=DEFAULT_ETA, seed=0):
+  """Evaluates the candidates with successive halving.
+
+  Args:
+    candidates: A list of (alpha, max_iter) tuples.
+    num_rows: The number of training rows.
+    pool: The worker pool mapped to the shared matrices.
+    eta: The inverse of the fraction of the candidates kept each round.
+    seed: The random seed of the classifiers.
+
+  Returns:
+    A list of trial dictionaries, one per candidate, with the index of the
+    last round of the candidate, the rows it was trained on and its score.
+  """
+  trials = [{
+      'alpha': alpha,
+      'max_iter': max_iter,
+      'round': None,
+      'rows': None,
+      'score': None
+  } for alpha, max_iter in candidates]
+  remaining = list(range(len(trials)))
+  round_sizes = _round_sizes(len(trials), num_rows, eta)
+
+  for round_index, round_rows in enumerate(round_sizes):
+    scores = pool.map(_evaluate,
+                      [(trials[i]['alpha'], trials[i]['max_iter'], round_rows,
+                        seed) for i in remaining])
+    for i, score in zip(remaining, scores):
+      trials[i].update(round=round_index, rows=round_rows, score=score)
+    print('Round {}/{}: {} candidates on {} rows, best accuracy={:.4f}'.format(
+        round_index + 1, len(round_sizes), len(remaining), round_rows,
+        max(scores)))
+
+    remaining.sort(key=lambda i: trials[i]['score'], reverse=True)
+    remaining = remaining[:max(1, len(remaining) // eta)]
+
+  return trials
+
+
+def trial_report(trials, num_rounds):
+  """Returns the trials in the shape of an AI Platform Hypertune job.
+
+  The trials are sorted best first. Candidates that reached a later round
+  rank above the ones stopped earlier, whose scores were computed on
+  fewer training rows.
+  """
+  ranked = sorted(
+      enumerate(trials),
+      key=lambda item: (item[1]['round'], item[1]['score']),
+      reverse=True)
+  return {
+      'trainingOutput': {
+          'isHyperparameterTuningJob': True,
+          'hyperparameterMetricTag': METRIC_TAG,
+          'completedTrialCount': str(len(trials)),
+          'trials': [{
+              'trialId': str(index + 1),
+              'hyperparameters': {
+                  'alpha': str(trial['alpha']),
+                  'max_iter': str(trial['max_iter'])
+              },
+              'finalMetric': {
+                  'trainingStep': str(trial['rows']),
+                  'objectiveValue': trial['score']
+              },
+              'isTrialStoppedEarly': trial['round'] < num_rounds - 1,
+              'state': 'SUCCEEDED'
+          } for index, trial in ranked]
+      }
+  }
+
+
+def search(training_dataset_path, validation_dataset_path, report_path,
+           alphas=None, max_iters=None, num_workers=None, eta=DEFAULT_ETA,
+           cache_dir=None, seed=0):
+  """Searches the alpha and max_iter grid on the local machine.
+
+  Args:
+    training_dataset_path: The path or the gs:// URI of the training split.
+    validation_dataset_path: The path or the gs:// URI of the validation
+      split.
+    report_path: The path or the gs:// URI of the JSON trial report.
+    alphas: The candidate alpha values.
+    max_iters: The candidate max_iter values.
+    num_workers: The number of worker processes, by default the number of
+      CPUs.
+    eta: The inverse of the fraction of the candidates kept each round.
+    cache_dir: The dataset cache directory.
+    seed: The random seed of the shuffling and the classifiers.
+
+  Returns:
+    The trial report.
+  """
+  candidates = list(
+      itertools.product(alphas or DEFAULT_ALPHAS, max_iters or
+                        DEFAULT_MAX_ITERS))
+  matrices = _preprocess(training_dataset_path, validation_dataset_path,
+                         cache_dir, seed)
+  num_rows = matrices[0].shape[0]
+
+  print('Searching {} candidates on {} rows'.format(len(candidates), num_rows))
+  shared_dir = tempfile.mkdtemp(
+      dir=SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else None)
+  try:
+    layout = _share(shared_dir, *matrices)
+    del matrices
+    with multiprocessing.Pool(
+        num_workers, initializer=_attach,
+        initargs=(shared_dir, layout)) as pool:
+      trials = successive_halving(candidates, num_rows, pool, eta, seed)
+  finally:
+    shutil.rmtree(shared_dir, ignore_errors=True)
+
+  num_rounds = len(_round_sizes(len(candidates), num_rows, eta))
+  report = trial_report(trials, num_rounds)
+  best_trial = report['trainingOutput']['trials'][0]
+  print('Best trial: {}, accuracy={:.4f}'.format(
+      best_trial['hyperparameters'],
+      best_trial['finalMetric']['objectiveValue']))
+
+  with fileio.open_file(report_path, 'wb') as report_file:
+    report_file.write(json.dumps(report, indent=2).encode('utf-8'))
+  print('Saved the trial report in: {}'.format(report_path))
+  return report
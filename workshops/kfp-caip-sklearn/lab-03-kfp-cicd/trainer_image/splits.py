@@ -0,0 +1,262 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Creation of the Covertype splits in a single pass over the source.
+
+The rows are assigned to lots by the fingerprint of their JSON
+representation, and the splits are sets of lots. The BigQuery engine
+runs a script that scans and hashes the source table once into a
+temporary table clustered by lot, creates the split tables from it, and
+extracts them to GCS. Extract jobs are not billed, and the clustering
+limits the bytes read by the split queries to the rows of the splits.
+The split tables are suffixed with a run ID, so that concurrent runs do
+not overwrite each other, and are dropped after the extraction.
+
+The local engine applies the same lot assignment to CSV files standing
+in for the source tables, so that the splitting can run without
+BigQuery. Its fingerprint function differs from FARM_FINGERPRINT, so the
+rows of its splits differ from the BigQuery ones.
+
+The splits are written as CSV files, or as Snappy compressed Parquet
+files if their paths have the .parquet extension. If a step cache is
+given, the splits are created only if the query, the source table or the
+code changed since they were last created.
+"""
+
+import collections
+import hashlib
+import json
+import uuid
+
+import pandas as pd
+
+import data
+import fileio
+import step_cache
+
+NUM_LOTS = 10
+
+# The split tables left by a failed run expire after this many hours
+SPLIT_TABLE_EXPIRATION_HOURS = 24
+
+SPLIT_LOTS = collections.OrderedDict([('training', [1, 2, 3, 4]),
+                                      ('validation', [8]), ('testing', [9])])
+
+SPLIT_SCRIPT_TEMPLATE = """
+CREATE TEMP TABLE lots
+CLUSTER BY lot
+AS
+SELECT *
+FROM (
+  SELECT cover.*,
+         MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(cover))), {num_lots}) AS lot
+  FROM `{source_table}` AS cover)
+WHERE lot IN ({all_lots});
+{split_statements}
+"""
+
+SPLIT_STATEMENT_TEMPLATE = """
+CREATE OR REPLACE TABLE `{table}`
+OPTIONS (
+  expiration_timestamp = TIMESTAMP_ADD(CURRENT_TIMESTAMP(),
+                                       INTERVAL {expiration_hours} HOUR))
+AS
+SELECT * EXCEPT (lot)
+FROM lots
+WHERE lot IN ({lots});
+"""
+
+
+def _lots_list(lots):
+  return ', '.join(str(lot) for lot in lots)
+
+
+def generate_split_script(source_table_name, split_tables, num_lots=NUM_LOTS,
+                          split_lots=None):
+  """Returns the BigQuery script creating the split tables.
+
+  Args:
+    source_table_name: The fully qualified name of the source table.
+    split_tables: A dictionary mapping the split names to the fully
+      qualified names of their tables.
+    num_lots: The number of lots.
+    split_lots: A dictionary mapping the split names to their lots.
+
+  Returns:
+    The script.
+  """
+  split_lots = split_lots or SPLIT_LOTS
+  all_lots = sorted(set(lot for lots in split_lots.values() for lot in lots))
+  split_statements = ''.join(
+      SPLIT_STATEMENT_TEMPLATE.format(
+          table=split_tables[split],
+          expiration_hours=SPLIT_TABLE_EXPIRATION_HOURS,
+          lots=_lots_list(lots))
+      for split, lots in split_lots.items())
+  return SPLIT_SCRIPT_TEMPLATE.format(
+      source_table=source_table_name,
+      num_lots=num_lots,
+      all_lots=_lots_list(all_lots),
+      split_statements=split_statements)
+
+
+class BigQueryEngine(object):
+  """Creates the splits with a BigQuery script and extract jobs."""
+
+  def __init__(self, project_id, dataset_id, location='US'):
+    from google.cloud import bigquery
+
+    self._bigquery = bigquery
+    self.client = bigquery.Client(project=project_id, location=location)
+    self.project_id = project_id
+    self.dataset_id = dataset_id
+    self.location = location
+
+  def _split_tables(self, split_lots, run_id=None):
+    """Returns the names of the split tables of a run.
+
+    Without a run ID, the names are the ones the cache key is computed
+    with, so that the key does not change from run to run.
+    """
+    suffix = '_{}'.format(run_id) if run_id else ''
+    return {
+        split: '{}.{}.{}{}'.format(self.project_id, self.dataset_id, split,
+                                   suffix) for split in split_lots
+    }
+
+  def describe(self, source_table_name, num_lots, split_lots):
+    """Returns the query and the version of the source table."""
+    table = self.client.get_table(source_table_name)
+    return {
+        'script':
+            generate_split_script(source_table_name,
+                                  self._split_tables(split_lots), num_lots,
+                                  split_lots),
+        'source_version':
+            'modified={},rows={}'.format(table.modified.isoformat(),
+                                         table.num_rows)
+    }
+
+  def create_splits(self, source_table_name, output_paths, num_lots,
+                    split_lots):
+    dataset = self._bigquery.Dataset('{}.{}'.format(self.project_id,
+                                                    self.dataset_id))
+    dataset.location = self.location
+    self.client.create_dataset(dataset, exists_ok=True)
+
+    split_tables = self._split_tables(split_lots, uuid.uuid4().hex)
+    script = generate_split_script(source_table_name, split_tables, num_lots,
+                                   split_lots)
+    print(script)
+    try:
+      query_job = self.client.query(script)
+      query_job.result()
+      print('Bytes billed: {}'.format(query_job.total_bytes_billed))
+
+      extract_jobs = []
+      for split in split_lots:
+        job_config = self._bigquery.ExtractJobConfig()
+        if data.is_parquet(output_paths[split]):
+          job_config.destination_format = (
+              self._bigquery.DestinationFormat.PARQUET)
+          job_config.compression = self._bigquery.Compression.SNAPPY
+        extract_jobs.append(
+            self.client.extract_table(
+                split_tables[split], output_paths[split],
+                job_config=job_config))
+      for extract_job in extract_jobs:
+        extract_job.result()
+    finally:
+      for table in split_tables.values():
+        self.client.delete_table(table, not_found_ok=True)
+
+
+def local_fingerprint(row_json):
+  """Returns a signed 64 bit fingerprint of a string."""
+  digest = hashlib.sha256(row_json.encode('utf-8')).digest()
+  return int.from_bytes(digest[:8], 'little', signed=True)
+
+
+class LocalEngine(object):
+  """Creates the splits from local CSV files standing in for the tables.
+
+  Args:
+    tables: A dictionary mapping the table names to the paths or gs://
+      URIs of their CSV files.
+  """
+
+  def __init__(self, tables):
+    self.tables = tables
+
+  def describe(self, source_table_name, num_lots, split_lots):
+    """Returns the path and the version of the source file."""
+    path = self.tables[source_table_name]
+    return {'source': path, 'source_version': fileio.version(path)}
+
+  def create_splits(self, source_table_name, output_paths, num_lots,
+                    split_lots):
+    source = pd.read_csv(self.tables[source_table_name])
+    # The JSON representation of the rows, as TO_JSON_STRING
+    rows_json = source.apply(
+        lambda row: json.dumps(row.to_dict(), separators=(',', ':')), axis=1)
+    lots = rows_json.map(
+        lambda row_json: abs(local_fingerprint(row_json)) % num_lots)
+
+    for split, split_lot_list in split_lots.items():
+      split_df = source[lots.isin(split_lot_list).values]
+      with fileio.open_file(output_paths[split], 'wb') as f:
+        if data.is_parquet(output_paths[split]):
+          split_df.to_parquet(f, compression='snappy', index=False)
+        else:
+          f.write(split_df.to_csv(index=False).encode('utf-8'))
+      print('Wrote {} rows to: {}'.format(len(split_df), output_paths[split]))
+
+
+def create_splits(engine, source_table_name, output_paths, num_lots=NUM_LOTS,
+                  split_lots=None, cache=None):
+  """Creates the splits of a source table in a single pass.
+
+  Args:
+    engine: A BigQueryEngine or a LocalEngine.
+    source_table_name: The name of the source table.
+    output_paths: A dictionary mapping the split names to the paths or
+      gs:// URIs of their CSV or Parquet files.
+    num_lots: The number of lots.
+    split_lots: A dictionary mapping the split names to their lots, by
+      default SPLIT_LOTS.
+    cache: An optional StepCache.
+
+  Returns:
+    The output paths.
+  """
+  split_lots = split_lots or SPLIT_LOTS
+  if cache:
+    key = step_cache.cache_key(
+        'create_splits',
+        engine=type(engine).__name__,
+        source_table_name=source_table_name,
+        output_paths=output_paths,
+        num_lots=num_lots,
+        split_lots=split_lots,
+        **engine.describe(source_table_name, num_lots, split_lots))
+    cached_paths = cache.get('create_splits', key)
+    if cached_paths:
+      return cached_paths
+
+  engine.create_splits(source_table_name, output_paths, num_lots, split_lots)
+
+  if cache:
+    cache.put(
+        'create_splits', key, output_paths, files=list(output_paths.values()))
+  return output_paths
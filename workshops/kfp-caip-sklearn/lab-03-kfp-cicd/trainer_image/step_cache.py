@@ -0,0 +1,108 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-based caching of the pipeline steps.
+
+A step is keyed by its name, its inputs and a fingerprint of the trainer
+code and libraries, which stands in for the digest of the image the step
+runs in. The inputs include the versions of the data the step reads,
+e.g. the generation of a GCS object or the last modification time of a
+BigQuery table. A cache entry records the outputs of the step and the
+versions of the files it wrote, and is used only while these files are
+unchanged.
+"""
+
+import glob
+import hashlib
+import json
+import os
+
+import pandas as pd
+import sklearn
+
+import fileio
+
+CACHE_FORMAT_VERSION = 1
+
+_code_fingerprint = None
+
+
+def code_fingerprint():
+  """Returns a fingerprint of the trainer modules and libraries."""
+  global _code_fingerprint
+  if _code_fingerprint is None:
+    digest = hashlib.sha1()
+    digest.update('sklearn={},pandas={}'.format(sklearn.__version__,
+                                                pd.__version__).encode('utf-8'))
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(module_dir, '*.py'))):
+      with open(path, 'rb') as f:
+        digest.update(f.read())
+    _code_fingerprint = digest.hexdigest()
+  return _code_fingerprint
+
+
+def data_versions(paths):
+  """Returns a dictionary mapping the existing paths to their versions."""
+  return {
+      path: fileio.version(path)
+      for path in paths
+      if path and fileio.exists(path)
+  }
+
+
+def cache_key(step, **inputs):
+  """Returns the cache key of a step and its inputs."""
+  key = {
+      'version': CACHE_FORMAT_VERSION,
+      'step': step,
+      'code': code_fingerprint(),
+      'inputs': inputs
+  }
+  return hashlib.sha1(
+      json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class StepCache(object):
+  """A cache of step outputs in a local directory or a gs:// URI."""
+
+  def __init__(self, root):
+    self.root = root
+
+  def _entry_path(self, step, key):
+    return fileio.join(self.root, step, key + '.json')
+
+  def get(self, step, key):
+    """Returns the outputs of a cached step, or None.
+
+    An entry is ignored if any of the files written by the step was
+    changed or deleted.
+    """
+    entry_path = self._entry_path(step, key)
+    if not fileio.exists(entry_path):
+      return None
+    with fileio.open_file(entry_path, 'rb') as f:
+      entry = json.loads(f.read().decode('utf-8'))
+    if data_versions(entry['files']) != entry['files']:
+      print('Ignoring the stale cache entry: {}'.format(entry_path))
+      return None
+
+    print('Using the cached outputs of {}: {}'.format(step, entry_path))
+    return entry['outputs']
+
+  def put(self, step, key, outputs, files=()):
+    """Caches the outputs of a step and the versions of its files."""
+    entry = {'outputs': outputs, 'files': data_versions(files)}
+    with fileio.open_file(self._entry_path(step, key), 'wb') as f:
+      f.write(json.dumps(entry, indent=2, sort_keys=True).encode('utf-8'))
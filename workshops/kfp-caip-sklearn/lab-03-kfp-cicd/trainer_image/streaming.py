@@ -0,0 +1,164 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Out-of-core training of the Covertype Classifier.
+
+The splits are streamed in mini-batches, so the memory used does not
+depend on the size of the splits. A first pass computes the scaler
+statistics, the categories of the categorical features and the classes.
+The following passes train the classifier with partial_fit, one pass
+per epoch, until the loss stops improving as in SGDClassifier.fit. The
+splits in GCS are downloaded once per run.
+"""
+
+import itertools
+
+import numpy as np
+from sklearn.compose import ColumnTransformer
+from sklearn.metrics import log_loss
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder
+from sklearn.preprocessing import StandardScaler
+
+import data
+
+
+def _iter_batches(paths, batch_size):
+  return itertools.chain.from_iterable(
+      data.iter_dataset(path, batch_size) for path in paths)
+
+
+def fit_preprocessor(paths, batch_size):
+  """Fits the preprocessor in a single pass over the splits.
+
+  Args:
+    paths: The paths or gs:// URIs of the CSV or Parquet splits.
+    batch_size: The number of rows read at a time.
+
+  Returns:
+    A tuple of the fitted ColumnTransformer and the sorted class labels.
+  """
+  scaler = StandardScaler()
+  categories = {feature: set() for feature in data.CATEGORICAL_FEATURES}
+  classes = set()
+  first_batch = None
+  for batch in _iter_batches(paths, batch_size):
+    if first_batch is None:
+      first_batch = batch
+    scaler.partial_fit(batch[data.NUMERIC_FEATURES])
+    for feature in data.CATEGORICAL_FEATURES:
+      categories[feature].update(batch[feature].dropna().unique())
+    classes.update(batch[data.LABEL].unique())
+
+  if first_batch is None:
+    raise ValueError('The training splits are empty: {}'.format(paths))
+
+  preprocessor = ColumnTransformer(transformers=[(
+      'num', StandardScaler(), data.NUMERIC_FEATURES), (
+          'cat',
+          OneHotEncoder(
+              categories=[
+                  sorted(categories[feature])
+                  for feature in data.CATEGORICAL_FEATURES
+              ],
+              handle_unknown='ignore'), data.CATEGORICAL_FEATURES)])
+  # The column transformer is fitted on one batch, which sets up its
+  # columns, and the scaler statistics are replaced by the full pass.
+  X, _ = data.split_features(first_batch)
+  preprocessor.fit(X)
+  fitted_scaler = preprocessor.named_transformers_['num']
+  for attribute in ['mean_', 'var_', 'scale_', 'n_samples_seen_']:
+    setattr(fitted_scaler, attribute, getattr(scaler, attribute))
+
+  return preprocessor, np.array(sorted(classes))
+
+
+def fit_classifier(preprocessor, classifier, classes, paths, batch_size,
+                   epochs):
+  """Trains the classifier with partial_fit on mini-batches.
+
+  The loss of an epoch is the progressive validation log loss, i.e. the
+  loss of each mini-batch computed before the classifier is updated with
+  it, so it costs no extra pass over the splits. The classifier may be
+  already trained, in which case its training continues.
+
+  As in SGDClassifier.fit, the training stops before the given number of
+  epochs once the loss did not improve by the tol of the classifier for
+  n_iter_no_change consecutive epochs. The splits should be local, see
+  data.local_copies.
+
+  Returns:
+    The list of the losses of the epochs.
+  """
+  tol = getattr(classifier, 'tol', None)
+  n_iter_no_change = getattr(classifier, 'n_iter_no_change', 5)
+  best_loss = np.inf
+  no_improvement_count = 0
+  losses = []
+  for epoch in range(epochs):
+    total_loss = 0.0
+    total_count = 0
+    for batch in _iter_batches(paths, batch_size):
+      X, y = data.split_features(batch)
+      X = preprocessor.transform(X)
+      if hasattr(classifier, 'coef_'):
+        total_loss += log_loss(
+            y, classifier.predict_proba(X), labels=classes) * len(y)
+        total_count += len(y)
+      classifier.partial_fit(X, y, classes=classes)
+
+    loss = total_loss / total_count if total_count else float('nan')
+    losses.append(loss)
+    print('Epoch {}/{}: loss={:.4f}'.format(epoch + 1, epochs, loss))
+
+    # The first epoch of a new classifier has no loss
+    if tol is None or not total_count:
+      continue
+    if loss > best_loss - tol:
+      no_improvement_count += 1
+    else:
+      no_improvement_count = 0
+    best_loss = min(best_loss, loss)
+    if no_improvement_count >= n_iter_no_change:
+      print('The loss did not improve for {} epochs, stopping'.format(
+          n_iter_no_change))
+      break
+  return losses
+
+
+def train(classifier, paths, batch_size, epochs):
+  """Trains the Covertype Classifier pipeline out of core.
+
+  epochs is the maximum number of passes over the splits.
+
+  Returns:
+    A fitted Pipeline with the same steps as the in-memory trainer.
+  """
+  with data.local_copies(paths) as local_paths:
+    preprocessor, classes = fit_preprocessor(local_paths, batch_size)
+    fit_classifier(preprocessor, classifier, classes, local_paths, batch_size,
+                   epochs)
+  return Pipeline([('preprocessor', preprocessor),
+                   ('classifier', classifier)])
+
+
+def score(pipeline, path, batch_size):
+  """Computes the accuracy of a pipeline on a split in mini-batches."""
+  correct = 0
+  count = 0
+  for batch in data.iter_dataset(path, batch_size):
+    X, y = data.split_features(batch)
+    correct += int((pipeline.predict(X) == y.values).sum())
+    count += len(y)
+  return correct / count
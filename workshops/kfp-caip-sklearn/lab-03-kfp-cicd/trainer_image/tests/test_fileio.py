@@ -0,0 +1,48 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+
+import pytest
+
+import fileio
+
+
+@pytest.mark.parametrize('umask', [0o022, 0o077])
+def test_open_file_applies_umask(tmp_path, umask):
+  path = str(tmp_path / 'output' / 'data.csv')
+  previous_umask = os.umask(umask)
+  try:
+    with fileio.open_file(path, 'wb') as f:
+      f.write(b'data')
+  finally:
+    os.umask(previous_umask)
+
+  assert stat.S_IMODE(os.stat(path).st_mode) == 0o666 & ~umask
+  assert os.listdir(os.path.dirname(path)) == ['data.csv']
+
+
+def test_open_file_keeps_file_on_failure(tmp_path):
+  path = str(tmp_path / 'data.csv')
+  with fileio.open_file(path, 'wb') as f:
+    f.write(b'data')
+
+  with pytest.raises(RuntimeError):
+    with fileio.open_file(path, 'wb') as f:
+      f.write(b'partial')
+      raise RuntimeError('failed')
+  with fileio.open_file(path, 'rb') as f:
+    assert f.read() == b'data'
+  assert os.listdir(str(tmp_path)) == ['data.csv']
@@ -0,0 +1,133 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import splits
+
+SOURCE_TABLE_NAME = 'covertype_dataset.covertype'
+
+
+@pytest.fixture
+def source_path(tmp_path):
+  random = np.random.RandomState(0)
+  num_rows = 500
+  source = pd.DataFrame({
+      'Elevation': random.randint(1800, 3900, num_rows),
+      'Slope': random.randint(0, 60, num_rows),
+      'Wilderness_Area': random.choice(['Rawah', 'Neota', 'Cache'], num_rows),
+      'Cover_Type': random.randint(0, 7, num_rows)
+  })
+  path = str(tmp_path / 'covertype.csv')
+  source.to_csv(path, index=False)
+  return path
+
+
+def _create_splits(source_path, output_dir):
+  output_paths = {
+      split: str(output_dir / '{}.csv'.format(split))
+      for split in splits.SPLIT_LOTS
+  }
+  engine = splits.LocalEngine({SOURCE_TABLE_NAME: source_path})
+  splits.create_splits(engine, SOURCE_TABLE_NAME, output_paths)
+  return {
+      split: pd.read_csv(path) for split, path in output_paths.items()
+  }
+
+
+def _row_lot(row):
+  row_json = json.dumps(row.to_dict(), separators=(',', ':'))
+  return abs(splits.local_fingerprint(row_json)) % splits.NUM_LOTS
+
+
+def test_local_splits_match_split_lots(source_path, tmp_path):
+  split_dfs = _create_splits(source_path, tmp_path)
+
+  source = pd.read_csv(source_path)
+  source_lots = source.apply(_row_lot, axis=1)
+  for split, lots in splits.SPLIT_LOTS.items():
+    assert len(split_dfs[split])
+    assert split_dfs[split].apply(_row_lot, axis=1).isin(lots).all()
+    assert len(split_dfs[split]) == source_lots.isin(lots).sum()
+
+
+def test_local_splits_are_disjoint(source_path, tmp_path):
+  split_dfs = _create_splits(source_path, tmp_path)
+
+  rows = [
+      set(map(tuple, split_df.values.tolist()))
+      for split_df in split_dfs.values()
+  ]
+  for i in range(len(rows)):
+    for j in range(i + 1, len(rows)):
+      assert not rows[i] & rows[j]
+
+
+def test_local_splits_are_deterministic(source_path, tmp_path):
+  (tmp_path / 'first').mkdir()
+  (tmp_path / 'second').mkdir()
+  first = _create_splits(source_path, tmp_path / 'first')
+  second = _create_splits(source_path, tmp_path / 'second')
+
+  for split in splits.SPLIT_LOTS:
+    pd.testing.assert_frame_equal(first[split], second[split])
+
+
+def _bigquery_engine():
+  engine = splits.BigQueryEngine.__new__(splits.BigQueryEngine)
+  engine._bigquery = mock.MagicMock()
+  engine.client = mock.MagicMock()
+  engine.project_id = 'mlops-dev-env'
+  engine.dataset_id = 'splits'
+  engine.location = 'US'
+  return engine
+
+
+def test_bigquery_split_tables_are_per_run_and_dropped():
+  output_paths = {
+      split: 'gs://bucket/{}/data.csv'.format(split)
+      for split in splits.SPLIT_LOTS
+  }
+  engine = _bigquery_engine()
+  engine.create_splits(SOURCE_TABLE_NAME, output_paths, splits.NUM_LOTS,
+                       splits.SPLIT_LOTS)
+  engine.create_splits(SOURCE_TABLE_NAME, output_paths, splits.NUM_LOTS,
+                       splits.SPLIT_LOTS)
+
+  extracted_tables = [
+      call[0][0] for call in engine.client.extract_table.call_args_list
+  ]
+  dropped_tables = [
+      call[0][0] for call in engine.client.delete_table.call_args_list
+  ]
+  assert len(extracted_tables) == 2 * len(splits.SPLIT_LOTS)
+  assert len(set(extracted_tables)) == len(extracted_tables)
+  assert sorted(dropped_tables) == sorted(extracted_tables)
+  for table in extracted_tables:
+    assert table not in engine._split_tables(splits.SPLIT_LOTS).values()
+
+
+def test_bigquery_split_tables_are_dropped_on_failure():
+  engine = _bigquery_engine()
+  engine.client.query.return_value.result.side_effect = RuntimeError('quota')
+
+  with pytest.raises(RuntimeError):
+    engine.create_splits(SOURCE_TABLE_NAME, {}, splits.NUM_LOTS,
+                         splits.SPLIT_LOTS)
+  assert engine.client.delete_table.call_count == len(splits.SPLIT_LOTS)
@@ -0,0 +1,127 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import artifacts
+import data
+import local_runner
+import splits
+import step_cache
+import train
+
+
+@pytest.fixture
+def source_path(tmp_path):
+  random = np.random.RandomState(0)
+  num_rows = 400
+  source = pd.DataFrame({
+      feature: random.randint(0, 360, num_rows)
+      for feature in data.NUMERIC_FEATURES
+  })
+  source['Wilderness_Area'] = random.choice(['Rawah', 'Neota', 'Cache'],
+                                            num_rows)
+  source['Soil_Type'] = random.choice(['2702', '7745', '8771'], num_rows)
+  source[data.LABEL] = random.randint(0, 3, num_rows)
+  path = str(tmp_path / 'covertype.csv')
+  source.to_csv(path, index=False)
+  return path
+
+
+@pytest.fixture
+def calls(monkeypatch):
+  """Counts the splits created and the models trained."""
+  calls = collections.Counter()
+
+  def counted(name, function):
+
+    def wrapper(*args, **kwargs):
+      calls[name] += 1
+      return function(*args, **kwargs)
+
+    return wrapper
+
+  monkeypatch.setattr(
+      splits.LocalEngine, 'create_splits',
+      counted('create_splits', splits.LocalEngine.create_splits))
+  monkeypatch.setattr(train, '_train_in_memory',
+                      counted('train', train._train_in_memory))
+  return calls
+
+
+def _run_pipeline(source_path, root):
+  return local_runner.run_pipeline(
+      source_path, str(root), alphas=[0.0001, 0.001], max_iters=[5],
+      max_workers=1)
+
+
+def test_step_cache_miss_then_hit(source_path, tmp_path, calls):
+  root = tmp_path / 'pipeline'
+  accuracy = _run_pipeline(source_path, root)
+  assert calls == {'create_splits': 1, 'train': 3}
+
+  calls.clear()
+  assert _run_pipeline(source_path, root) == accuracy
+  assert not calls
+
+
+def test_step_cache_miss_on_changed_source(source_path, tmp_path, calls):
+  root = tmp_path / 'pipeline'
+  _run_pipeline(source_path, root)
+
+  source = pd.read_csv(source_path)
+  source.iloc[:-1].to_csv(source_path, index=False)
+  calls.clear()
+  _run_pipeline(source_path, root)
+  assert calls['create_splits'] == 1
+
+
+def test_step_cache_ignores_stale_files(source_path, tmp_path, calls):
+  root = tmp_path / 'pipeline'
+  _run_pipeline(source_path, root)
+
+  # A changed split invalidates the splits and the steps reading them
+  with open(str(root / 'datasets' / 'validation' / 'data.csv'), 'ab') as f:
+    f.write(b'\n')
+  calls.clear()
+  _run_pipeline(source_path, root)
+  assert calls == {'create_splits': 1, 'train': 3}
+
+  # A deleted model invalidates the training step only
+  os.remove(artifacts.model_path(str(root / 'jobdir' / 'model')))
+  calls.clear()
+  _run_pipeline(source_path, root)
+  assert calls == {'train': 1}
+
+
+def test_step_cache_entry(tmp_path):
+  cache = step_cache.StepCache(str(tmp_path / 'cache'))
+  output_path = str(tmp_path / 'output.txt')
+  with open(output_path, 'w') as f:
+    f.write('output')
+  key = step_cache.cache_key('step', alpha=0.001)
+
+  assert cache.get('step', key) is None
+  cache.put('step', key, {'path': output_path}, files=[output_path])
+  assert cache.get('step', key) == {'path': output_path}
+  assert cache.get('step', step_cache.cache_key('step', alpha=0.01)) is None
+
+  with open(output_path, 'w') as f:
+    f.write('changed output')
+  assert cache.get('step', key) is None
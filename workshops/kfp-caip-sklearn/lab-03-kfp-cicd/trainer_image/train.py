@@ -14,76 +14,279 @@
 
 """Covertype Classifier trainer script."""
 
-import pickle
-import subprocess
-import sys
-
 import fire
 import hypertune
-import pandas as pd
-from sklearn.compose import ColumnTransformer
 from sklearn.linear_model import SGDClassifier
 from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import OneHotEncoder
-from sklearn.preprocessing import StandardScaler
+
+import artifacts
+import fileio
+import kernel
+import preprocessing
+import search as local_search
+import step_cache
+import streaming
+import warm_start
+
+DEFAULT_BATCH_SIZE = 50000
+SEARCH_REPORT_FILENAME = 'search_report.json'
 
 
 def train_evaluate(job_dir, training_dataset_path, validation_dataset_path,
-                   alpha, max_iter, hptune):
-  """Trains the Covertype Classifier model."""
+                   alpha=None, max_iter=None, hptune=False, cache_dir=None,
+                   stream=False, batch_size=DEFAULT_BATCH_SIZE, search=False,
+                   alphas=None, max_iters=None, num_workers=None,
+                   warm_start_dir=None, new_data_path=None,
+                   full_retrain=False, step_cache_dir=None):
+  """Trains the Covertype Classifier model.
 
-  df_train = pd.read_csv(training_dataset_path)
-  df_validation = pd.read_csv(validation_dataset_path)
+  If cache_dir is set the parsed datasets are cached there, so that
+  the hypertune trials parse each split only once.
 
-  if not hptune:
-    df_train = pd.concat([df_train, df_validation])
+  If stream is set the splits are streamed in mini-batches of
+  batch_size rows instead of being loaded into memory, and the classifier
+  is trained with partial_fit for at most max_iter epochs, stopping once
+  the loss does not improve.
 
-  numeric_features = [
-      'Elevation', 'Aspect', 'Slope', 'Horizontal_Distance_To_Hydrology',
-      'Vertical_Distance_To_Hydrology', 'Horizontal_Distance_To_Roadways',
-      'Hillshade_9am', 'Hillshade_Noon', 'Hillshade_3pm',
-      'Horizontal_Distance_To_Fire_Points'
-  ]
+  If search is set the alphas and max_iters candidates are evaluated on
+  the local machine instead, by num_workers processes, and the trial
+  report is saved in the job directory.
 
-  categorical_features = ['Wilderness_Area', 'Soil_Type']
+  If warm_start_dir is set, the model saved in it, typically the deployed
+  model, continues training with partial_fit on the data in new_data_path
+  for a few epochs. The model is retrained from scratch on the splits
+  instead if full_retrain is set, if there is no model in warm_start_dir
+  or if the schema of the new data changed. The hyperparameters of the
+  saved model, or the defaults of the warm_start module if there is no
+  model, are used unless alpha and max_iter are set.
 
-  preprocessor = ColumnTransformer(transformers=[(
-      'num', StandardScaler(),
-      numeric_features), ('cat', OneHotEncoder(), categorical_features)])
+  If step_cache_dir is set, the trainer reuses the accuracy of a trial or
+  the model of a training run with the same inputs instead of training.
 
-  pipeline = Pipeline([('preprocessor', preprocessor),
-                       ('classifier', SGDClassifier(loss='log'))])
+  The accuracy of a hypertune trial is reported to hypertune and is not
+  returned, so that fire does not print it.
+  """
+
+  run_training(
+      job_dir,
+      training_dataset_path,
+      validation_dataset_path,
+      alpha=alpha,
+      max_iter=max_iter,
+      hptune=hptune,
+      cache_dir=cache_dir,
+      stream=stream,
+      batch_size=batch_size,
+      search=search,
+      alphas=alphas,
+      max_iters=max_iters,
+      num_workers=num_workers,
+      warm_start_dir=warm_start_dir,
+      new_data_path=new_data_path,
+      full_retrain=full_retrain,
+      step_cache_dir=step_cache_dir)
+
+
+def run_training(job_dir, training_dataset_path, validation_dataset_path,
+                 alpha=None, max_iter=None, hptune=False, cache_dir=None,
+                 stream=False, batch_size=DEFAULT_BATCH_SIZE, search=False,
+                 alphas=None, max_iters=None, num_workers=None,
+                 warm_start_dir=None, new_data_path=None, full_retrain=False,
+                 step_cache_dir=None):
+  """Trains the Covertype Classifier model, see train_evaluate.
+
+  Returns:
+    The accuracy of a hypertune trial, or None.
+  """
+
+  if search:
+    local_search.search(
+        training_dataset_path,
+        validation_dataset_path,
+        '{}/{}'.format(job_dir, SEARCH_REPORT_FILENAME),
+        alphas=alphas,
+        max_iters=max_iters,
+        num_workers=num_workers,
+        cache_dir=cache_dir)
+    return
+
+  cache = None
+  if step_cache_dir:
+    cache = step_cache.StepCache(step_cache_dir)
+    step = 'hptune' if hptune else 'train'
+    inputs = [training_dataset_path, validation_dataset_path]
+    if warm_start_dir and not hptune:
+      inputs += [artifacts.model_path(warm_start_dir), new_data_path]
+    key = step_cache.cache_key(
+        step,
+        data=step_cache.data_versions(inputs),
+        alpha=alpha,
+        max_iter=max_iter,
+        stream=stream,
+        batch_size=batch_size if stream else None,
+        full_retrain=full_retrain)
+    outputs = cache.get(step, key)
+    if outputs and hptune:
+      _report_accuracy(outputs['accuracy'])
+      return outputs['accuracy']
+    if outputs:
+      model_path = artifacts.model_path(job_dir)
+      kernel_path = kernel.kernel_path(job_dir)
+      if outputs['model_path'] != model_path:
+        fileio.copy(outputs['model_path'], model_path)
+        fileio.copy(outputs['kernel_path'], kernel_path)
+      print('Saved model in: {}'.format(model_path))
+      return None
+
+  # The warm_start_dir is empty if the model has no deployed version
+  pipeline = None
+  if warm_start_dir is not None and not hptune:
+    pipeline, alpha, max_iter = _train_warm_start(warm_start_dir,
+                                                  new_data_path, alpha,
+                                                  max_iter, full_retrain,
+                                                  batch_size)
+
+  if alpha is None or max_iter is None:
+    raise ValueError('alpha and max_iter are required unless searching')
+
+  if pipeline is not None:
+    accuracy = None
+  elif stream:
+    pipeline, accuracy = _train_streaming(training_dataset_path,
+                                          validation_dataset_path, alpha,
+                                          max_iter, hptune, batch_size)
+  else:
+    pipeline, accuracy = _train_in_memory(training_dataset_path,
+                                          validation_dataset_path, alpha,
+                                          max_iter, hptune, cache_dir)
+
+  if hptune:
+    _report_accuracy(accuracy)
+    if cache:
+      cache.put(step, key, {'accuracy': accuracy})
+    return accuracy
+
+  # Save the model and its inference kernel
+  model_path = artifacts.save_model(pipeline, job_dir)
+  kernel_path = kernel.export_kernel(pipeline, job_dir)
+  print('Saved model in: {}'.format(model_path))
+  if cache:
+    cache.put(
+        step,
+        key, {
+            'model_path': model_path,
+            'kernel_path': kernel_path
+        },
+        files=[model_path, kernel_path])
+  return None
+
+
+def _report_accuracy(accuracy):
+  print('Model accuracy: {}'.format(accuracy))
+  # Log it with hypertune
+  hpt = hypertune.HyperTune()
+  hpt.report_hyperparameter_tuning_metric(
+      hyperparameter_metric_tag='accuracy', metric_value=accuracy)
 
-  num_features_type_map = {feature: 'float64' for feature in numeric_features}
-  df_train = df_train.astype(num_features_type_map)
-  df_validation = df_validation.astype(num_features_type_map)
+
+def _train_warm_start(warm_start_dir, new_data_path, alpha, max_iter,
+                      full_retrain, batch_size):
+  """Continues training the model saved in warm_start_dir.
+
+  Returns:
+    A tuple of the trained pipeline, or None if the model has to be
+    retrained from scratch, and of the alpha and max_iter to retrain it
+    with, which are never None.
+  """
+
+  deployed_pipeline = warm_start.load_deployed_model(warm_start_dir)
+  if deployed_pipeline is None:
+    if alpha is None:
+      alpha = warm_start.DEFAULT_ALPHA
+    if max_iter is None:
+      max_iter = warm_start.DEFAULT_MAX_ITER
+    print('No model in {}, retraining from scratch: alpha={}, max_iter={}'
+          .format(warm_start_dir, alpha, max_iter))
+    return None, alpha, max_iter
+
+  # The models streamed by earlier trainers do not record max_iter
+  classifier = deployed_pipeline.named_steps['classifier']
+  if alpha is None:
+    alpha = classifier.alpha
+  if max_iter is None:
+    max_iter = classifier.max_iter or warm_start.DEFAULT_MAX_ITER
+
+  if full_retrain:
+    print('Full retraining requested')
+    return None, alpha, max_iter
+  if not new_data_path:
+    raise ValueError('new_data_path is required to warm start')
+
+  changes = warm_start.schema_changes(deployed_pipeline, [new_data_path],
+                                      batch_size)
+  if changes:
+    print('The schema of the new data changed, retraining from scratch: {}'
+          .format(', '.join(changes)))
+    return None, alpha, max_iter
+
+  print('Continuing training of the model in {} on {}'.format(
+      warm_start_dir, new_data_path))
+  pipeline = warm_start.continue_training(deployed_pipeline, [new_data_path],
+                                          batch_size)
+  return pipeline, alpha, max_iter
+
+
+def _train_in_memory(training_dataset_path, validation_dataset_path, alpha,
+                     max_iter, hptune, cache_dir):
+  """Trains the model on the splits loaded into memory.
+
+  The fitted preprocessor and the transformed splits are cached in
+  cache_dir, so the trials only fit the classifier.
+  """
+
+  training_dataset_paths = [training_dataset_path]
+  if not hptune:
+    training_dataset_paths.append(validation_dataset_path)
+  preprocessor, splits = preprocessing.load_preprocessed(
+      training_dataset_paths, validation_dataset_path if hptune else None,
+      cache_dir)
 
   print('Starting training: alpha={}, max_iter={}'.format(alpha, max_iter))
-  X_train = df_train.drop('Cover_Type', axis=1)
-  y_train = df_train['Cover_Type']
+  X_train, y_train = splits['train']
 
-  pipeline.set_params(classifier__alpha=alpha, classifier__max_iter=max_iter)
-  pipeline.fit(X_train, y_train)
+  classifier = SGDClassifier(loss='log', alpha=alpha, max_iter=max_iter)
+  classifier.fit(X_train, y_train)
+  pipeline = Pipeline([('preprocessor', preprocessor),
+                       ('classifier', classifier)])
 
+  accuracy = None
   if hptune:
-    X_validation = df_validation.drop('Cover_Type', axis=1)
-    y_validation = df_validation['Cover_Type']
-    accuracy = pipeline.score(X_validation, y_validation)
-    print('Model accuracy: {}'.format(accuracy))
-    # Log it with hypertune
-    hpt = hypertune.HyperTune()
-    hpt.report_hyperparameter_tuning_metric(
-        hyperparameter_metric_tag='accuracy', metric_value=accuracy)
-
-  # Save the model
+    X_validation, y_validation = splits['validation']
+    accuracy = classifier.score(X_validation, y_validation)
+  return pipeline, accuracy
+
+
+def _train_streaming(training_dataset_path, validation_dataset_path, alpha,
+                     max_iter, hptune, batch_size):
+  """Trains the model on the splits streamed in mini-batches."""
+
+  paths = [training_dataset_path]
   if not hptune:
-    model_filename = 'model.pkl'
-    with open(model_filename, 'wb') as model_file:
-      pickle.dump(pipeline, model_file)
-    gcs_model_path = '{}/{}'.format(job_dir, model_filename)
-    subprocess.check_call(['gsutil', 'cp', model_filename, gcs_model_path],
-                          stderr=sys.stdout)
-    print('Saved model in: {}'.format(gcs_model_path))
+    paths.append(validation_dataset_path)
+
+  print('Starting streaming training: alpha={}, epochs={}, batch_size={}'
+        .format(alpha, max_iter, batch_size))
+  # max_iter bounds the epochs, which stop early as in SGDClassifier.fit.
+  # It is set on the classifier so that the model records it.
+  classifier = SGDClassifier(
+      loss='log', alpha=alpha, max_iter=max_iter, tol=1e-3,
+      n_iter_no_change=5)
+  pipeline = streaming.train(classifier, paths, batch_size, max_iter)
+
+  accuracy = None
+  if hptune:
+    accuracy = streaming.score(pipeline, validation_dataset_path, batch_size)
+  return pipeline, accuracy
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+# Copyright 2020 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#            http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental retraining of a deployed Covertype Classifier.
+
+The fitted preprocessor of the deployed model is kept and its classifier
+continues training with partial_fit on the newly arrived data only. This
+is possible only if the new data has the schema the model was trained
+on, i.e. the same columns, no unseen categories and no unseen classes.
+Otherwise the model has to be retrained from scratch.
+"""
+
+import artifacts
+import data
+import fileio
+import streaming
+
+DEFAULT_EPOCHS = 5
+
+# The hyperparameters a model is retrained with from scratch when there is
+# no deployed model to take them from and none are given
+DEFAULT_ALPHA = 0.0001
+DEFAULT_MAX_ITER = 500
+
+
+def load_deployed_model(model_dir):
+  """Returns the model saved in a directory, or None if there is none.
+
+  There is none if the directory is empty, e.g. the model has no default
+  version, or if it holds a model saved in another format, e.g. the
+  model.pkl of the earlier versions of the trainer.
+  """
+  if not model_dir or not fileio.exists(artifacts.model_path(model_dir)):
+    return None
+  return artifacts.load_model(model_dir)
+
+
+def schema_changes(pipeline, paths, batch_size):
+  """Compares the schema of new data with the schema of a model.
+
+  Args:
+    pipeline: The trained pipeline.
+    paths: The paths or gs:// URIs of the splits of new data.
+    batch_size: The number of rows read at a time.
+
+  Returns:
+    A list of descriptions of the changes, empty if there are none.
+  """
+  encoder = pipeline.named_steps['preprocessor'].named_transformers_['cat']
+  known_categories = {
+      feature: set(str(category) for category in categories)
+      for feature, categories in zip(data.CATEGORICAL_FEATURES,
+                                     encoder.categories_)
+  }
+  known_classes = set(pipeline.named_steps['classifier'].classes_.tolist())
+
+  changes = set()
+  for path in paths:
+    for batch in data.iter_dataset(path, batch_size):
+      for column in set(data.SCHEMA_COLUMNS) - set(batch.columns):
+        changes.add('missing column {}'.format(column))
+      for feature in data.CATEGORICAL_FEATURES:
+        if feature not in batch:
+          continue
+        values = set(batch[feature].dropna().astype(str).unique())
+        for value in values - known_categories[feature]:
+          changes.add('unseen {} category {}'.format(feature, value))
+      if data.LABEL in batch:
+        for label in set(batch[data.LABEL].unique().tolist()) - known_classes:
+          changes.add('unseen class {}'.format(label))
+  return sorted(changes)
+
+
+def continue_training(pipeline, paths, batch_size, epochs=DEFAULT_EPOCHS):
+  """Continues training the classifier of a pipeline on new data.
+
+  The preprocessor is not refitted.
+
+  Returns:
+    The pipeline.
+  """
+  classifier = pipeline.named_steps['classifier']
+  with data.local_copies(paths) as local_paths:
+    streaming.fit_classifier(pipeline.named_steps['preprocessor'], classifier,
+                             classifier.classes_, local_paths, batch_size,
+                             epochs)
+  return pipeline
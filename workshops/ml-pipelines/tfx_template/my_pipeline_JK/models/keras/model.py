@@ -22,6 +22,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import time
 from absl import logging
 import tensorflow as tf
 import tensorflow_transform as tft
@@ -30,6 +31,24 @@ from models import features
 from models.keras import constants
 
 
+# The options of the input pipeline, which can be overridden by the
+# 'input_pipeline' entry of the Trainer custom_config, e.g.
+# custom_config={'input_pipeline': {'cache_train': True}}.
+INPUT_PIPELINE_DEFAULTS = {
+    # The number of transformed example files read in parallel
+    'num_parallel_reads': tf.data.experimental.AUTOTUNE,
+    'shuffle_buffer_size': 10000,
+    # Whether to cache the decompressed training records, so that the
+    # epochs after the first one do not read the files again, and the
+    # file prefix of the cache, or '' to cache in memory
+    'cache_train': False,
+    'cache_path': '',
+    # The number of training batches read and timed before training,
+    # or 0 not to benchmark the input pipeline
+    'benchmark_steps': 0,
+}
+
+
 def _gzip_reader_fn(filenames):
   """Small utility returning a record reader that can read gzip'ed files."""
   return tf.data.TFRecordDataset(filenames, compression_type='GZIP')
@@ -54,14 +73,37 @@ def _get_serve_tf_examples_fn(model, tf_transform_output):
   return serve_tf_examples_fn
 
 
-def _input_fn(file_pattern, tf_transform_output, batch_size=200):
+def _input_pipeline_config(fn_args):
+  """Returns the input pipeline options of the Trainer custom_config."""
+  custom_config = getattr(fn_args, 'custom_config', None) or {}
+  config = dict(INPUT_PIPELINE_DEFAULTS)
+  config.update(custom_config.get('input_pipeline', {}))
+  return config
+
+
+def _input_fn(file_pattern,
+              tf_transform_output,
+              batch_size=200,
+              num_parallel_reads=tf.data.experimental.AUTOTUNE,
+              shuffle_buffer_size=10000,
+              cache=False,
+              cache_path=''):
   """Generates features and label for tuning/training.
 
+  The transformed example files are read in parallel and the shuffled
+  records are batched before they are parsed, so that each batch is
+  parsed by a single vectorized parse_example. The batches are prefetched
+  while the model trains on the previous ones.
+
   Args:
     file_pattern: input tfrecord file pattern.
     tf_transform_output: A TFTransformOutput.
     batch_size: representing the number of consecutive elements of returned
       dataset to combine in a single batch
+    num_parallel_reads: the number of files read in parallel.
+    shuffle_buffer_size: the number of records shuffled at a time.
+    cache: whether to cache the decompressed records after the first epoch.
+    cache_path: the file prefix of the cache, or '' to cache in memory.
 
   Returns:
     A dataset that contains (features, indices) tuple where features is a
@@ -69,15 +111,44 @@ def _input_fn(file_pattern, tf_transform_output, batch_size=200):
   """
   transformed_feature_spec = (
       tf_transform_output.transformed_feature_spec().copy())
-
-  dataset = tf.data.experimental.make_batched_features_dataset(
-      file_pattern=file_pattern,
-      batch_size=batch_size,
-      features=transformed_feature_spec,
-      reader=_gzip_reader_fn,
-      label_key=features.transformed_name(features.LABEL_KEY))
-
-  return dataset
+  label_key = features.transformed_name(features.LABEL_KEY)
+
+  def parse_batch(serialized_examples):
+    parsed_features = tf.io.parse_example(serialized_examples,
+                                          transformed_feature_spec)
+    label = parsed_features.pop(label_key)
+    return parsed_features, label
+
+  filenames = tf.data.Dataset.list_files(file_pattern, shuffle=True)
+  dataset = filenames.interleave(
+      _gzip_reader_fn,
+      cycle_length=num_parallel_reads,
+      num_parallel_calls=tf.data.experimental.AUTOTUNE)
+  if cache:
+    dataset = dataset.cache(cache_path)
+  dataset = dataset.shuffle(shuffle_buffer_size).repeat()
+  dataset = dataset.batch(batch_size)
+  dataset = dataset.map(
+      parse_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+  return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def _benchmark_input_fn(dataset, num_steps, batch_size):
+  """Logs the time per step of reading batches of a dataset.
+
+  The input pipeline bounds the training speed if its step time is close
+  to the step time of the training.
+  """
+  iterator = iter(dataset)
+  # The first batch includes the start up of the pipeline
+  next(iterator)
+  start_time = time.time()
+  for _ in range(num_steps):
+    next(iterator)
+  step_time = (time.time() - start_time) / num_steps
+  logging.info('Input pipeline: %.2f ms per step, %.0f examples per second',
+               step_time * 1000, batch_size / step_time)
 
 
 def _build_keras_model(hidden_units, learning_rate):
@@ -196,10 +267,28 @@ def run_fn(fn_args):
 
   tf_transform_output = tft.TFTransformOutput(fn_args.transform_output)
 
-  train_dataset = _input_fn(fn_args.train_files, tf_transform_output,
-                            constants.TRAIN_BATCH_SIZE)
+  input_config = _input_pipeline_config(fn_args)
+  read_options = {
+      'num_parallel_reads': input_config['num_parallel_reads'],
+      'shuffle_buffer_size': input_config['shuffle_buffer_size']
+  }
+
+  if input_config['benchmark_steps']:
+    # Without the cache, which would be left incomplete
+    benchmark_dataset = _input_fn(fn_args.train_files, tf_transform_output,
+                                  constants.TRAIN_BATCH_SIZE, **read_options)
+    _benchmark_input_fn(benchmark_dataset, input_config['benchmark_steps'],
+                        constants.TRAIN_BATCH_SIZE)
+
+  train_dataset = _input_fn(
+      fn_args.train_files,
+      tf_transform_output,
+      constants.TRAIN_BATCH_SIZE,
+      cache=input_config['cache_train'],
+      cache_path=input_config['cache_path'],
+      **read_options)
   eval_dataset = _input_fn(fn_args.eval_files, tf_transform_output,
-                           constants.EVAL_BATCH_SIZE)
+                           constants.EVAL_BATCH_SIZE, **read_options)
 
   mirrored_strategy = tf.distribute.MirroredStrategy()
   with mirrored_strategy.scope():
@@ -17,8 +17,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import types
+
 import tensorflow as tf
 
+from models import features
 from models.keras import model
 
 
@@ -32,6 +36,68 @@ class ModelTest(tf.test.TestCase):
     built_model = model._build_keras_model(hidden_units=[1], learning_rate=0.1)  # pylint: disable=protected-access
     self.assertEqual(len(built_model.layers), 9)
 
+  def testInputPipelineConfig(self):
+    fn_args = types.SimpleNamespace(
+        custom_config={'input_pipeline': {'cache_train': True}})
+    config = model._input_pipeline_config(fn_args)  # pylint: disable=protected-access
+    self.assertTrue(config['cache_train'])
+    self.assertEqual(config['shuffle_buffer_size'],
+                     model.INPUT_PIPELINE_DEFAULTS['shuffle_buffer_size'])
+
+    config = model._input_pipeline_config(types.SimpleNamespace())  # pylint: disable=protected-access
+    self.assertEqual(config, model.INPUT_PIPELINE_DEFAULTS)
+
+  def _write_transformed_examples(self, num_examples):
+    """Writes a GZIP TFRecord file of transformed examples."""
+    feature_key = features.transformed_names(
+        features.DENSE_FLOAT_FEATURE_KEYS)[0]
+    label_key = features.transformed_name(features.LABEL_KEY)
+    path = os.path.join(self.get_temp_dir(), 'transformed_examples.gz')
+    with tf.io.TFRecordWriter(path, options='GZIP') as writer:
+      for i in range(num_examples):
+        example = tf.train.Example(
+            features=tf.train.Features(
+                feature={
+                    feature_key:
+                        tf.train.Feature(
+                            float_list=tf.train.FloatList(value=[float(i)])),
+                    label_key:
+                        tf.train.Feature(
+                            int64_list=tf.train.Int64List(value=[i % 2])),
+                }))
+        writer.write(example.SerializeToString())
+    feature_spec = {
+        feature_key: tf.io.FixedLenFeature([], tf.float32),
+        label_key: tf.io.FixedLenFeature([], tf.int64),
+    }
+    return path, feature_key, feature_spec
+
+  def testInputFn(self):
+    file_pattern, feature_key, feature_spec = (
+        self._write_transformed_examples(10))
+    tf_transform_output = types.SimpleNamespace(
+        transformed_feature_spec=lambda: feature_spec)
+
+    for cache, cache_path in [
+        (False, ''), (True, ''),
+        (True, os.path.join(self.get_temp_dir(), 'input_cache'))
+    ]:
+      dataset = model._input_fn(  # pylint: disable=protected-access
+          file_pattern,
+          tf_transform_output,
+          batch_size=4,
+          shuffle_buffer_size=10,
+          cache=cache,
+          cache_path=cache_path)
+      # The batches of the repeated epochs have the same structure
+      for batch_features, label in dataset.take(5):
+        self.assertEqual(set(batch_features), {feature_key})
+        self.assertEqual(batch_features[feature_key].shape, (4,))
+        self.assertEqual(label.shape, (4,))
+        self.assertAllEqual(
+            label,
+            tf.cast(batch_features[feature_key], tf.int64) % 2)
+
 
 if __name__ == '__main__':
   tf.test.main()